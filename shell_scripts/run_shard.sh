@@ -0,0 +1,4 @@
+#!/bin/bash
+# Job body for submit_shards.sh; SHARD_INDEX is taken from PBS_ARRAY_INDEX
+cd "$PBS_O_WORKDIR" || exit 1
+singularity exec --nv container/visu_env.sif uv run -m "$MODULE"
@@ -0,0 +1,11 @@
+#!/bin/bash
+# Usage: shell_scripts/submit_shards.sh <num_shards> <module> [queue]
+#   e.g. shell_scripts/submit_shards.sh 8 src.inference.shuffled_text.gpt4o rt_HC
+# Merge afterwards with: uv run -m src.merge_shards <output_jsonl> <num_shards> <dataset_jsonl> [limit | start:stop]
+NUM_SHARDS=$1
+MODULE=$2
+QUEUE=${3:-rt_HC}
+qsub -P gch51711 -q "$QUEUE" -l select=1 -l walltime=12:00:00 \
+    -J 0-$((NUM_SHARDS - 1)) \
+    -v NUM_SHARDS="$NUM_SHARDS",MODULE="$MODULE" \
+    shell_scripts/run_shard.sh
@@ -1,38 +1,90 @@
 import json
-from pprint import pprint
+import sys
+import time
+from pathlib import Path
 
-import pandas as pd
+import numpy as np
 
 from src.utils.paths import ORIGINAL_ROOT, VIST_JSON_ROOT
 from src.utils.text_processor import TextProcessor as tp
-from src.utils.utils import load_json
+from src.utils.utils import iter_json_array
 
-if __name__ == "__main__":
-    sis_test = load_json(VIST_JSON_ROOT / "sis" / "test.story-in-sequence.json")
-    sis_test_annotations_df = pd.DataFrame(sis_test["annotations"])
-    sis_test_annotations_df = sis_test_annotations_df[0].apply(pd.Series)
 
-    sis_test_annotations_df["text"] = sis_test_annotations_df["text"].apply(
-        tp.convert_numbers_to_words
-    )
+def build_base_data(sis_path: Path, output_path: Path) -> None:
+    """
+    sis_path: {split}.story-in-sequence.json
+    output_path: one line per story, sorted by story_id:
+        {"story_id": str, "image_ids": [...], "texts": [...]}
+        ordered by worker_arranged_photo_order
 
-    ordered_annotations = (
-        sis_test_annotations_df.sort_values(["story_id", "worker_arranged_photo_order"])
-        .groupby("story_id")
-        .apply(
-            lambda df: {
-                "image_ids": df["photo_flickr_id"].tolist(),
-                "texts": df["text"].tolist(),
-            }
-        )
-        .to_dict()
-    )
+    Annotations are streamed from the json and kept only as compact columns
+    (interned ids, int orders, caption list), so the images/albums sections of
+    large splits are never loaded.
+    """
+    start = time.perf_counter()
+
+    story_codes: dict[str, int] = {}
+    story_col = []
+    order_col = []
+    photo_col = []
+    text_col = []
+    for annotation in iter_json_array(sis_path, "annotations"):
+        # each annotation is a list holding one dict
+        row = annotation[0]
+        story_col.append(story_codes.setdefault(row["story_id"], len(story_codes)))
+        order_col.append(row["worker_arranged_photo_order"])
+        photo_col.append(sys.intern(row["photo_flickr_id"]))
+        text_col.append(row["text"])
+        if len(story_col) % 100000 == 0:
+            elapsed = time.perf_counter() - start
+            print(
+                f"parsed {len(story_col)} annotations "
+                f"({len(story_col) / elapsed:.0f} rows/sec)",
+                end="\r",
+            )
+    parse_time = time.perf_counter() - start
 
-    pprint(ordered_annotations)
+    texts = tp.convert_numbers_to_words_batch(text_col).tolist()
 
-    output_path = ORIGINAL_ROOT / "sis_base.jsonl"
+    # sort by story_id (as str, like the previous pandas version), then by order
+    story_names = np.asarray(list(story_codes), dtype=str)
+    story_ids = story_names[np.asarray(story_col, dtype=np.int64)]
+    orders = np.asarray(order_col, dtype=np.int64)
+    sorted_idx = np.lexsort((orders, story_ids))
+    sorted_story_ids = story_ids[sorted_idx]
+    boundaries = np.flatnonzero(sorted_story_ids[1:] != sorted_story_ids[:-1]) + 1
+    group_starts = np.concatenate(([0], boundaries)).tolist()
+    group_ends = np.concatenate((boundaries, [len(sorted_idx)])).tolist()
 
+    sorted_idx = sorted_idx.tolist()
     with open(output_path, "w", encoding="utf-8") as f:
-        for story_id, rec in ordered_annotations.items():
-            record = {"story_id": story_id, **rec}
+        for group_start, group_end in zip(group_starts, group_ends):
+            rows = sorted_idx[group_start:group_end]
+            record = {
+                "story_id": str(sorted_story_ids[group_start]),
+                "image_ids": [photo_col[i] for i in rows],
+                "texts": [texts[i] for i in rows],
+            }
             f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Wrote {len(group_starts)} stories ({len(story_col)} annotations) to "
+        f"{output_path} in {elapsed:.1f}s "
+        f"(parse {len(story_col) / parse_time if parse_time > 0 else 0.0:.0f} rows/sec, "
+        f"total {len(story_col) / elapsed if elapsed > 0 else 0.0:.0f} rows/sec)"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print(
+            "Usage: uv run -m src.build_dataset.build_base_data [split (default: test)]",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    split = sys.argv[1] if len(sys.argv) == 2 else "test"
+
+    sis_path = VIST_JSON_ROOT / "sis" / f"{split}.story-in-sequence.json"
+    file_name = "sis_base.jsonl" if split == "test" else f"sis_base_{split}.jsonl"
+    build_base_data(sis_path=sis_path, output_path=ORIGINAL_ROOT / file_name)
@@ -1,28 +1,187 @@
 import json
+import re
 import sys
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 
-from openai import OpenAI
+import httpx
 from tqdm import tqdm
 
+from src.utils.concurrency import (
+    AdaptiveRateLimiter,
+    JsonlWriter,
+    load_done_keys,
+    send_with_retries,
+)
+from src.utils.image_processor import ImageProcessor as ip
 from src.utils.paths import ORIGINAL_ROOT
-from src.utils.text_processor import TextProcessor as tp
+from src.utils.payload import (
+    RequestBody,
+    get_message_content,
+    post_chat_completion,
+    request_cache_key,
+)
+from src.utils.response_cache import get_response_cache
+from src.utils.text_processor import (
+    BUILD_INCORRECT_OPTION_TEMPLATE,
+    BUILD_MULTI_POS_INCORRECT_OPTION_TEMPLATE,
+)
 from src.utils.utils import env
 
 MODEL = "gpt-4o"
 OPENAI_API_KEY = env(key="OPENAI_API_KEY", required=True)
-client = OpenAI(api_key=OPENAI_API_KEY)
+OPENAI_BASE_URL = env(key="OPENAI_BASE_URL", default="https://api.openai.com/v1")
+# number of requests in flight at once
+MAX_IN_FLIGHT = int(env(key="VISU_MAX_IN_FLIGHT", default="8"))
+# optional client-side cap; the provider's rate limit headers are always honored
+REQUESTS_PER_MINUTE = env(key="VISU_REQUESTS_PER_MINUTE")
+# rounds of retries for replies that are not a JSON array of strings
+PARSE_RETRIES = int(env(key="VISU_PARSE_RETRIES", default="2"))
+# temperature=0 tends to repeat the same malformed reply
+RETRY_TEMPERATURE = 0.7
+client = httpx.Client(timeout=600, limits=httpx.Limits(max_connections=MAX_IN_FLIGHT))
+
+JSON_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+
+
+class OptionParseError(ValueError):
+    def __init__(self, message: str, generated: str | None):
+        super().__init__(message)
+        self.generated = generated
+
+
+def parse_incorrect_options(generated: str | None) -> list[str]:
+    """generated: model reply, optionally wrapped in a ```json fence"""
+    if not generated:
+        raise OptionParseError("empty reply", generated)
+    m = JSON_FENCE_PATTERN.search(generated)
+    text = (m.group(1) if m else generated).strip()
+    try:
+        options = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise OptionParseError(f"invalid JSON: {e}", generated) from e
+    if not isinstance(options, list) or not all(isinstance(o, str) for o in options):
+        raise OptionParseError("not a JSON array of strings", generated)
+    return options
+
+
+def parse_multi_pos_incorrect_options(
+    generated: str | None, positions: list[int]
+) -> dict[int, list[str]]:
+    """generated: JSON object {"pos": [options]} covering every position"""
+    if not generated:
+        raise OptionParseError("empty reply", generated)
+    m = JSON_FENCE_PATTERN.search(generated)
+    text = (m.group(1) if m else generated).strip()
+    try:
+        reply = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise OptionParseError(f"invalid JSON: {e}", generated) from e
+    if not isinstance(reply, dict):
+        raise OptionParseError("not a JSON object", generated)
+    options_by_pos = {}
+    for pos in positions:
+        options = reply.get(str(pos))
+        if not isinstance(options, list) or not all(
+            isinstance(o, str) for o in options
+        ):
+            raise OptionParseError(f"no JSON array of strings for pos {pos}", generated)
+        options_by_pos[pos] = options
+    return options_by_pos
+
+
+def parse_options_by_pos(
+    generated: str | None, positions: list[int]
+) -> dict[int, list[str]]:
+    if len(positions) == 1:
+        return {positions[0]: parse_incorrect_options(generated)}
+    return parse_multi_pos_incorrect_options(generated, positions)
+
+
+def group_positions(positions: list[int]) -> list[list[int]]:
+    """
+    Positions of one story split into the positions of its requests: even and
+    odd ones, so no request hides the image next to one of its targets
+    """
+    groups = [[pos for pos in positions if pos % 2 == parity] for parity in (0, 1)]
+    return [group for group in groups if group]
+
+
+def generate_incorrect_options(
+    sample: dict,
+    num_incorrect_options: int,
+    positions: list[int],
+    limiter: AdaptiveRateLimiter,
+    temperature: float,
+) -> dict[int, list[str]]:
+    """
+    One request: a single position uses BUILD_INCORRECT_OPTION_TEMPLATE, several
+    (see group_positions) BUILD_MULTI_POS_INCORRECT_OPTION_TEMPLATE; the images
+    of the requested positions are hidden in both.
+    return: {pos: incorrect options}
+    """
+    if len(positions) == 1:
+        template = BUILD_INCORRECT_OPTION_TEMPLATE
+        sample = {**sample, "target_pos": positions[0]}
+    else:
+        template = BUILD_MULTI_POS_INCORRECT_OPTION_TEMPLATE
+        sample = {**sample, "target_positions": positions}
+    sample = {**sample, "num_incorrect_options": num_incorrect_options}
+    params = {
+        "temperature": temperature,
+        "max_tokens": 512 * len(positions),
+        "top_p": 1,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+    }
+    response_cache = get_response_cache()
+    cache_key = request_cache_key(MODEL, template, sample, **params)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        try:
+            return parse_options_by_pos(get_message_content(cached), positions)
+        except OptionParseError:
+            # cached before replies were checked; ask the model again
+            pass
+    body = RequestBody(model=MODEL, template=template, sample=sample, **params)
+    response = send_with_retries(
+        lambda: post_chat_completion(
+            client, body, api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL
+        ),
+        limiter,
+    ).json()
+    options_by_pos = parse_options_by_pos(get_message_content(response), positions)
+    # only replies that parse are cached, so a retry round or the next run
+    # asks the model again instead of getting the same malformed reply
+    response_cache.put(cache_key, MODEL, response)
+    return options_by_pos
+
+
+def get_output_path(target_pos: int, num_incorrect_options: int) -> Path:
+    return (
+        ORIGINAL_ROOT
+        / "text_option"
+        / f"pos{target_pos}"
+        / f"incorrect_options_{num_incorrect_options}.jsonl"
+    )
 
 
 def main():
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         print(
-            "Usage: uv run -m src.build_dataset.build_incorrect_options <num_incorrect_options> <target_pos>",
+            "Usage: uv run -m src.build_dataset.build_incorrect_options "
+            "<num_incorrect_options> <target_pos | pos,pos,... | all> [limit]\n"
+            "  several positions are generated with one request per story for the\n"
+            "  even and one for the odd positions (target images are hidden)",
             file=sys.stderr,
         )
         sys.exit(1)
     num_incorrect_options = int(sys.argv[1])
-    target_pos = int(sys.argv[2])
+    # None: every position of each story
+    target_positions = (
+        None if sys.argv[2] == "all" else [int(p) for p in sys.argv[2].split(",")]
+    )
+    limit = int(sys.argv[3]) if len(sys.argv) == 4 else None
     sis_base_path = ORIGINAL_ROOT / "sis_base.jsonl"
     data = []
     with open(sis_base_path, "r", encoding="utf-8") as f:
@@ -32,50 +191,112 @@ def main():
                 continue
             item = json.loads(line)
             data.append(item)
+    data = data[:limit]
 
-    out_path = (
-        ORIGINAL_ROOT
-        / "text_option"
-        / f"pos{target_pos}"
-        / f"incorrect_options_{num_incorrect_options}.jsonl"
+    all_positions = sorted(
+        set(range(max(len(sample["texts"]) for sample in data)))
+        if target_positions is None
+        else set(target_positions)
+    )
+    writers = {}
+    done = {}
+    for pos in all_positions:
+        out_path = get_output_path(pos, num_incorrect_options)
+        writers[pos] = JsonlWriter(out_path)
+        # resume: story_ids already in the output of a position are skipped
+        done[pos] = load_done_keys(out_path)
+    queue = []
+    num_stories = 0
+    for sample in data:
+        positions = [
+            pos
+            for pos in all_positions
+            if pos < len(sample["texts"]) and str(sample["story_id"]) not in done[pos]
+        ]
+        if positions:
+            num_stories += 1
+            queue.extend((sample, group) for group in group_positions(positions))
+    print(
+        f"positions {all_positions}: {len(queue)} requests for {num_stories} "
+        f"stories ({sum(len(positions) for _, positions in queue)} story positions)"
     )
-    f_out = out_path.open("a", encoding="utf-8")
 
-    for sample in tqdm(data[:10]):
-        messages = tp.convert_to_build_incorrect_option_template(
-            sample=sample,
-            num_incorrect_options=num_incorrect_options,
-            target_pos=target_pos,
-        )
+    limiter = AdaptiveRateLimiter(
+        requests_per_minute=float(REQUESTS_PER_MINUTE) if REQUESTS_PER_MINUTE else None
+    )
+    num_written = 0
+    num_errors = 0
+    unparsed: list[tuple[dict, list[int], str | None]] = []
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as executor:
+        for retry_round in range(PARSE_RETRIES + 1):
+            if not queue:
+                break
+            temperature = 0 if retry_round == 0 else RETRY_TEMPERATURE
+            futures = {
+                executor.submit(
+                    generate_incorrect_options,
+                    sample,
+                    num_incorrect_options,
+                    positions,
+                    limiter,
+                    temperature,
+                ): (sample, positions)
+                for sample, positions in queue
+            }
+            unparsed = []
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                sample, positions = futures[future]
+                try:
+                    options_by_pos = future.result()
+                except OptionParseError as e:
+                    unparsed.append((sample, positions, e.generated))
+                    continue
+                except Exception as e:
+                    print(f"[error] story_id {sample['story_id']} failed: {e}")
+                    num_errors += 1
+                    continue
+                for pos, incorrect_options in options_by_pos.items():
+                    writers[pos].write(
+                        {
+                            "story_id": sample["story_id"],
+                            "image_ids": sample["image_ids"],
+                            "texts": sample["texts"],
+                            "target_pos": pos,
+                            "num_incorrect_options": num_incorrect_options,
+                            "incorrect_options": incorrect_options,
+                        }
+                    )
+                    num_written += 1
+            queue = [(sample, positions) for sample, positions, _ in unparsed]
+            if queue:
+                print(f"{len(queue)} replies could not be parsed (round {retry_round})")
+    for writer in writers.values():
+        writer.close()
+    client.close()
 
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0,
-            max_tokens=512,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        )
-        generated = response.choices[0].message.content
-        generated = generated.split("json")[1] if "json" in generated else generated
-        generated = generated.split("```")[0] if "```" in generated else generated
-        generated = generated.strip()
-
-        record = {
-            "story_id": sample["story_id"],
-            "image_ids": sample["image_ids"],
-            "texts": sample["texts"],
-            "target_pos": target_pos,
-            "num_incorrect_options": num_incorrect_options,
-            "incorrect_options": json.loads(generated),
-        }
-        f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-        print("sleeping 20 seconds to avoid rate limits...")
-        sleep(20)
-
-    f_out.close()
+    if unparsed:
+        # kept for inspection; these story_ids are retried by the next run
+        failed_path = get_output_path(all_positions[0], num_incorrect_options)
+        failed_path = failed_path.with_name(f"{failed_path.stem}.unparsed.jsonl")
+        failed_writer = JsonlWriter(failed_path)
+        for sample, positions, generated in unparsed:
+            failed_writer.write(
+                {
+                    "story_id": sample["story_id"],
+                    "target_positions": positions,
+                    "generated": generated,
+                }
+            )
+        failed_writer.close()
+        print(f"{len(unparsed)} unparsed replies -> {failed_path}")
+
+    print(
+        f"wrote {num_written} records, "
+        f"{num_errors} request errors, {len(unparsed)} unparsed"
+    )
+    print(limiter.summary())
+    print(get_response_cache().summary())
+    print(ip.image_cache.summary())
 
 
 if __name__ == "__main__":
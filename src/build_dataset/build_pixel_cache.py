@@ -0,0 +1,64 @@
+import json
+import sys
+
+from src.utils.paths import CACHE_ROOT, ORIGINAL_ROOT
+from src.utils.pixel_cache import PATCH_FACTOR, PixelCache
+
+PIXEL_CACHE_DIR = CACHE_ROOT / "qwen_pixels"
+
+
+def get_referenced_image_ids(sample: dict) -> list[str]:
+    # seq2opt: images shown are the keys of "question"; other tasks list them
+    if sample.get("question") is not None:
+        return list(sample["question"].keys())
+    return list(sample.get("image_ids") or [])
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print(
+            "Usage: uv run -m src.build_dataset.build_pixel_cache "
+            "<dataset_jsonl> <max_vision_tokens_per_sample> [min_pixels]",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    dataset_path = ORIGINAL_ROOT / sys.argv[1]
+    max_vision_tokens_per_sample = int(sys.argv[2])
+    min_pixels = int(sys.argv[3]) if len(sys.argv) == 4 else 56 * 56
+
+    image_ids = []
+    max_images_per_sample = 1
+    with open(dataset_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            sample_image_ids = get_referenced_image_ids(json.loads(line))
+            image_ids.extend(sample_image_ids)
+            max_images_per_sample = max(max_images_per_sample, len(sample_image_ids))
+
+    # split the per-sample token budget evenly over the images of a sample
+    max_pixels = (
+        max_vision_tokens_per_sample * PATCH_FACTOR * PATCH_FACTOR
+    ) // max_images_per_sample
+    if max_pixels < min_pixels:
+        print(
+            f"Token budget too small: {max_pixels} pixels per image < min_pixels {min_pixels}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    print(
+        f"{len(image_ids)} image references, up to {max_images_per_sample} per sample, "
+        f"max_pixels per image {max_pixels}"
+    )
+
+    PixelCache.build(
+        image_ids=image_ids,
+        cache_dir=PIXEL_CACHE_DIR,
+        min_pixels=min_pixels,
+        max_pixels=max_pixels,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.utils.paths import ORIGINAL_ROOT
+
+
+def get_seq2opt_output_path(drop_pos: int) -> Path:
+    # drop_pos=2 is the seq2opt.jsonl read by the inference scripts
+    if drop_pos == 2:
+        return ORIGINAL_ROOT / "seq2opt.jsonl"
+    return ORIGINAL_ROOT / f"seq2opt_pos{drop_pos}.jsonl"
+
+
+def _sample_negatives(
+    rng: np.random.Generator,
+    pool_photo: np.ndarray,
+    pool_text: np.ndarray,
+    correct_photo: np.ndarray,
+    correct_text: np.ndarray,
+    num_negatives: int,
+    max_rounds: int = 100,
+) -> np.ndarray:
+    """
+    return: (num_stories, num_negatives) indices into the pool such that no
+    negative shares the photo or the text of the story's answer and the
+    negatives of a story have distinct photos
+    """
+    num_stories = len(correct_photo)
+    negatives = np.full((num_stories, num_negatives), -1, dtype=np.int64)
+    num_filled = np.zeros(num_stories, dtype=np.int64)
+    pending = np.arange(num_stories)
+
+    for _ in range(max_rounds):
+        if pending.size == 0:
+            return negatives
+        draws = rng.integers(0, len(pool_photo), size=(pending.size, num_negatives * 2))
+        # rejection against the answer, for all pending stories at once
+        accepted = (pool_photo[draws] != correct_photo[pending, None]) & (
+            pool_text[draws] != correct_text[pending, None]
+        )
+        for row, story in enumerate(pending.tolist()):
+            for candidate in draws[row][accepted[row]].tolist():
+                if num_filled[story] == num_negatives:
+                    break
+                chosen = negatives[story, : num_filled[story]]
+                if (pool_photo[chosen] == pool_photo[candidate]).any():
+                    continue
+                negatives[story, num_filled[story]] = candidate
+                num_filled[story] += 1
+        pending = np.flatnonzero(num_filled < num_negatives)
+
+    raise ValueError(
+        f"Could not draw {num_negatives} negatives for {pending.size} stories; "
+        "the candidate pool is too small"
+    )
+
+
+def build_seq2opt_data(
+    base_path: Path,
+    drop_positions: list[int],
+    n_options: int = 4,
+    seed: int = 42,
+) -> None:
+    """
+    base_path: sis_base.jsonl (captions already normalized)
+    For every drop_pos, writes get_seq2opt_output_path(drop_pos) with records
+    {"story_id", "question": {photo_id: text} without drop_pos,
+     "answer": {photo_id: text}, "option": {photo_id: text} (n_options),
+     "answer_idx", "drop_pos"}
+
+    Candidates are the distinct (photo_id, text) pairs that appear at some
+    position other than drop_pos, indexed once as integer arrays. Each
+    drop_pos draws from its own generator seeded with (seed, drop_pos), so its
+    output depends only on the seed, not on the other positions built with it.
+    """
+    start = time.perf_counter()
+
+    story_ids = []
+    photo_codes: dict[str, int] = {}
+    text_codes: dict[str, int] = {}
+    flat_story, flat_pos, flat_photo, flat_text = [], [], [], []
+    with open(base_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            story = len(story_ids)
+            story_ids.append(item["story_id"])
+            for pos, (photo, text) in enumerate(zip(item["image_ids"], item["texts"])):
+                flat_story.append(story)
+                flat_pos.append(pos)
+                flat_photo.append(photo_codes.setdefault(photo, len(photo_codes)))
+                flat_text.append(text_codes.setdefault(text, len(text_codes)))
+
+    photos = list(photo_codes)
+    texts = list(text_codes)
+    flat_story = np.asarray(flat_story, dtype=np.int64)
+    flat_pos = np.asarray(flat_pos, dtype=np.int64)
+    flat_photo = np.asarray(flat_photo, dtype=np.int64)
+    flat_text = np.asarray(flat_text, dtype=np.int64)
+
+    # distinct (photo, text) pairs and the set of positions each appears at
+    pair_keys = flat_photo * len(texts) + flat_text
+    unique_keys, pair_of_row = np.unique(pair_keys, return_inverse=True)
+    pair_photo = unique_keys // len(texts)
+    pair_text = unique_keys % len(texts)
+    pair_positions = np.zeros(len(unique_keys), dtype=np.int64)
+    np.bitwise_or.at(pair_positions, pair_of_row, np.left_shift(1, flat_pos))
+
+    story_start = np.searchsorted(flat_story, np.arange(len(story_ids)))
+    story_end = np.searchsorted(flat_story, np.arange(len(story_ids)), side="right")
+
+    for drop_pos in drop_positions:
+        rng = np.random.default_rng([seed, drop_pos])
+        pool = np.flatnonzero(pair_positions & ~(1 << drop_pos))
+        answer_rows = np.flatnonzero(flat_pos == drop_pos)
+        answer_stories = flat_story[answer_rows]
+
+        negatives = _sample_negatives(
+            rng,
+            pool_photo=pair_photo[pool],
+            pool_text=pair_text[pool],
+            correct_photo=flat_photo[answer_rows],
+            correct_text=flat_text[answer_rows],
+            num_negatives=n_options - 1,
+        )
+        # column 0 is the answer; permute the columns of every story at once
+        candidates = np.concatenate(
+            (pair_of_row[answer_rows, None], pool[negatives]), axis=1
+        )
+        order = rng.permuted(
+            np.tile(np.arange(n_options), (len(answer_rows), 1)), axis=1
+        )
+        options = np.take_along_axis(candidates, order, axis=1)
+        answer_idx = np.argmax(order == 0, axis=1)
+
+        output_path = get_seq2opt_output_path(drop_pos)
+        with open(output_path, "w", encoding="utf-8") as f_out:
+            for i, (story, answer_row) in enumerate(
+                zip(answer_stories.tolist(), answer_rows.tolist())
+            ):
+                rows = range(story_start[story], story_end[story])
+                record = {
+                    "story_id": story_ids[story],
+                    "question": {
+                        photos[flat_photo[r]]: texts[flat_text[r]]
+                        for r in rows
+                        if flat_pos[r] != drop_pos
+                    },
+                    "answer": {
+                        photos[flat_photo[answer_row]]: texts[flat_text[answer_row]]
+                    },
+                    "option": {
+                        photos[pair_photo[pair]]: texts[pair_text[pair]]
+                        for pair in options[i].tolist()
+                    },
+                    "answer_idx": int(answer_idx[i]),
+                    "drop_pos": drop_pos,
+                }
+                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(
+            f"drop_pos={drop_pos}: {len(answer_rows)} stories, pool {len(pool)} "
+            f"candidates -> {output_path}"
+        )
+
+    print(f"Built seq2opt data in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and not all(arg.isdigit() for arg in sys.argv[1:]):
+        print(
+            "Usage: uv run -m src.build_dataset.build_seq2opt_data "
+            "[n_options (default: 4)] [drop_pos ... (default: 2)]",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    n_options = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    drop_positions = [int(arg) for arg in sys.argv[2:]] or [2]
+    build_seq2opt_data(
+        base_path=ORIGINAL_ROOT / "sis_base.jsonl",
+        drop_positions=drop_positions,
+        n_options=n_options,
+    )
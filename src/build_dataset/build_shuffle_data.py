@@ -1,99 +1,193 @@
 import json
+import math
+import sys
+import time
+from collections.abc import Iterator
 from pathlib import Path
 
 import numpy as np
 
 from src.utils.paths import ORIGINAL_ROOT
 
-
-def build_shuffle_text_data(base_path: Path, output_path: Path) -> None:
-    data = []
-
+# stories read, shuffled and written at a time
+CHUNK_SIZE = 4096
+
+
+def draw_permutations(
+    rng: np.random.Generator,
+    num_rows: int,
+    length: int,
+    num_shuffles: int,
+    exclude_identity: bool = False,
+    unique: bool = False,
+    max_rounds: int = 100,
+) -> np.ndarray:
+    """
+    return: (num_rows, num_shuffles, length) permutations of range(length),
+    drawn in one batched call; rows violating exclude_identity/unique are
+    redrawn until none are left
+    """
+    num_candidates = math.factorial(length) - (1 if exclude_identity else 0)
+    if num_candidates < 1 or (unique and num_shuffles > num_candidates):
+        raise ValueError(
+            f"Cannot draw {num_shuffles} permutations of length {length} "
+            f"(exclude_identity={exclude_identity}, unique={unique})"
+        )
+
+    identity = np.arange(length)
+    perms = rng.permuted(np.tile(identity, (num_rows, num_shuffles, 1)), axis=2)
+    for _ in range(max_rounds):
+        bad = np.zeros((num_rows, num_shuffles), dtype=bool)
+        if exclude_identity:
+            bad |= (perms == identity).all(axis=2)
+        if unique and num_shuffles > 1:
+            # a permutation is bad if it equals an earlier one of the same row
+            same = (perms[:, :, None, :] == perms[:, None, :, :]).all(axis=3)
+            bad |= np.tril(same, k=-1).any(axis=2)
+        if not bad.any():
+            return perms
+        perms[bad] = rng.permuted(np.tile(identity, (int(bad.sum()), 1)), axis=1)
+    raise ValueError(f"Could not draw valid permutations in {max_rounds} rounds")
+
+
+def _read_chunks(base_path: Path, chunk_size: int) -> Iterator[list[dict]]:
+    chunk = []
     with open(base_path, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
-            item = json.loads(line)
-            texts = item.get("texts")
-
-            indices = np.arange(len(texts))
-            # index for shuffle
-            shuffled_indices = np.random.permutation(indices)
-
-            shuffled_texts = [texts[i] for i in shuffled_indices]
-
-            # Index for restoration
-            restore_indices = np.argsort(shuffled_indices)
-
-            # print("index before shuffle:", indices)
-            # print("index after shuffle:", shuffled_indices)
-            # print("index for restoration:", restore_indices)
-            # restored_texts = [shuffled_texts[i] for i in restore_indices]
-            # confirmation
-            # print(texts==restored_texts)
-
-            data.append(
-                {
-                    "story_id": item.get("story_id"),
-                    "image_ids": item.get("image_ids"),
-                    "texts": texts,
-                    "shuffled_texts": shuffled_texts,
-                    "answer": restore_indices.tolist(),
-                }
+            chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _draw_chunk(
+    rng: np.random.Generator,
+    items: list[dict],
+    num_shuffles: int,
+    exclude_identity: bool,
+    unique: bool,
+) -> list[np.ndarray]:
+    """
+    return: per item, (2 * num_shuffles, length) permutations; text ones are
+    [:num_shuffles], image ones [num_shuffles:]
+    """
+    lengths = np.asarray([len(item["texts"]) for item in items], dtype=np.int64)
+    perms_of_item: list[np.ndarray] = [None] * len(items)
+    for length in np.unique(lengths).tolist():
+        rows = np.flatnonzero(lengths == length)
+        # one (text, image) pair of rows per story; uniqueness is per task
+        perms = draw_permutations(
+            rng, 2 * len(rows), length, num_shuffles, exclude_identity, unique
+        ).reshape(len(rows), 2 * num_shuffles, length)
+        for row, i in enumerate(rows.tolist()):
+            perms_of_item[i] = perms[row]
+    return perms_of_item
+
+
+def build_shuffle_data(
+    base_path: Path,
+    text_output_path: Path,
+    image_output_path: Path,
+    num_shuffles: int = 1,
+    seed: int = 42,
+    exclude_identity: bool = False,
+    unique: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+) -> None:
+    """
+    base_path: sis_base.jsonl
+    Writes num_shuffles shuffled copies of every story for the text task
+    ({..., "shuffled_texts", "answer"}) and the image task
+    ({..., "shuffled_image_ids", "answer"}), where answer is the index for
+    restoration (argsort of the shuffle). With num_shuffles > 1 every record
+    also has "shuffle_idx".
+
+    The base data is read once, chunk_size stories at a time; the
+    permutations of a chunk are drawn per story length with one seeded
+    Generator call and its records are written before the next chunk is
+    read, so memory does not grow with the split. The output is reproducible
+    for a given seed and chunk_size.
+    """
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+
+    num_items = 0
+    with (
+        open(text_output_path, "w", encoding="utf-8") as f_text,
+        open(image_output_path, "w", encoding="utf-8") as f_image,
+    ):
+        for items in _read_chunks(base_path, chunk_size):
+            perms_of_item = _draw_chunk(
+                rng, items, num_shuffles, exclude_identity, unique
             )
-
-    with open(output_path, "w", encoding="utf-8") as f_out:
-        for item in data:
-            f_out.write(json.dumps(item, ensure_ascii=False) + "\n")
-
-
-def build_shuffle_image_data(base_path: Path, output_path: Path) -> None:
-    data = []
-    with open(base_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            item = json.loads(line)
-            image_ids = item.get("image_ids")
-
-            indices = np.arange(len(image_ids))
-            # index for shuffle
-            shuffled_indices = np.random.permutation(indices)
-
-            shuffled_image_ids = [image_ids[i] for i in shuffled_indices]
-
-            # Index for restoration
-            restore_indices = np.argsort(shuffled_indices)
-
-            # print("index before shuffle:", indices)
-            # print("index after shuffle:", shuffled_indices)
-            # print("index for restoration:", restore_indices)
-            # restored_image_ids = [shuffled_image_ids[i] for i in restore_indices]
-            # confirmation
-            # print(image_ids == restored_image_ids)
-
-            data.append(
-                {
-                    "story_id": item.get("story_id"),
-                    "image_ids": image_ids,
-                    "texts": item.get("texts"),
-                    "shuffled_image_ids": shuffled_image_ids,
-                    "answer": restore_indices.tolist(),
-                }
-            )
-
-    with open(output_path, "w", encoding="utf-8") as f_out:
-        for item in data:
-            f_out.write(json.dumps(item, ensure_ascii=False) + "\n")
+            for item, perms in zip(items, perms_of_item):
+                texts = item.get("texts")
+                image_ids = item.get("image_ids")
+                restore = np.argsort(perms, axis=-1).tolist()
+                perms = perms.tolist()
+                text_lines = []
+                image_lines = []
+                for k in range(num_shuffles):
+                    text_perm = perms[k]
+                    image_perm = perms[num_shuffles + k]
+                    text_record = {
+                        "story_id": item.get("story_id"),
+                        "image_ids": image_ids,
+                        "texts": texts,
+                        "shuffled_texts": [texts[i] for i in text_perm],
+                        "answer": restore[k],
+                    }
+                    image_record = {
+                        "story_id": item.get("story_id"),
+                        "image_ids": image_ids,
+                        "texts": texts,
+                        "shuffled_image_ids": [image_ids[i] for i in image_perm],
+                        "answer": restore[num_shuffles + k],
+                    }
+                    if num_shuffles > 1:
+                        text_record["shuffle_idx"] = k
+                        image_record["shuffle_idx"] = k
+                    text_lines.append(json.dumps(text_record, ensure_ascii=False))
+                    image_lines.append(json.dumps(image_record, ensure_ascii=False))
+                f_text.write("\n".join(text_lines) + "\n")
+                f_image.write("\n".join(image_lines) + "\n")
+            num_items += len(items)
+
+    print(
+        f"Wrote {num_items} stories x {num_shuffles} shuffles to "
+        f"{text_output_path} and {image_output_path} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        print(
+            "Usage: uv run -m src.build_dataset.build_shuffle_data "
+            "[num_shuffles (default: 1)] [seed (default: 42)]",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    num_shuffles = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 42
+
     base_path = ORIGINAL_ROOT / "sis_base.jsonl"
     text_output_path = ORIGINAL_ROOT / "shuffle" / "text_option" / "shuffle_data.jsonl"
     image_output_path = (
         ORIGINAL_ROOT / "shuffle" / "image_option" / "shuffle_data.jsonl"
     )
-    build_shuffle_text_data(base_path=base_path, output_path=text_output_path)
-    build_shuffle_image_data(base_path=base_path, output_path=image_output_path)
+    # with several shuffles per story, every shuffle is a distinct non-identity one
+    build_shuffle_data(
+        base_path=base_path,
+        text_output_path=text_output_path,
+        image_output_path=image_output_path,
+        num_shuffles=num_shuffles,
+        seed=seed,
+        exclude_identity=num_shuffles > 1,
+        unique=num_shuffles > 1,
+    )
@@ -1,4 +1,3 @@
-import json
 from dataclasses import dataclass
 from statistics import mean
 from typing import Any, Dict, List, Optional
@@ -6,8 +5,9 @@ from typing import Any, Dict, List, Optional
 from tqdm import tqdm
 
 from src.dataset import get_seq2opt_dataset
-from src.utils import convert_to_messages
-from utils.paths import ORIGINAL_ROOT, OUTPUT_ROOT
+from src.utils.paths import ORIGINAL_ROOT, OUTPUT_ROOT
+from src.utils.payload import RequestBody
+from src.utils.text_processor import SEQ2OPT_TEMPLATE
 
 MODEL = "gpt-4o"
 THRESHOLD_MB = 10.0  # 判定しきい値
@@ -22,11 +22,11 @@ class PayloadRecord:
     error: Optional[str] = None
 
 
-def calc_bytes(messages: List[Dict[str, Any]]) -> int:
-    # 実際の送信に近い形：UTF-8バイト数を計測
-    payload_obj = {"model": MODEL, "messages": messages}
-    payload_str = json.dumps(payload_obj, ensure_ascii=False, separators=(",", ":"))
-    return len(payload_str.encode("utf-8"))
+def calc_bytes(sample: Dict[str, Any]) -> int:
+    # 実際に送信されるUTF-8バイト数（画像はbase64のサイズ規則で計算し、シリアライズしない）
+    return RequestBody(
+        model=MODEL, template=SEQ2OPT_TEMPLATE, sample=sample
+    ).content_length
 
 
 def main():
@@ -44,8 +44,7 @@ def main():
     for data in tqdm(dataset, desc="calc payload"):
         story_id = data.get("story_id")
         try:
-            messages = convert_to_messages(data)
-            bytes_len = calc_bytes(messages)
+            bytes_len = calc_bytes(data)
             mb = bytes_len / (1024 * 1024)
             ok = True
             err = None
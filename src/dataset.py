@@ -1,196 +1,177 @@
+import hashlib
 import json
-import random
+from pathlib import Path
 
-import pandas as pd
+import numpy as np
 from torch.utils.data import Dataset
 
-from src.utils.paths import VIST_JSON_ROOT
-from src.utils.text_processor import TextProcessor as tp
-from src.utils.utils import load_json
-
-
-class Seq2optDataset(Dataset):
-    def __init__(self, jsonl_path):
-        self.data = []
-        # JSONL を１行ずつ読み込む
-        with open(jsonl_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                item = json.loads(line)
-                self.data.append(
-                    {
-                        "story_id": item.get("story_id"),
-                        "question": item.get("question"),
-                        "answer": item.get("answer"),
-                        "option": item.get("option"),
-                        "answer_idx": item.get("answer_idx"),
-                        "drop_pos": item.get("drop_pos"),
-                    }
-                )
+from src.build_dataset.build_base_data import build_base_data
+from src.build_dataset.build_seq2opt_data import build_seq2opt_data
+from src.utils.columnar import ColumnStore
+from src.utils.indexed_jsonl import IndexedJsonl, RowView
+from src.utils.paths import CACHE_ROOT, ORIGINAL_ROOT, VIST_JSON_ROOT
+from src.utils.utils import env
+
+
+class JsonlDataset(Dataset):
+    """
+    JSONL records with a fixed set of FIELDS (fields missing from a line are None).
+
+    backend (default: VISU_DATASET_BACKEND or "columnar"):
+      columnar: the whole file is held in a ColumnStore (see src/utils/columnar.py).
+                The parsed columns are cached under CACHE_ROOT and reused while
+                the file is unchanged (VISU_DATASET_CACHE=0 disables this).
+      indexed:  IndexedJsonl (see src/utils/indexed_jsonl.py); only the rows
+                that are accessed are parsed.
+    Slicing and find_story return lightweight RowViews.
+    """
+
+    FIELDS: dict[str, str] = {}
+
+    def __init__(self, jsonl_path, cache: bool | None = None, backend=None):
+        jsonl_path = Path(jsonl_path).resolve()
+        self.backend = backend or env(key="VISU_DATASET_BACKEND", default="columnar")
+        self._story_ids: np.ndarray | None = None
+
+        if self.backend == "indexed":
+            self.store = IndexedJsonl(jsonl_path)
+            return
+        if self.backend != "columnar":
+            raise ValueError(f"Unknown dataset backend: {self.backend}")
+
+        if cache is None:
+            cache = env(key="VISU_DATASET_CACHE", default="1") != "0"
+
+        stat = jsonl_path.stat()
+        signature = f"{jsonl_path}:{stat.st_size}:{stat.st_mtime_ns}"
+        cache_path = (
+            CACHE_ROOT
+            / "datasets"
+            / f"{hashlib.sha256(str(jsonl_path).encode('utf-8')).hexdigest()[:16]}.npz"
+        )
+
+        store = ColumnStore.load(cache_path, self.FIELDS, signature) if cache else None
+        if store is None:
+            store = ColumnStore.from_records(_iter_jsonl(jsonl_path), self.FIELDS)
+            if cache:
+                store.save(cache_path, signature)
+        self.store = store
 
     def __len__(self):
-        return len(self.data)
+        return len(self.store)
 
     def __getitem__(self, idx):
-        return self.data[idx]
+        if isinstance(idx, slice):
+            return RowView(self, np.arange(len(self))[idx])
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("dataset index out of range")
+        if self.backend == "indexed":
+            item = self.store[idx]
+            return {name: item.get(name) for name in self.FIELDS}
+        return self.store.record(idx)
+
+    def story_ids(self) -> np.ndarray:
+        """story_id of every row, as str"""
+        if self.backend == "indexed":
+            return self.store.story_ids()
+        if self._story_ids is None:
+            self._story_ids = np.asarray(
+                [str(self.store.get(i, "story_id")) for i in range(len(self))],
+                dtype=str,
+            )
+        return self._story_ids
+
+    def find_story(self, story_id) -> RowView:
+        """All rows with the given story_id."""
+        if self.backend == "indexed":
+            return RowView(self, self.store.find_story(story_id).indices)
+        rows = np.flatnonzero(self.story_ids() == str(story_id))
+        return RowView(self, rows)
+
+
+def _iter_jsonl(jsonl_path):
+    # JSONL を１行ずつ読み込む
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield json.loads(line)
+
+
+class Seq2optDataset(JsonlDataset):
+    FIELDS = {
+        "story_id": "id",
+        "question": "id_text_dict",
+        "answer": "id_text_dict",
+        "option": "id_text_dict",
+        "answer_idx": "int",
+        "drop_pos": "int",
+    }
 
 
 def get_seq2opt_dataset(jsonl_path):
     return Seq2optDataset(jsonl_path)
 
 
-def build_seq2opt_dataset(drop_pos: int = 2, n_options: int = 4):
-    sis_test = load_json(VIST_JSON_ROOT / "sis" / "test.story-in-sequence.json")
-    sis_test_annotations_df = pd.DataFrame(sis_test["annotations"])
-    sis_test_annotations_df = sis_test_annotations_df[0].apply(pd.Series)
-
-    sis_test_annotations_df["text"] = sis_test_annotations_df["text"].apply(
-        tp.convert_numbers_to_words
+def build_seq2opt_dataset(drop_pos: int = 2, n_options: int = 4, seed: int = 42):
+    base_path = ORIGINAL_ROOT / "sis_base.jsonl"
+    if not base_path.exists():
+        build_base_data(
+            sis_path=VIST_JSON_ROOT / "sis" / "test.story-in-sequence.json",
+            output_path=base_path,
+        )
+    build_seq2opt_data(
+        base_path=base_path,
+        drop_positions=[drop_pos],
+        n_options=n_options,
+        seed=seed,
     )
 
-    answer_dict = {}
-    modified_dict = {}
-
-    for story_id, group in sis_test_annotations_df.groupby("story_id"):
-        group = group.sort_values("worker_arranged_photo_order")
-        # 答え（order==drop_posのもの）
-        answer_row = group[group["worker_arranged_photo_order"] == drop_pos]
-        if not answer_row.empty:
-            ans_photo_id = answer_row.iloc[0]["photo_flickr_id"]
-            ans_text = answer_row.iloc[0]["text"]
-            answer_dict[story_id] = {ans_photo_id: ans_text}
-        # modified_dictにはdrop_posのものを入れない
-        photo_text_dict = {
-            row["photo_flickr_id"]: row["text"]
-            for _, row in group.iterrows()
-            if row["worker_arranged_photo_order"] != drop_pos
-        }
-        modified_dict[story_id] = photo_text_dict
-
-    options_dict = {}
-    answer_index_dict = {}
-
-    n_options = 4  # 選択肢数
-    seed = 42
-    random.seed(seed)  # 一度だけseedを設定
-
-    # 全storyのphoto_flickr_id-textペアを集める（重複除外）
-    all_photo_text = set()
-    for d in modified_dict.values():
-        all_photo_text.update(d.items())
-    all_photo_text = list(all_photo_text)
-
-    for story_id in answer_dict.keys():
-        correct_pair = list(answer_dict[story_id].items())[0]  # (photo_flickr_id, text)
-        # 不正解候補（正解と同じphoto_flickr_id/textは除外）
-        negatives = [
-            item
-            for item in all_photo_text
-            if item[0] != correct_pair[0] and item[1] != correct_pair[1]
-        ]
-        sampled_neg = random.sample(negatives, min(n_options - 1, len(negatives)))
-        # optionsリスト作成
-        options = [correct_pair] + sampled_neg
-        random.shuffle(options)
-        # photo_flickr_id: text の辞書に変換
-        options_dict[story_id] = {k: v for k, v in options}
-        # 正解の位置をstory_id: indexで記録
-        correct_index = [i for i, (k, _) in enumerate(options) if k == correct_pair[0]][
-            0
-        ]
-        answer_index_dict[story_id] = correct_index
-
-
-class Seq2OptDatasetWithGenIncorrect(Dataset):
-    def __init__(self, jsonl_path):
-        self.data = []
-
-        with open(jsonl_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                item = json.loads(line)
-                self.data.append(
-                    {
-                        "story_id": item.get("story_id"),
-                        "image_ids": item.get("image_ids"),
-                        "texts": item.get("texts"),
-                        "target_pos": item.get("target_pos"),
-                        "num_incorrect_options": item.get("num_incorrect_options"),
-                        "incorrect_options": item.get("incorrect_options"),
-                    }
-                )
-
-    def __len__(self):
-        return len(self.data)
 
-    def __getitem__(self, idx):
-        return self.data[idx]
+class Seq2OptDatasetWithGenIncorrect(JsonlDataset):
+    FIELDS = {
+        "story_id": "id",
+        "image_ids": "id_list",
+        "texts": "text_list",
+        "target_pos": "int",
+        "num_incorrect_options": "int",
+        "incorrect_options": "text_list",
+    }
 
 
 def get_seq2opt_dataset_with_gen_incorrect(jsonl_path):
     return Seq2OptDatasetWithGenIncorrect(jsonl_path)
 
 
-class ShuffledTextDataset(Dataset):
-    def __init__(self, jsonl_path):
-        self.data = []
-        # JSONL を１行ずつ読み込む
-        with open(jsonl_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                item = json.loads(line)
-                self.data.append(
-                    {
-                        "story_id": item.get("story_id"),
-                        "image_ids": item.get("image_ids"),
-                        "texts": item.get("texts"),
-                        "shuffled_texts": item.get("shuffled_texts"),
-                        "answer": item.get("answer"),
-                    }
-                )
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        return self.data[idx]
+class ShuffledTextDataset(JsonlDataset):
+    FIELDS = {
+        "story_id": "id",
+        "image_ids": "id_list",
+        "texts": "text_list",
+        "shuffled_texts": "text_list",
+        "answer": "int_list",
+        # only present when build_shuffle_data made several shuffles per story
+        "shuffle_idx": "int",
+    }
 
 
 def get_shuffled_text_dataset(jsonl_path):
     return ShuffledTextDataset(jsonl_path)
 
 
-class ShuffledImageDataset(Dataset):
-    def __init__(self, jsonl_path):
-        self.data = []
-        # JSONL を１行ずつ読み込む
-        with open(jsonl_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                item = json.loads(line)
-                self.data.append(
-                    {
-                        "story_id": item.get("story_id"),
-                        "image_ids": item.get("image_ids"),
-                        "texts": item.get("texts"),
-                        "shuffled_image_ids": item.get("shuffled_image_ids"),
-                        "answer": item.get("answer"),
-                    }
-                )
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        return self.data[idx]
+class ShuffledImageDataset(JsonlDataset):
+    FIELDS = {
+        "story_id": "id",
+        "image_ids": "id_list",
+        "texts": "text_list",
+        "shuffled_image_ids": "id_list",
+        "answer": "int_list",
+        # only present when build_shuffle_data made several shuffles per story
+        "shuffle_idx": "int",
+    }
 
 
 def get_shuffled_image_dataset(jsonl_path):
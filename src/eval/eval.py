@@ -1,4 +1,5 @@
 import json
+import math
 from pathlib import Path
 
 from src.utils.paths import OUTPUT_ROOT
@@ -13,6 +14,8 @@ def evaluate(jsonl_path: Path) -> None:
     correct_indices = []  # 正解した行番号
     none_pred_indices = []  # pred=None の行番号
     wrong_non_none_indices = []  # pred があり非Noneで誤った行番号
+    pred_probs = []  # スコアモード: 予測した選択肢の確率
+    answer_probs = []  # スコアモード: 正解の選択肢の確率
 
     with open(jsonl_path, "r", encoding="utf-8") as f:
         for idx, line in enumerate(f):
@@ -26,6 +29,11 @@ def evaluate(jsonl_path: Path) -> None:
 
             total += 1
 
+            option_probs = data.get("option_probs")
+            if option_probs is not None and answer_idx is not None:
+                pred_probs.append(max(option_probs))
+                answer_probs.append(option_probs[answer_idx])
+
             # pred が None の場合は必ず誤りとしてカウント
             if pred is None:
                 none_pred += 1
@@ -60,6 +68,13 @@ def evaluate(jsonl_path: Path) -> None:
     print(f"正解の行番号          : {correct_indices}")
     print(f"pred=None の行番号    : {none_pred_indices}")
     print(f"誤答(非None)の行番号   : {wrong_non_none_indices}")
+    if pred_probs:
+        log_loss = -sum(math.log(max(p, 1e-12)) for p in answer_probs) / len(
+            answer_probs
+        )
+        print(f"平均確信度           : {sum(pred_probs) / len(pred_probs):.4f}")
+        print(f"正解の平均確率        : {sum(answer_probs) / len(answer_probs):.4f}")
+        print(f"対数損失             : {log_loss:.4f}")
 
 
 if __name__ == "__main__":
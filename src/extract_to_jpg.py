@@ -5,21 +5,22 @@ from src.utils.paths import VIST_IMAGE_ROOT
 
 
 def main():
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         print(
-            "Usage: uv run -m src.utils.extract_to_jpg <tar_gz_file_name>",
+            "Usage: uv run -m src.extract_to_jpg <tar_gz_file_name> [num_workers]",
             file=sys.stderr,
         )
         sys.exit(1)
 
     tar_gz_file_name = sys.argv[1]
+    num_workers = int(sys.argv[2]) if len(sys.argv) == 3 else None
 
     tar_gz_path = VIST_IMAGE_ROOT / tar_gz_file_name
     extract_path = VIST_IMAGE_ROOT
 
-    ip.extract_tar_gz(tar_gz_path=tar_gz_path, extract_path=extract_path)
-
-    ip.convert_to_jpg(extract_path=extract_path)
+    ip.extract_tar_gz_to_jpg(
+        tar_gz_path=tar_gz_path, extract_path=extract_path, num_workers=num_workers
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1095 @@
+import time
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import httpx
+from tqdm import tqdm
+
+from src.inference.tasks import Task, make_score_record, option_probs_from_logprobs
+from src.utils.async_runner import RunStats, run
+from src.utils.batching import BatchTimer, LengthBucketSampler
+from src.utils.concurrency import JsonlWriter, load_done_keys, record_key
+from src.utils.payload import (
+    IMAGE_SENTINEL,
+    RequestBody,
+    apost_chat_completion,
+    get_message_content,
+    request_cache_key,
+)
+from src.utils.pipeline import PipelineStats
+from src.utils.prefix_cache import SharedPrefix, find_shared_prefix
+from src.utils.prompt_template import (
+    ImageRef,
+    PromptTemplate,
+    fill,
+    openai_to_qwen,
+    render_qwen,
+)
+from src.utils.response_cache import get_response_cache
+from src.utils.utils import env
+
+# output file names of the models used so far (see Backend.output_name)
+OUTPUT_NAMES = {
+    "gpt-4o": "gpt4o",
+    "gemini-2.5-pro": "gemini2-5pro",
+    "unsloth/Qwen2.5-VL-72B-Instruct-bnb-4bit": "qwen2-5-VL-72B",
+}
+
+
+class Backend:
+    """
+    Adapter of one model family. Samples already in the output are skipped,
+    responses go through the response cache and records are written with the
+    task's make_record; a backend only says how to ask its model.
+    """
+
+    name: str
+    default_model: str
+    # request params of the score mode (see run)
+    score_params: dict = {}
+
+    def __init__(self, model: str | None = None):
+        self.model = model or self.default_model
+
+    @property
+    def output_name(self) -> str:
+        return OUTPUT_NAMES.get(self.model, self.model.split("/")[-1])
+
+    def request_params(self, score: bool) -> dict:
+        return dict(self.score_params) if score else {}
+
+    def make_cache_key(
+        self, task: Task, sample: dict, score: bool = False
+    ) -> str | None:
+        """None: responses of this backend are not cached"""
+        return request_cache_key(
+            self.model, task.template, sample, **self.request_params(score)
+        )
+
+    def get_content(self, response: dict) -> str | None:
+        return get_message_content(response)
+
+    def get_option_probs(
+        self, response: dict, num_options: int
+    ) -> tuple[list[float], float] | None:
+        """(probabilities of the option indices, their total) of a score response"""
+        raise NotImplementedError
+
+    def make_record_fn(self, task: Task, score: bool) -> Callable[[dict, dict], dict]:
+        """
+        return: (sample, response json) -> output record; response None for a
+        sample whose request failed for good
+        """
+        if score:
+            return lambda sample, response: make_score_record(
+                task,
+                sample,
+                None
+                if response is None
+                else self.get_option_probs(response, task.num_options(sample)),
+            )
+        return lambda sample, response: task.make_record(
+            sample, None if response is None else self.get_content(response)
+        )
+
+    def run(
+        self,
+        task: Task,
+        samples: Iterable[dict],
+        writer: JsonlWriter,
+        log_payload=None,
+        score: bool = False,
+    ) -> RunStats:
+        """
+        score: instead of generating an answer, read the probabilities of the
+        option indices 0..n-1 as the next token (multiple-choice tasks)
+        """
+        raise NotImplementedError
+
+
+class ApiBackend(Backend):
+    """HTTP API run with the asyncio runner (concurrency, rate limits, retries)."""
+
+    api_key_env: str
+    # None: api_key_env has to be set
+    default_api_key: str | None = None
+    base_url_env: str
+    default_base_url: str
+
+    def __init__(self, model: str | None = None):
+        super().__init__(model)
+        self.api_key = env(
+            key=self.api_key_env, default=self.default_api_key, required=True
+        )
+        self.base_url = env(key=self.base_url_env, default=self.default_base_url)
+
+    def make_body(self, task: Task, sample: dict, score: bool = False) -> RequestBody:
+        raise NotImplementedError
+
+    async def post(
+        self, http_client: httpx.AsyncClient, body: RequestBody
+    ) -> httpx.Response:
+        """raises httpx.HTTPStatusError on 4xx/5xx"""
+        raise NotImplementedError
+
+    def get_top_logprobs(self, response: dict) -> list[dict[str, float]]:
+        """{token: logprob} of the top candidates of each generated token"""
+        raise NotImplementedError
+
+    def get_option_probs(self, response, num_options):
+        return option_probs_from_logprobs(self.get_top_logprobs(response), num_options)
+
+    def run(self, task, samples, writer, log_payload=None, score=False) -> RunStats:
+        return run(
+            samples,
+            make_body=lambda sample: self.make_body(task, sample, score),
+            make_record=self.make_record_fn(task, score),
+            make_cache_key=lambda sample: self.make_cache_key(task, sample, score),
+            writer=writer,
+            api_key=self.api_key,
+            base_url=self.base_url,
+            key=task.key,
+            log_payload=log_payload,
+            post=self.post,
+            get_content=lambda response: response,
+        )
+
+
+class OpenAIBackend(ApiBackend):
+    """OpenAI or any OpenAI-compatible chat completions endpoint."""
+
+    name = "openai"
+    default_model = "gpt-4o"
+    api_key_env = "OPENAI_API_KEY"
+    base_url_env = "OPENAI_BASE_URL"
+    default_base_url = "https://api.openai.com/v1"
+    # one token; the option indices are looked up in its top logprobs
+    score_params = {
+        "max_tokens": 1,
+        "temperature": 0,
+        "logprobs": True,
+        "top_logprobs": 20,
+    }
+
+    def make_body(self, task, sample, score=False) -> RequestBody:
+        return RequestBody(
+            model=self.model,
+            template=task.template,
+            sample=sample,
+            **self.request_params(score),
+        )
+
+    async def post(self, http_client, body) -> httpx.Response:
+        return await apost_chat_completion(
+            http_client, body, api_key=self.api_key, base_url=self.base_url
+        )
+
+    def get_top_logprobs(self, response):
+        logprobs = response["choices"][0].get("logprobs") or {}
+        return [
+            {top["token"]: top["logprob"] for top in step.get("top_logprobs") or []}
+            for step in logprobs.get("content") or []
+        ]
+
+
+# tokens billed per image of up to 384x384 px, or per 768x768 tile
+GEMINI_IMAGE_TOKENS = 258
+
+
+class GeminiRequestBody(RequestBody):
+    """generateContent request body; params go to generationConfig."""
+
+    def image_part(self) -> dict:
+        return {"inlineData": {"mimeType": "image/jpeg", "data": IMAGE_SENTINEL}}
+
+    def build(self, template: PromptTemplate, content: list) -> dict:
+        body: dict[str, Any] = {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [
+                        {"text": part["text"]} if "text" in part else part
+                        for part in content
+                    ],
+                }
+            ]
+        }
+        if template.system is not None:
+            body["systemInstruction"] = {"parts": [{"text": template.system}]}
+        if self.params:
+            body["generationConfig"] = self.params
+        return body
+
+    def estimate_tokens(self, completion_tokens: int = 256) -> int:
+        text_bytes = sum(len(chunk) for chunk in self.static_chunks)
+        completion_tokens = self.params.get("maxOutputTokens", completion_tokens)
+        return (
+            text_bytes // 4 + GEMINI_IMAGE_TOKENS * len(self.images) + completion_tokens
+        )
+
+
+class GeminiBackend(ApiBackend):
+    """Gemini through the native REST API (models/{model}:generateContent)."""
+
+    name = "gemini"
+    default_model = "gemini-2.5-pro"
+    api_key_env = "GEMINI_API_KEY"
+    base_url_env = "GEMINI_BASE_URL"
+    default_base_url = "https://generativelanguage.googleapis.com/v1beta"
+    # no maxOutputTokens: thinking models spend output tokens on thoughts
+    # first; the first answer token that ranks an option index is used
+    score_params = {"temperature": 0, "responseLogprobs": True, "logprobs": 20}
+
+    def make_body(self, task, sample, score=False) -> RequestBody:
+        return GeminiRequestBody(
+            model=self.model,
+            template=task.template,
+            sample=sample,
+            **self.request_params(score),
+        )
+
+    async def post(self, http_client, body) -> httpx.Response:
+        response = await http_client.post(
+            f"{self.base_url.rstrip('/')}/models/{self.model}:generateContent",
+            content=body.aiter_chunks(),
+            headers={
+                "x-goog-api-key": self.api_key,
+                "Content-Type": "application/json",
+                "Content-Length": str(body.content_length),
+            },
+        )
+        response.raise_for_status()
+        return response
+
+    def get_content(self, response: dict) -> str | None:
+        """None when no candidate was returned (e.g. a blocked prompt)"""
+        candidates = response.get("candidates") or []
+        if not candidates:
+            return None
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        texts = [p["text"] for p in parts if "text" in p and not p.get("thought")]
+        return "".join(texts) if texts else None
+
+    def get_top_logprobs(self, response):
+        candidates = response.get("candidates") or []
+        if not candidates:
+            return []
+        steps = (candidates[0].get("logprobsResult") or {}).get("topCandidates") or []
+        return [
+            {
+                top["token"]: top["logProbability"]
+                for top in step.get("candidates") or []
+            }
+            for step in steps
+        ]
+
+
+# local backends: samples per batch, DataLoader workers preparing the model
+# inputs, and padded prompt tokens per batch (default: from the free GPU memory)
+LOCAL_BATCH_SIZE = int(env(key="VISU_LOCAL_BATCH_SIZE", default="8"))
+LOCAL_NUM_WORKERS = int(env(key="VISU_LOCAL_NUM_WORKERS", default="2"))
+LOCAL_BATCH_TOKENS = env(key="VISU_LOCAL_BATCH_TOKENS")
+# batches generated but not yet written before the model waits for the writer
+LOCAL_PENDING_WRITES = 4
+# prefill the prompt prefix shared by all samples once per run ("0": off)
+PREFIX_CACHE = env(key="VISU_PREFIX_CACHE", default="1") != "0"
+# prompt tokens assumed per image when its size is not known (a VIST photo of
+# about 500x375 px is 18x13 Qwen2.5-VL tokens)
+IMAGE_TOKENS_ESTIMATE = 256
+
+
+def estimate_prompt_tokens(
+    template: PromptTemplate,
+    sample: dict,
+    count_image_tokens: Callable[[str], int] = lambda image_id: IMAGE_TOKENS_ESTIMATE,
+) -> tuple[int, int]:
+    """return: (number of images, estimated prompt tokens) without loading images"""
+    num_images = 0
+    num_tokens = len(template.system) // 4 + 1 if template.system is not None else 0
+    for part in fill(template, sample):
+        if isinstance(part, ImageRef):
+            num_images += 1
+            num_tokens += count_image_tokens(part.image_id)
+        else:
+            num_tokens += len(part["text"]) // 4 + 1
+    return num_images, num_tokens
+
+
+class _CollateWithSamples:
+    """
+    DataLoader collate_fn keeping the samples next to the model inputs, and
+    the seconds spent building them (in the worker)
+    """
+
+    def __init__(self, collate: Callable[[list[dict]], Any]):
+        self.collate = collate
+
+    def __call__(self, samples: list[dict]) -> tuple[list[dict], Any, float]:
+        start = time.perf_counter()
+        inputs = self.collate(samples)
+        return samples, inputs, time.perf_counter() - start
+
+
+class LocalBackend(Backend):
+    """
+    Model run in this process on length-bucketed batches (see
+    LengthBucketSampler). DataLoader workers build the model inputs of the
+    next batches while the current one is generated, and a writer thread
+    caches and writes the outputs of the previous ones. A batch that runs out
+    of memory is split in halves and the batch token budget is lowered.
+    Outputs are cached like API responses: {"choices": [...]} for
+    generations, {"option_probs", "option_mass"} for scores.
+    """
+
+    # set by prepare() when the prompts of the run share a prefix to cache
+    shared_prefix: SharedPrefix | None = None
+
+    def load(self) -> None:
+        """Load the model; called once before the first generation."""
+
+    def count_image_tokens(self, image_id: str) -> int:
+        return IMAGE_TOKENS_ESTIMATE
+
+    def initial_batch_tokens(self) -> int:
+        """padded prompt tokens per batch to start with (called after load)"""
+        return int(LOCAL_BATCH_TOKENS or 16384)
+
+    def make_collator(self, task: Task) -> Callable[[list[dict]], Any]:
+        """samples -> model inputs; runs in DataLoader workers, so it is picklable"""
+        raise NotImplementedError
+
+    def prepare(
+        self, task: Task, collate: Callable[[list[dict]], Any], samples: list[dict]
+    ) -> None:
+        """Called after load with the samples of the run (e.g. to set shared_prefix)."""
+
+    def make_message_collator(self) -> Callable[[list[list[dict]]], Any]:
+        """OpenAI chat messages of each request -> model inputs (for the server)"""
+        raise NotImplementedError
+
+    def generate(
+        self, task: Task | None, inputs: Any, max_new_tokens: int | None = None
+    ) -> list[str]:
+        """task: None for server requests"""
+        raise NotImplementedError
+
+    def score(
+        self, task: Task, inputs: Any, num_options: list[int]
+    ) -> list[tuple[list[float], float] | None]:
+        """
+        One forward pass: probabilities of the option index tokens 0..n-1 as
+        the next token, renormalized over the options, and their total (None
+        for a prompt whose options all have probability 0)
+        """
+        raise NotImplementedError
+
+    def top_logprobs(self, inputs: Any, k: int) -> list[list[tuple[str, float]]]:
+        """(token, logprob) of the k most probable next tokens of each prompt"""
+        raise NotImplementedError
+
+    def get_option_probs(self, response, num_options):
+        if response.get("option_probs") is None:
+            return None
+        return response["option_probs"], response["option_mass"]
+
+    def _respond(
+        self, task: Task, samples: list[dict], inputs: Any, score: bool
+    ) -> list[dict]:
+        """return: the responses of a batch in the cached format"""
+        if score:
+            scores = self.score(
+                task, inputs, [task.num_options(sample) for sample in samples]
+            )
+            return [
+                {
+                    "model": self.model,
+                    "option_probs": None if scored is None else scored[0],
+                    "option_mass": None if scored is None else scored[1],
+                }
+                for scored in scores
+            ]
+        return [
+            {"model": self.model, "choices": [{"message": {"content": text}}]}
+            for text in self.generate(task, inputs)
+        ]
+
+    def handle_out_of_memory(self, e: Exception) -> bool:
+        """True if e is an out of memory error (and the memory was released)"""
+        return False
+
+    def _respond_or_split(
+        self,
+        task: Task,
+        collate: Callable[[list[dict]], Any],
+        samples: list[dict],
+        inputs: Any,
+        sampler: LengthBucketSampler,
+        score: bool,
+    ) -> list[dict]:
+        try:
+            return self._respond(task, samples, inputs, score)
+        except Exception as e:
+            if len(samples) == 1 or not self.handle_out_of_memory(e):
+                raise
+        longest = max(
+            estimate_prompt_tokens(task.template, sample, self.count_image_tokens)[1]
+            for sample in samples
+        )
+        sampler.shrink(len(samples) * longest)
+        print(
+            f"Out of memory with {len(samples)} samples; "
+            f"batch token budget now {sampler.max_batch_tokens}"
+        )
+        half = len(samples) // 2
+        return [
+            response
+            for part in (samples[:half], samples[half:])
+            for response in self._respond_or_split(
+                task, collate, part, collate(part), sampler, score
+            )
+        ]
+
+    def run(self, task, samples, writer, log_payload=None, score=False) -> RunStats:
+        from torch.utils.data import DataLoader
+
+        response_cache = get_response_cache()
+        make_record = self.make_record_fn(task, score)
+        stats = RunStats()
+        done = load_done_keys(writer.jsonl_path, task.key)
+        start = time.perf_counter()
+        pending = []
+        for sample in samples:
+            if record_key(sample, task.key) in done:
+                stats.num_skipped += 1
+                continue
+            cache_key = self.make_cache_key(task, sample, score)
+            if cache_key is not None:
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    writer.write(make_record(sample, cached))
+                    stats.num_cached += 1
+                    continue
+            pending.append((sample, cache_key))
+
+        if pending:
+            self.load()
+            collate = self.make_collator(task)
+            self.prepare(task, collate, [sample for sample, _ in pending])
+            shapes = [
+                estimate_prompt_tokens(task.template, sample, self.count_image_tokens)
+                for sample, _ in pending
+            ]
+            sampler = LengthBucketSampler(
+                lengths=[num_tokens for _, num_tokens in shapes],
+                num_images=[num_images for num_images, _ in shapes],
+                max_batch_size=LOCAL_BATCH_SIZE,
+                max_batch_tokens=self.initial_batch_tokens(),
+            )
+            print(
+                f"{len(pending)} samples to {'score' if score else 'generate'}, "
+                "batches of up to "
+                f"{sampler.max_batch_size} samples / {sampler.max_batch_tokens} tokens"
+            )
+            loader = DataLoader(
+                [sample for sample, _ in pending],
+                batch_sampler=sampler,
+                collate_fn=_CollateWithSamples(collate),
+                num_workers=LOCAL_NUM_WORKERS,
+            )
+            # samples come back from the workers as copies
+            cache_keys = {
+                record_key(sample, task.key): cache_key for sample, cache_key in pending
+            }
+            pipeline = PipelineStats()
+            prepare_stage = pipeline.stage("prepare", max(1, LOCAL_NUM_WORKERS))
+            model_stage = pipeline.stage("model")
+            write_stage = pipeline.stage("write")
+
+            def write_batch(batch: list[dict], responses: list[dict]) -> None:
+                with write_stage.busy(len(batch)):
+                    for sample, response in zip(batch, responses):
+                        cache_key = cache_keys[record_key(sample, task.key)]
+                        if cache_key is not None:
+                            response_cache.put(cache_key, self.model, response)
+                    writer.write_many(
+                        [
+                            make_record(sample, response)
+                            for sample, response in zip(batch, responses)
+                        ]
+                    )
+                stats.num_done += len(batch)
+
+            timer = BatchTimer()
+            writes: deque[Future] = deque()
+            with (
+                tqdm(total=len(pending)) as progress,
+                ThreadPoolExecutor(max_workers=1) as write_pool,
+            ):
+                for batch, inputs, prepare_seconds in loader:
+                    prepare_stage.add(len(batch), prepare_seconds)
+                    batch_start = time.perf_counter()
+                    with model_stage.busy(len(batch)):
+                        responses = self._respond_or_split(
+                            task, collate, batch, inputs, sampler, score
+                        )
+                    timer.add(len(batch), time.perf_counter() - batch_start)
+                    sampler.grow()
+                    write_stage.observe(len(writes))
+                    writes.append(write_pool.submit(write_batch, batch, responses))
+                    # bounded: the outputs of at most a few batches wait in memory
+                    while len(writes) > LOCAL_PENDING_WRITES:
+                        writes.popleft().result()
+                    progress.update(len(batch))
+                for write in writes:
+                    write.result()
+            print(timer.summary())
+            print(pipeline.summary())
+            if self.shared_prefix is not None:
+                print(self.shared_prefix.summary())
+            if sampler.num_shrinks:
+                print(
+                    f"ran out of memory {sampler.num_shrinks} times, final batch "
+                    f"token budget {sampler.max_batch_tokens}"
+                )
+        stats.elapsed = time.perf_counter() - start
+        print(stats.summary())
+        print(response_cache.summary())
+        return stats
+
+
+class QwenCollator:
+    """Chat template, image loading and processor call of a Qwen2.5-VL batch."""
+
+    def __init__(self, processor, template: PromptTemplate, pixel_cache=None):
+        self.processor = processor
+        self.template = template
+        self.pixel_cache = pixel_cache
+
+    def render(self, sample: dict):
+        return render_qwen(self.template, sample, pixel_cache=self.pixel_cache)
+
+    def __call__(self, samples: list[dict]):
+        texts = []
+        images = []
+        for sample in samples:
+            message, sample_images = self.render(sample)
+            texts.append(
+                self.processor.apply_chat_template(message, add_generation_prompt=True)
+            )
+            images.extend(sample_images)
+        return self.processor(
+            images=images or None,
+            text=texts,
+            add_special_tokens=False,
+            padding=True,
+            return_tensors="pt",
+        )
+
+
+class QwenMessageCollator(QwenCollator):
+    """QwenCollator of server requests: OpenAI chat messages instead of samples."""
+
+    def __init__(self, processor):
+        super().__init__(processor, template=None)
+
+    def render(self, messages: list[dict]):
+        return openai_to_qwen(messages)
+
+
+class QwenBackend(LocalBackend):
+    """
+    Qwen2.5-VL with unsloth, fed from the pixel cache when it is built.
+
+    The chat template header and the instruction before the first image are
+    the same for every sample: their KV cache is computed once per run and
+    each batch prefills only the rest of its prompts on a copy of it
+    (VISU_PREFIX_CACHE=0 turns this off). Generation on the prefix is greedy.
+    """
+
+    name = "qwen"
+    default_model = "unsloth/Qwen2.5-VL-72B-Instruct-bnb-4bit"
+    max_new_tokens = 16
+    # only tells score responses apart in the response cache
+    score_params = {"mode": "score"}
+    # share of the free GPU memory given to the KV cache of a batch
+    kv_cache_memory_fraction = 0.5
+
+    def __init__(self, model: str | None = None):
+        from src.build_dataset.build_pixel_cache import PIXEL_CACHE_DIR
+        from src.utils.pixel_cache import INDEX_FILE_NAME, PixelCache
+
+        super().__init__(model)
+        # built by src.build_dataset.build_pixel_cache; images are decoded on
+        # the fly without it
+        self.pixel_cache = None
+        if (PIXEL_CACHE_DIR / INDEX_FILE_NAME).exists():
+            self.pixel_cache = PixelCache(PIXEL_CACHE_DIR)
+            print(
+                f"Using pixel cache {PIXEL_CACHE_DIR} ({len(self.pixel_cache)} images)"
+            )
+        # pre-resized and original images may give different outputs, and so
+        # do caches built with different pixel budgets
+        self.image_variant = (
+            f"qwen:pixel_cache:{self.pixel_cache.min_pixels}-"
+            f"{self.pixel_cache.max_pixels}"
+            if self.pixel_cache is not None
+            else "qwen:original"
+        )
+        self.model_obj = None
+        self.tokenizer = None
+        self.option_token_ids: list[int] = []
+        self.pad_token_id = 0
+        self.eos_token_ids: list[int] = []
+
+    def request_params(self, score):
+        return (
+            super().request_params(score)
+            if score
+            else {"max_new_tokens": self.max_new_tokens}
+        )
+
+    def make_cache_key(self, task, sample, score=False) -> str:
+        return request_cache_key(
+            self.model,
+            task.template,
+            sample,
+            image_variant=self.image_variant,
+            **self.request_params(score),
+        )
+
+    def load(self) -> None:
+        from unsloth import FastVisionModel
+
+        self.model_obj, self.tokenizer = FastVisionModel.from_pretrained(
+            self.model,
+            load_in_4bit=True,  # Use 4bit to reduce memory use. False for 16bit LoRA.
+            use_gradient_checkpointing="unsloth",  # True or "unsloth" for long context
+        )
+        FastVisionModel.for_inference(self.model_obj)
+        # batched generation appends after the prompt, so pad on the left
+        tokenizer = getattr(self.tokenizer, "tokenizer", self.tokenizer)
+        tokenizer.padding_side = "left"
+        # digits are single tokens
+        self.option_token_ids = [
+            tokenizer.convert_tokens_to_ids(str(i)) for i in range(10)
+        ]
+        self.pad_token_id = tokenizer.pad_token_id
+        eos_token_id = self.model_obj.generation_config.eos_token_id
+        self.eos_token_ids = (
+            list(eos_token_id) if isinstance(eos_token_id, list) else [eos_token_id]
+        )
+
+    def count_image_tokens(self, image_id: str) -> int:
+        if self.pixel_cache is not None and image_id in self.pixel_cache:
+            return self.pixel_cache.count_vision_tokens([image_id])
+        return IMAGE_TOKENS_ESTIMATE
+
+    def initial_batch_tokens(self) -> int:
+        """
+        VISU_LOCAL_BATCH_TOKENS, or as many tokens as the KV cache can hold in
+        kv_cache_memory_fraction of the free GPU memory
+        """
+        if LOCAL_BATCH_TOKENS:
+            return int(LOCAL_BATCH_TOKENS)
+        import torch
+
+        free_bytes, _ = torch.cuda.mem_get_info()
+        config = getattr(self.model_obj.config, "text_config", self.model_obj.config)
+        head_dim = config.hidden_size // config.num_attention_heads
+        # keys and values of every layer in 16 bit
+        kv_bytes_per_token = (
+            2 * config.num_hidden_layers * config.num_key_value_heads * head_dim * 2
+        )
+        return max(
+            1024, int(free_bytes * self.kv_cache_memory_fraction) // kv_bytes_per_token
+        )
+
+    def make_collator(self, task) -> QwenCollator:
+        return QwenCollator(self.tokenizer, task.template, self.pixel_cache)
+
+    def make_message_collator(self) -> QwenMessageCollator:
+        return QwenMessageCollator(self.tokenizer)
+
+    def prepare(self, task, collate, samples) -> None:
+        import torch
+
+        self.shared_prefix = None
+        if not PREFIX_CACHE or len(samples) < 2:
+            return
+        config = self.model_obj.config
+        inputs = collate([samples[0], samples[-1]])
+        prefix_ids = find_shared_prefix(
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            # image tokens have the same ids for different images
+            stop_token_ids=[config.vision_start_token_id, config.image_token_id],
+        )
+        if prefix_ids is None:
+            return
+        # text before the first image is at positions 0..P-1 on all three
+        # mrope axes
+        position_ids = torch.arange(len(prefix_ids), device="cuda").expand(3, 1, -1)
+        with torch.inference_mode():
+            output = self.model_obj(
+                input_ids=prefix_ids[None].to("cuda"),
+                position_ids=position_ids,
+                use_cache=True,
+                logits_to_keep=1,
+            )
+        self.shared_prefix = SharedPrefix(prefix_ids, output.past_key_values)
+        print(f"Prompts share a prefix of {len(prefix_ids)} tokens")
+
+    def _get_rope_index(self, input_ids, image_grid_thw, attention_mask):
+        # on the model or its inner model, depending on the transformers version
+        for module in (self.model_obj, getattr(self.model_obj, "model", None)):
+            if hasattr(module, "get_rope_index"):
+                return module.get_rope_index(
+                    input_ids=input_ids,
+                    image_grid_thw=image_grid_thw,
+                    attention_mask=attention_mask,
+                )
+        raise AttributeError(f"{self.model} has no get_rope_index")
+
+    def _prefill_on_prefix(self, inputs):
+        """
+        Prefill the prompts after the shared prefix on a copy of its cache.
+        return: (output, input_ids, attention_mask, position_ids) of the whole
+        prompts, or None if a prompt does not start with the prefix
+        """
+        import torch
+
+        prefix = self.shared_prefix
+        if prefix is None:
+            return None
+        split = prefix.split(
+            inputs["input_ids"], inputs["attention_mask"], self.pad_token_id
+        )
+        if split is None:
+            prefix.record(None, int(inputs["attention_mask"].sum()))
+            return None
+        suffix_ids, suffix_mask = split
+        batch_size, prefix_len = suffix_ids.shape[0], len(prefix)
+        # padding now sits between the prefix and the suffixes
+        input_ids = torch.cat([prefix.ids.expand(batch_size, -1), suffix_ids], dim=1)
+        attention_mask = torch.cat(
+            [suffix_mask.new_ones(batch_size, prefix_len), suffix_mask], dim=1
+        )
+        image_grid_thw = inputs.get("image_grid_thw")
+        position_ids, _ = self._get_rope_index(
+            input_ids, image_grid_thw, attention_mask
+        )
+        pixel_values = inputs.get("pixel_values")
+        output = self.model_obj(
+            input_ids=suffix_ids.to("cuda"),
+            attention_mask=attention_mask.to("cuda"),
+            position_ids=position_ids[:, :, prefix_len:].to("cuda"),
+            past_key_values=prefix.fork(batch_size),
+            cache_position=torch.arange(prefix_len, input_ids.shape[1], device="cuda"),
+            pixel_values=pixel_values.to("cuda") if pixel_values is not None else None,
+            image_grid_thw=(
+                image_grid_thw.to("cuda") if image_grid_thw is not None else None
+            ),
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        prefix.record(suffix_mask)
+        return output, input_ids, attention_mask, position_ids
+
+    def _decode_greedy(
+        self, output, input_ids, attention_mask, position_ids, max_new_tokens
+    ):
+        import torch
+
+        past_key_values = output.past_key_values
+        attention_mask = attention_mask.to("cuda")
+        eos_token_ids = torch.tensor(self.eos_token_ids, device="cuda")
+        # generated text continues from the last prompt position on all axes
+        next_position = position_ids[0, :, -1].to("cuda") + 1
+        finished = torch.zeros(len(input_ids), dtype=torch.bool, device="cuda")
+        new_tokens = []
+        for step in range(max_new_tokens):
+            token = output.logits[:, -1].argmax(dim=-1)
+            token = token.masked_fill(finished, self.pad_token_id)
+            new_tokens.append(token)
+            finished |= torch.isin(token, eos_token_ids)
+            if finished.all() or step == max_new_tokens - 1:
+                break
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones(len(token), 1)], dim=1
+            )
+            output = self.model_obj(
+                input_ids=token[:, None],
+                attention_mask=attention_mask,
+                position_ids=(next_position + step).expand(3, -1)[:, :, None],
+                past_key_values=past_key_values,
+                cache_position=torch.tensor(
+                    [attention_mask.shape[1] - 1], device="cuda"
+                ),
+                use_cache=True,
+            )
+            past_key_values = output.past_key_values
+        return torch.cat([input_ids.to("cuda"), torch.stack(new_tokens, dim=1)], dim=1)
+
+    def generate(self, task, inputs, max_new_tokens=None) -> list[str]:
+        import torch
+
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        with torch.inference_mode():
+            prefilled = self._prefill_on_prefix(inputs)
+            if prefilled is not None:
+                output = self._decode_greedy(*prefilled, max_new_tokens)
+            else:
+                output = self.model_obj.generate(
+                    **inputs.to("cuda"),
+                    max_new_tokens=max_new_tokens,
+                    use_cache=True,
+                )
+        responses = self.tokenizer.batch_decode(output, skip_special_tokens=True)
+        return [response.split("assistant")[-1] for response in responses]
+
+    def score(self, task, inputs, num_options):
+        import torch
+
+        with torch.inference_mode():
+            # left padded: the last position predicts the first answer token
+            prefilled = self._prefill_on_prefix(inputs)
+            if prefilled is not None:
+                logits = prefilled[0].logits
+            else:
+                logits = self.model_obj(**inputs.to("cuda"), logits_to_keep=1).logits
+        log_probs = torch.log_softmax(logits[:, -1, :].float(), dim=-1)
+        option_probs = log_probs[:, self.option_token_ids[: max(num_options)]].exp()
+        scores = []
+        for row, n in zip(option_probs.cpu().tolist(), num_options):
+            mass = sum(row[:n])
+            # every option token underflowed in float32: nothing to renormalize
+            scores.append(([p / mass for p in row[:n]], mass) if mass > 0 else None)
+        return scores
+
+    def top_logprobs(self, inputs, k):
+        import torch
+
+        with torch.inference_mode():
+            logits = self.model_obj(**inputs.to("cuda"), logits_to_keep=1).logits
+        log_probs = torch.log_softmax(logits[:, -1, :].float(), dim=-1)
+        values, token_ids = log_probs.topk(k, dim=-1)
+        tokenizer = getattr(self.tokenizer, "tokenizer", self.tokenizer)
+        return [
+            [
+                (tokenizer.decode([token_id]), value)
+                for token_id, value in zip(row_ids, row_values)
+            ]
+            for row_ids, row_values in zip(token_ids.tolist(), values.tolist())
+        ]
+
+    def handle_out_of_memory(self, e) -> bool:
+        import torch
+
+        if not isinstance(e, torch.cuda.OutOfMemoryError):
+            return False
+        torch.cuda.empty_cache()
+        return True
+
+
+class StubOutOfMemoryError(RuntimeError):
+    pass
+
+
+# stub tokens: text bytes, then one token per image and the padding
+STUB_IMAGE_TOKEN_ID = 256
+STUB_PAD_TOKEN_ID = 257
+
+
+class StubCache:
+    """Stands in for a model's KV cache in SharedPrefix.fork."""
+
+    def __init__(self):
+        self.batch_size = 1
+
+    def batch_repeat_interleave(self, repeats: int) -> None:
+        self.batch_size *= repeats
+
+
+class StubCollator:
+    """
+    Renders and loads the images like QwenCollator; returns the estimated
+    prompt lengths and left-padded stub token ids.
+    """
+
+    def __init__(self, template: PromptTemplate):
+        self.template = template
+
+    def render(self, sample: dict) -> tuple[list[int], int]:
+        """return: stub token ids, estimated prompt tokens"""
+        render_qwen(self.template, sample)
+        system = self.template.system or ""
+        token_ids = list(system.encode())
+        for part in fill(self.template, sample):
+            if isinstance(part, ImageRef):
+                token_ids.append(STUB_IMAGE_TOKEN_ID)
+            else:
+                token_ids.extend(part["text"].encode())
+        return token_ids, estimate_prompt_tokens(self.template, sample)[1]
+
+    def __call__(self, samples: list[dict]) -> dict:
+        import torch
+
+        lengths = []
+        rows = []
+        for sample in samples:
+            token_ids, length = self.render(sample)
+            rows.append(token_ids)
+            lengths.append(length)
+        width = max(len(row) for row in rows)
+        input_ids = torch.full((len(rows), width), STUB_PAD_TOKEN_ID)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        for i, row in enumerate(rows):
+            input_ids[i, width - len(row) :] = torch.tensor(row)
+            attention_mask[i, width - len(row) :] = 1
+        return {
+            "lengths": lengths,
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+        }
+
+
+class StubMessageCollator(StubCollator):
+    """StubCollator of server requests: OpenAI chat messages instead of samples."""
+
+    def __init__(self):
+        super().__init__(template=None)
+
+    def render(self, messages: list[dict]) -> tuple[list[int], int]:
+        messages, images = openai_to_qwen(messages)
+        token_ids = []
+        for message in messages:
+            parts = message["content"]
+            if isinstance(parts, str):
+                parts = [{"type": "text", "text": parts}]
+            for part in parts:
+                if part["type"] == "image":
+                    token_ids.append(STUB_IMAGE_TOKEN_ID)
+                else:
+                    token_ids.extend(part["text"].encode())
+        length = len(token_ids) // 4 + 1 + IMAGE_TOKENS_ESTIMATE * len(images)
+        return token_ids, length
+
+
+class StubBackend(LocalBackend):
+    """
+    Replies VISU_STUB_REPLY (default "0") to every sample without loading a
+    model, to try the task, batching, resume and output plumbing on a CPU.
+    Scores put all probability on option VISU_STUB_REPLY.
+    VISU_STUB_MEMORY_TOKENS simulates running out of memory on batches with
+    more padded tokens. The shared prompt prefix is split off and counted as
+    on a model (VISU_PREFIX_CACHE). Not cached.
+    """
+
+    name = "stub"
+    default_model = "stub"
+
+    def __init__(self, model: str | None = None):
+        super().__init__(model)
+        self.reply = env(key="VISU_STUB_REPLY", default="0")
+        memory_tokens = env(key="VISU_STUB_MEMORY_TOKENS")
+        self.memory_tokens = int(memory_tokens) if memory_tokens else None
+
+    def make_cache_key(self, task, sample, score=False) -> None:
+        return None
+
+    def make_collator(self, task) -> StubCollator:
+        return StubCollator(task.template)
+
+    def make_message_collator(self) -> StubMessageCollator:
+        return StubMessageCollator()
+
+    def prepare(self, task, collate, samples) -> None:
+        self.shared_prefix = None
+        if not PREFIX_CACHE or len(samples) < 2:
+            return
+        inputs = collate([samples[0], samples[-1]])
+        prefix_ids = find_shared_prefix(
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            stop_token_ids=[STUB_IMAGE_TOKEN_ID],
+        )
+        if prefix_ids is not None:
+            self.shared_prefix = SharedPrefix(prefix_ids, StubCache())
+
+    def _prefill(self, inputs: dict) -> None:
+        lengths = inputs["lengths"]
+        padded_tokens = len(lengths) * max(lengths)
+        if self.memory_tokens is not None and padded_tokens > self.memory_tokens:
+            raise StubOutOfMemoryError(f"{padded_tokens} padded tokens")
+        if self.shared_prefix is None:
+            return
+        split = self.shared_prefix.split(
+            inputs["input_ids"], inputs["attention_mask"], STUB_PAD_TOKEN_ID
+        )
+        if split is None:
+            self.shared_prefix.record(None, int(inputs["attention_mask"].sum()))
+            return
+        _, suffix_mask = split
+        self.shared_prefix.fork(len(suffix_mask))
+        self.shared_prefix.record(suffix_mask)
+
+    def generate(self, task, inputs, max_new_tokens=None) -> list[str]:
+        self._prefill(inputs)
+        return [self.reply for _ in inputs["lengths"]]
+
+    def score(self, task, inputs, num_options):
+        self._prefill(inputs)
+        return [
+            ([float(i == int(self.reply) % n) for i in range(n)], 1.0)
+            for n in num_options
+        ]
+
+    def top_logprobs(self, inputs, k):
+        self._prefill(inputs)
+        return [[(self.reply, 0.0)] for _ in inputs["lengths"]]
+
+    def handle_out_of_memory(self, e) -> bool:
+        return isinstance(e, StubOutOfMemoryError)
+
+
+class ServerBackend(OpenAIBackend):
+    """
+    A local model kept loaded by src.inference.server (start it first),
+    through its OpenAI-compatible endpoint. Images are sent encoded as for
+    the OpenAI API rather than from the pixel cache, so the outputs go to a
+    file of their own ({model}-server.jsonl).
+    """
+
+    name = "server"
+    default_model = QwenBackend.default_model
+    api_key_env = "VISU_SERVER_API_KEY"
+    # not checked by the server
+    default_api_key = "local"
+    base_url_env = "VISU_SERVER_URL"
+    default_base_url = "http://127.0.0.1:8765/v1"
+
+    @property
+    def output_name(self) -> str:
+        return f"{super().output_name}-server"
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (
+        OpenAIBackend,
+        GeminiBackend,
+        QwenBackend,
+        StubBackend,
+        ServerBackend,
+    )
+}
+
+
+def get_backend(spec: str) -> Backend:
+    """spec: "{backend}" or "{backend}:{model}", e.g. "openai:gpt-4o-mini" """
+    name, _, model = spec.partition(":")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r} (one of {', '.join(BACKENDS)})")
+    return BACKENDS[name](model or None)
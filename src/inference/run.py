@@ -0,0 +1,165 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from src.inference.backends import (
+    BACKENDS,
+    ApiBackend,
+    Backend,
+    OpenAIBackend,
+    get_backend,
+)
+from src.inference.tasks import TASKS, Task
+from src.utils.batch_api import run_step as run_batch_step
+from src.utils.concurrency import JsonlWriter
+from src.utils.image_processor import ImageProcessor as ip
+from src.utils.paths import OUTPUT_ROOT
+from src.utils.sharding import get_shard_spec, select_shard, shard_output_path
+from src.utils.utils import parse_range
+
+USAGE = (
+    "Usage: uv run -m src.inference.run <task> <backend>[:model] "
+    "[limit | start:stop] [score] [batch <prepare|submit|collect>]\n"
+    f"  task: {' | '.join(TASKS)}\n"
+    f"  backend: {' | '.join(BACKENDS)}\n"
+    "  e.g. uv run -m src.inference.run shuffled_text openai:gpt-4o 100\n"
+    "  score: read the option probabilities instead of generating "
+    "(multiple-choice tasks)\n"
+    "  batch: OpenAI Batch API steps (openai backend only)"
+)
+
+
+def get_output_path(task: Task, backend: Backend, score: bool = False) -> Path:
+    suffix = ".score.jsonl" if score else ".jsonl"
+    return OUTPUT_ROOT / task.output_dir / f"{backend.output_name}{suffix}"
+
+
+class PayloadLog:
+    """Tab separated request sizes, one line per request, next to the output."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open("w", encoding="utf-8") as f:
+                f.write("timestamp\tstory_id\tbytes\tmb\tsuccess\terror\n")
+
+    def append(
+        self,
+        story_id: Any,
+        bytes_len: int,
+        success: bool,
+        error: str | None = None,
+    ):
+        mb = bytes_len / (1024 * 1024)
+        ts = datetime.now().isoformat()
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(
+                f"{ts}\t{story_id}\t{bytes_len}\t{mb:.2f}\t{success}\t{(error or '-')}\n"
+            )
+
+    def append_max_success(self, story_id: Any, bytes_len: int):
+        with self.path.open("a", encoding="utf-8") as f:
+            if bytes_len > 0:
+                f.write(
+                    f"# MAX_SUCCESS\t{datetime.now().isoformat()}\t{story_id}\t"
+                    f"{bytes_len}\t{bytes_len / 1024 / 1024:.2f}MB\n"
+                )
+            else:
+                f.write(f"# MAX_SUCCESS\t{datetime.now().isoformat()}\t-\t0\t0.00MB\n")
+
+
+def run_task(
+    task_name: str,
+    backend_spec: str,
+    start: int = 0,
+    stop: int | None = None,
+    batch_step: str | None = None,
+    output_path: Path | None = None,
+    score: bool = False,
+):
+    """
+    Run a task on dataset[start:stop] (then the shard of SHARD_INDEX /
+    NUM_SHARDS) and append the records to output_path (default:
+    OUTPUT_ROOT/{task.output_dir}/{model}.jsonl, {model}.score.jsonl with
+    score). Re-running resumes.
+    """
+    task = TASKS[task_name]
+    if score and task.num_options is None:
+        raise ValueError(f"{task.name} has no options to score")
+    backend = get_backend(backend_spec)
+    shard_index, num_shards = get_shard_spec()
+
+    dataset = task.load_dataset(task.dataset_path)
+    dataset = select_shard(dataset[start:stop], shard_index, num_shards)
+    output_path = shard_output_path(
+        output_path or get_output_path(task, backend, score), shard_index, num_shards
+    )
+    print(
+        f"{task.name} {'scored' if score else 'generated'} with "
+        f"{backend.name}:{backend.model} -> {output_path}"
+    )
+
+    if batch_step is not None:
+        if not isinstance(backend, OpenAIBackend):
+            raise ValueError(f"Batch API is not supported by {backend.name}")
+        # Batch API: batch prepare -> batch submit -> batch collect
+        run_batch_step(
+            batch_step,
+            dataset,
+            make_body=lambda sample: backend.make_body(task, sample, score),
+            make_record=backend.make_record_fn(task, score),
+            make_cache_key=lambda sample: backend.make_cache_key(task, sample, score),
+            output_path=output_path,
+            api_key=backend.api_key,
+            base_url=backend.base_url,
+            key=task.key,
+            get_content=lambda response: response,
+        )
+        return
+
+    payload_log = None
+    if isinstance(backend, ApiBackend):
+        payload_log = PayloadLog(
+            shard_output_path(
+                output_path.with_name("payload_stats.txt"), shard_index, num_shards
+            )
+        )
+    writer = JsonlWriter(output_path)
+    stats = backend.run(
+        task,
+        dataset,
+        writer,
+        log_payload=payload_log.append if payload_log is not None else None,
+        score=score,
+    )
+    writer.close()
+
+    if payload_log is not None:
+        print(ip.image_cache.summary())
+        payload_log.append_max_success(
+            stats.max_success_story_id, stats.max_success_bytes
+        )
+
+
+def main(argv: list[str] | None = None):
+    argv = sys.argv[1:] if argv is None else argv
+    batch_step = None
+    if len(argv) >= 2 and argv[-2] == "batch":
+        batch_step = argv[-1]
+        argv = argv[:-2]
+    score = bool(argv) and argv[-1] == "score"
+    if score:
+        argv = argv[:-1]
+    if len(argv) not in (2, 3) or argv[0] not in TASKS:
+        print(USAGE, file=sys.stderr)
+        sys.exit(1)
+    start, stop = parse_range(argv[2]) if len(argv) == 3 else (0, None)
+    run_task(
+        argv[0], argv[1], start=start, stop=stop, batch_step=batch_step, score=score
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import sys
+
+from src.inference.run import main
+
+# kept for existing job scripts; same as
+#   uv run -m src.inference.run seq2opt gemini [batch <step>]
+if __name__ == "__main__":
+    main(["seq2opt", "gemini", *sys.argv[1:]])
@@ -0,0 +1,287 @@
+import json
+import queue
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from src.inference.backends import (
+    LOCAL_BATCH_SIZE,
+    LocalBackend,
+    ServerBackend,
+    get_backend,
+)
+from src.utils.batching import BatchTimer
+from src.utils.utils import env
+
+USAGE = (
+    "Usage: uv run -m src.inference.server [qwen | stub][:model]\n"
+    "  Loads the model once and serves POST /v1/chat/completions on "
+    "VISU_SERVER_URL\n"
+    f"  (default {ServerBackend.default_base_url}); run tasks against it with\n"
+    "  e.g. uv run -m src.inference.run seq2opt server 16: [score]"
+)
+
+# seconds the first request of a batch waits for more requests
+SERVER_BATCH_WAIT = float(env(key="VISU_SERVER_BATCH_WAIT", default="0.05"))
+
+
+@dataclass
+class ChatRequest:
+    """
+    top_logprobs: None to generate up to max_tokens tokens, else the number of
+    next-token candidates to return (logprobs requests; nothing is generated)
+    """
+
+    messages: list[dict]
+    max_tokens: int | None = None
+    top_logprobs: int | None = None
+    future: Future = field(default_factory=Future)
+
+
+class ModelWorker:
+    """
+    Owns the model. Takes requests from a bounded queue, batches the ones
+    waiting (up to max_batch_size, collected for at most batch_wait seconds),
+    and answers each batch with one model call. A batch that runs out of
+    memory is split in halves; if another error hits a batch, its requests
+    are retried one by one so a bad request only fails itself.
+    Requests left without an output fail rather than wait forever, and an
+    error escaping a batch fails its requests without stopping the worker.
+    """
+
+    def __init__(
+        self,
+        backend: LocalBackend,
+        max_batch_size: int = LOCAL_BATCH_SIZE,
+        batch_wait: float = SERVER_BATCH_WAIT,
+    ):
+        self.backend = backend
+        self.collate = backend.make_message_collator()
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        # HTTP threads block on put when the model falls behind
+        self.requests: queue.Queue[ChatRequest] = queue.Queue(
+            maxsize=4 * max_batch_size
+        )
+        self.timer = BatchTimer()
+
+    def submit(self, request: ChatRequest) -> Future:
+        self.requests.put(request)
+        return request.future
+
+    def _next_batch(self) -> list[ChatRequest]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _answer(self, requests: list[ChatRequest]) -> None:
+        """requests: with the same max_tokens and top_logprobs"""
+        max_tokens, top_logprobs = requests[0].max_tokens, requests[0].top_logprobs
+        try:
+            inputs = self.collate([request.messages for request in requests])
+            if top_logprobs is None:
+                outputs = self.backend.generate(None, inputs, max_tokens)
+            else:
+                outputs = self.backend.top_logprobs(inputs, top_logprobs)
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0].future.set_exception(e)
+                return
+            if self.backend.handle_out_of_memory(e):
+                half = len(requests) // 2
+                print(f"Out of memory with {len(requests)} requests; splitting")
+                self._answer(requests[:half])
+                self._answer(requests[half:])
+            else:
+                for request in requests:
+                    self._answer([request])
+            return
+        for request, output in zip(requests, outputs):
+            request.future.set_result(output)
+        for request in requests[len(outputs) :]:
+            request.future.set_exception(
+                RuntimeError(
+                    f"{len(outputs)} outputs for a batch of {len(requests)} requests"
+                )
+            )
+
+    def run(self) -> None:
+        while True:
+            groups: dict[tuple, list[ChatRequest]] = {}
+            for request in self._next_batch():
+                groups.setdefault(
+                    (request.max_tokens, request.top_logprobs), []
+                ).append(request)
+            for requests in groups.values():
+                start = time.perf_counter()
+                try:
+                    self._answer(requests)
+                except Exception as e:
+                    # e.g. from handle_out_of_memory; the worker keeps serving
+                    print(f"Batch failed: {type(e).__name__}: {e}", file=sys.stderr)
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                self.timer.add(len(requests), time.perf_counter() - start)
+
+
+def parse_request(body: dict) -> ChatRequest:
+    """OpenAI chat completion request -> ChatRequest; raises ValueError if invalid"""
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("messages must be a non-empty list")
+    max_tokens = body.get("max_completion_tokens", body.get("max_tokens"))
+    top_logprobs = None
+    if body.get("logprobs"):
+        # only the first token is scored
+        top_logprobs = max(1, int(body.get("top_logprobs") or 1))
+    return ChatRequest(
+        messages=messages,
+        max_tokens=int(max_tokens) if max_tokens else None,
+        top_logprobs=top_logprobs,
+    )
+
+
+def make_response(model: str, request: ChatRequest, output) -> dict:
+    """output: generated text, or [(token, logprob)] of a logprobs request"""
+    choice = {"index": 0, "finish_reason": "stop"}
+    if request.top_logprobs is None:
+        choice["message"] = {"role": "assistant", "content": output}
+    else:
+        token, logprob = output[0]
+        choice["message"] = {"role": "assistant", "content": token}
+        choice["logprobs"] = {
+            "content": [
+                {
+                    "token": token,
+                    "logprob": logprob,
+                    "top_logprobs": [
+                        {"token": token, "logprob": logprob}
+                        for token, logprob in output
+                    ],
+                }
+            ]
+        }
+        choice["finish_reason"] = "length"
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [choice],
+    }
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible POST /v1/chat/completions and GET /v1/models."""
+
+    server: "ModelServer"
+
+    def _send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str, error_type: str) -> None:
+        self._send_json(status, {"error": {"message": message, "type": error_type}})
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            self._send_error(404, f"Unknown path {self.path}", "invalid_request_error")
+            return
+        model = self.server.worker.backend.model
+        self._send_json(
+            200, {"object": "list", "data": [{"id": model, "object": "model"}]}
+        )
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_error(404, f"Unknown path {self.path}", "invalid_request_error")
+            return
+        model = self.server.worker.backend.model
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length))
+            if body.get("model", model) != model:
+                self._send_error(
+                    404,
+                    f"This server serves {model}, not {body['model']}",
+                    "model_not_found",
+                )
+                return
+            request = parse_request(body)
+        except (ValueError, TypeError) as e:
+            self._send_error(400, str(e), "invalid_request_error")
+            return
+        try:
+            output = self.server.worker.submit(request).result()
+        except ValueError as e:
+            # e.g. an image that is not a data URL
+            self._send_error(400, str(e), "invalid_request_error")
+            return
+        except Exception as e:
+            self._send_error(500, f"{type(e).__name__}: {e}", "server_error")
+            return
+        self._send_json(200, make_response(model, request, output))
+
+    def log_message(self, format, *args):
+        # one line per request would drown the batch log
+        pass
+
+
+class ModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], worker: ModelWorker):
+        super().__init__(address, ChatCompletionsHandler)
+        self.worker = worker
+
+
+def serve(backend_spec: str = "qwen") -> None:
+    backend = get_backend(backend_spec)
+    if not isinstance(backend, LocalBackend):
+        raise ValueError(f"{backend.name} is not a local model")
+    url = urlsplit(env(key="VISU_SERVER_URL", default=ServerBackend.default_base_url))
+    backend.load()
+    worker = ModelWorker(backend)
+    threading.Thread(target=worker.run, daemon=True).start()
+    server = ModelServer((url.hostname, url.port), worker)
+    print(
+        f"Serving {backend.model} on {url.scheme}://{url.hostname}:{url.port}/v1 "
+        f"(batches of up to {worker.max_batch_size} requests)"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(worker.timer.summary())
+
+
+def main(argv: list[str] | None = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 1:
+        print(USAGE, file=sys.stderr)
+        sys.exit(1)
+    serve(*argv)
+
+
+if __name__ == "__main__":
+    main()
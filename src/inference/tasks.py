@@ -0,0 +1,199 @@
+import math
+import re
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass
+from pathlib import Path
+
+from src.dataset import (
+    get_seq2opt_dataset,
+    get_seq2opt_dataset_with_gen_incorrect,
+    get_shuffled_image_dataset,
+    get_shuffled_text_dataset,
+)
+from src.utils.paths import ORIGINAL_ROOT
+from src.utils.prompt_template import PromptTemplate
+from src.utils.text_processor import (
+    INCORRECT_TEMPLATE,
+    SEQ2OPT_TEMPLATE,
+    SHUFFLED_IMAGE_TEMPLATE,
+    SHUFFLED_TEXT_TEMPLATE,
+)
+
+
+@dataclass(frozen=True)
+class Task:
+    """
+    template: prompt of one sample (rendered for each backend)
+    make_record: (sample, generated) -> output record
+    key: record fields identifying a sample (resume, merge_shards)
+    output_dir: under OUTPUT_ROOT; outputs are {output_dir}/{model}.jsonl
+    num_options: sample -> number of options of a multiple-choice task, answered
+         with an index 0..n-1 (None: the task cannot be scored)
+    """
+
+    name: str
+    template: PromptTemplate
+    dataset_path: Path
+    load_dataset: Callable[[Path], object]
+    make_record: Callable[[dict, str | None], dict]
+    key: str | tuple[str, ...] = "story_id"
+    output_dir: str = ""
+    num_options: Callable[[dict], int] | None = None
+
+
+def _first_number(generated: str | None) -> str | None:
+    m = re.search(r"\d+", generated) if generated is not None else None
+    return m.group() if m else None
+
+
+def make_seq2opt_record(data: dict, generated: str | None) -> dict:
+    return {
+        "story_id": data["story_id"],
+        "question": data["question"],
+        "answer": data["answer"],
+        "option": data["option"],
+        "answer_idx": data["answer_idx"],
+        "drop_pos": data["drop_pos"],
+        "generated": generated,
+        "pred": _first_number(generated),
+    }
+
+
+def make_incorrect_options_record(data: dict, generated: str | None) -> dict:
+    return {
+        "story_id": data["story_id"],
+        "image_ids": data["image_ids"],
+        "texts": data["texts"],
+        "target_pos": data["target_pos"],
+        "num_incorrect_options": data["num_incorrect_options"],
+        "incorrect_options": data["incorrect_options"],
+        "generated": generated,
+        "pred": _first_number(generated),
+    }
+
+
+def make_shuffled_text_record(data: dict, generated: str | None) -> dict:
+    record = {
+        "story_id": data["story_id"],
+        "image_ids": data["image_ids"],
+        "texts": data["texts"],
+        "shuffled_texts": data["shuffled_texts"],
+        "answer": data["answer"],
+        "generated": generated,
+    }
+    if data["shuffle_idx"] is not None:
+        record["shuffle_idx"] = data["shuffle_idx"]
+    return record
+
+
+def make_shuffled_image_record(data: dict, generated: str | None) -> dict:
+    # NOTE: the shuffled image ids are stored as "shuffled_texts", as before
+    record = {
+        "story_id": data["story_id"],
+        "image_ids": data["image_ids"],
+        "texts": data["texts"],
+        "shuffled_texts": data["shuffled_image_ids"],
+        "answer": data["answer"],
+        "generated": generated,
+    }
+    if data["shuffle_idx"] is not None:
+        record["shuffle_idx"] = data["shuffle_idx"]
+    return record
+
+
+def option_probs_from_logprobs(
+    steps: Sequence[dict[str, float]], num_options: int
+) -> tuple[list[float], float] | None:
+    """
+    steps: top logprobs {token: logprob} of each generated token
+    return: (probabilities of the option indices renormalized over the
+    options, their total probability) at the first step that ranks any option
+    index, or None
+    """
+    for top_logprobs in steps:
+        probs = [0.0] * num_options
+        for token, logprob in top_logprobs.items():
+            token = token.strip()
+            if token.isdigit() and int(token) < num_options:
+                probs[int(token)] += math.exp(logprob)
+        mass = sum(probs)
+        if mass > 0:
+            return [p / mass for p in probs], mass
+    return None
+
+
+def make_score_record(
+    task: Task, sample: dict, scored: tuple[list[float], float] | None
+) -> dict:
+    """
+    Record of the score mode: the task's record for the most probable option,
+    plus option_probs (per option index) and option_mass (probability of all
+    option tokens before renormalizing; low values mean the model wanted to
+    answer something else).
+    """
+    if scored is None:
+        record = task.make_record(sample, None)
+        record["option_probs"] = None
+        record["option_mass"] = None
+        return record
+    probs, mass = scored
+    record = task.make_record(
+        sample, str(max(range(len(probs)), key=probs.__getitem__))
+    )
+    record["option_probs"] = probs
+    record["option_mass"] = mass
+    return record
+
+
+TASKS = {
+    task.name: task
+    for task in (
+        Task(
+            name="seq2opt",
+            template=SEQ2OPT_TEMPLATE,
+            dataset_path=ORIGINAL_ROOT / "seq2opt.jsonl",
+            load_dataset=get_seq2opt_dataset,
+            make_record=make_seq2opt_record,
+            num_options=lambda sample: len(sample["option"]),
+        ),
+        # answer with the generated incorrect options (built by
+        # src.build_dataset.build_incorrect_options 3 2)
+        Task(
+            name="incorrect_options",
+            template=INCORRECT_TEMPLATE,
+            dataset_path=ORIGINAL_ROOT
+            / "text_option"
+            / "pos2"
+            / "incorrect_options_3.jsonl",
+            load_dataset=get_seq2opt_dataset_with_gen_incorrect,
+            make_record=make_incorrect_options_record,
+            output_dir="incorrect_options",
+            # the generated incorrect options, then the correct caption
+            num_options=lambda sample: len(sample["incorrect_options"]) + 1,
+        ),
+        Task(
+            name="shuffled_text",
+            template=SHUFFLED_TEXT_TEMPLATE,
+            dataset_path=ORIGINAL_ROOT
+            / "shuffle"
+            / "text_option"
+            / "shuffle_data.jsonl",
+            load_dataset=get_shuffled_text_dataset,
+            make_record=make_shuffled_text_record,
+            key=("story_id", "shuffle_idx"),
+            output_dir="shuffled_text",
+        ),
+        Task(
+            name="shuffled_image",
+            template=SHUFFLED_IMAGE_TEMPLATE,
+            dataset_path=ORIGINAL_ROOT
+            / "shuffle"
+            / "image_option"
+            / "shuffle_data.jsonl",
+            load_dataset=get_shuffled_image_dataset,
+            make_record=make_shuffled_image_record,
+            key=("story_id", "shuffle_idx"),
+            output_dir="shuffled_image",
+        ),
+    )
+}
@@ -0,0 +1,54 @@
+import sys
+
+from src.utils.concurrency import record_key
+from src.utils.indexed_jsonl import IndexedJsonl
+from src.utils.paths import ORIGINAL_ROOT, OUTPUT_ROOT
+from src.utils.sharding import merge_shards
+from src.utils.utils import parse_range
+
+
+def main():
+    argv = sys.argv[1:]
+    overwrite = "--overwrite" in argv
+    if overwrite:
+        argv.remove("--overwrite")
+    if len(argv) not in (3, 4):
+        print(
+            "Usage: uv run -m src.merge_shards <output_jsonl> <num_shards> "
+            "<dataset_jsonl> [limit | start:stop] [--overwrite]\n"
+            "  e.g. uv run -m src.merge_shards shuffled_text/gpt4o.jsonl 8 "
+            "shuffle/text_option/shuffle_data.jsonl 100\n"
+            "  --overwrite: replace an output_jsonl that is not an earlier merge",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    output_path = OUTPUT_ROOT / argv[0]
+    num_shards = int(argv[1])
+    dataset = IndexedJsonl(ORIGINAL_ROOT / argv[2])
+    # same as the dataset[start:stop] slice of the inference run, e.g. "16:"
+    # for src.inference.seq2opt.qwen2-5-VL
+    start, stop = parse_range(argv[3]) if len(argv) == 4 else (0, None)
+
+    # shuffle data may hold several shuffles per story (shuffle_idx)
+    key_fields = ("story_id", "shuffle_idx")
+    expected_keys = [record_key(row, key_fields) for row in dataset[start:stop]]
+    try:
+        missing = merge_shards(
+            output_path,
+            num_shards,
+            expected_keys,
+            key_fields=key_fields,
+            overwrite=overwrite,
+        )
+    except FileExistsError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if missing:
+        print(
+            f"missing (story_id, shuffle_idx): {missing[:20]}{' ...' if len(missing) > 20 else ''}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import sys
+
+from src.utils.image_shards import pack_image_shards
+from src.utils.paths import VIST_IMAGE_ROOT
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print(
+            "Usage: uv run -m src.pack_image_shards <split> [shard_size_mb]",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    split = sys.argv[1]
+    shard_size_mb = int(sys.argv[2]) if len(sys.argv) == 3 else 1024
+
+    image_dir = VIST_IMAGE_ROOT / split
+    shard_dir = VIST_IMAGE_ROOT / f"{split}_shards"
+
+    pack_image_shards(
+        image_dir=image_dir,
+        shard_dir=shard_dir,
+        shard_size_bytes=shard_size_mb * 1024 * 1024,
+    )
+
+
+if __name__ == "__main__":
+    main()
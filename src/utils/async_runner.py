@@ -0,0 +1,431 @@
+import asyncio
+import time
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass, field
+from typing import Any
+
+import httpx
+
+from src.utils.concurrency import (
+    JsonlWriter,
+    get_reset_pause,
+    load_done_keys,
+    record_key,
+    retry_delay,
+)
+from src.utils.payload import (
+    RequestBody,
+    apost_chat_completion,
+    get_message_content,
+    get_total_tokens,
+)
+from src.utils.pipeline import PipelineStats, StageStats
+from src.utils.response_cache import get_response_cache
+from src.utils.utils import env
+
+# requests in flight at once
+MAX_IN_FLIGHT = int(env(key="VISU_MAX_IN_FLIGHT", default="8"))
+# client-side limits (unset: only the provider's rate limit headers are honored)
+REQUESTS_PER_MINUTE = env(key="VISU_REQUESTS_PER_MINUTE")
+TOKENS_PER_MINUTE = env(key="VISU_TOKENS_PER_MINUTE")
+MAX_RETRIES = int(env(key="VISU_MAX_RETRIES", default="6"))
+# threads encoding request bodies (images) ahead of the requests
+PREPARE_WORKERS = int(env(key="VISU_PREPARE_WORKERS", default="4"))
+# records written with one write at most
+WRITE_BATCH_SIZE = 64
+
+
+class TokenBucket:
+    """
+    rate_per_minute units refill continuously up to capacity (by default 10
+    seconds worth). reserve() takes the units right away and returns how long
+    the caller has to wait for them, so waiters are served in order.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1.0, rate_per_minute / 6.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """amount > 0 takes more units (e.g. actual usage above the estimate)"""
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class AsyncRateLimiter:
+    """
+    Request and token buckets (RPM/TPM) shared by the workers of one event
+    loop, plus a run-wide pause set from 429 responses and from the
+    provider's x-ratelimit-* headers.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        min_remaining_requests: int = 1,
+        min_remaining_tokens: int = 8192,
+    ):
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.min_remaining_requests = min_remaining_requests
+        self.min_remaining_tokens = min_remaining_tokens
+        self._paused_until = 0.0
+
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.total_wait = 0.0
+
+    async def acquire(self, estimated_tokens: int) -> None:
+        start = time.monotonic()
+        while (pause := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.num_requests += 1
+        self.total_wait += time.monotonic() - start
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def throttle(self, seconds: float) -> None:
+        self.num_throttled += 1
+        self.pause(seconds)
+
+    def update(self, headers: httpx.Headers) -> None:
+        seconds = get_reset_pause(
+            headers, self.min_remaining_requests, self.min_remaining_tokens
+        )
+        if seconds:
+            self.pause(seconds)
+
+    def report_usage(self, estimated_tokens: int, response: httpx.Response) -> None:
+        """Correct the token bucket with the usage reported by the response."""
+        if self.tokens is None:
+            return
+        try:
+            used = get_total_tokens(response.json())
+        except ValueError:
+            return
+        if used is not None:
+            self.tokens.adjust(used - estimated_tokens)
+
+    def summary(self) -> str:
+        return (
+            f"rate limiter: {self.num_requests} requests, "
+            f"{self.num_throttled} throttled (429), "
+            f"waited {self.total_wait:.1f}s in total"
+        )
+
+
+@dataclass
+class RunStats:
+    num_done: int = 0
+    num_skipped: int = 0
+    num_cached: int = 0
+    num_failed: int = 0
+    # failed for good and written without an output
+    num_rejected: int = 0
+    failed_keys: list = field(default_factory=list)
+    max_success_bytes: int = 0
+    max_success_story_id: Any = None
+    elapsed: float = 0.0
+
+    def summary(self) -> str:
+        rate = self.num_done / self.elapsed if self.elapsed > 0 else 0.0
+        return (
+            f"done {self.num_done} ({rate * 60:.1f}/min), "
+            f"skipped {self.num_skipped} already in the output, "
+            f"{self.num_cached} from the response cache, "
+            f"rejected {self.num_rejected} (written without output), "
+            f"failed {self.num_failed} in {self.elapsed:.1f}s"
+        )
+
+
+def is_retryable(e: Exception) -> bool:
+    """429, 5xx and transport errors may pass on a later run"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+async def _send(
+    http_client: httpx.AsyncClient,
+    body: RequestBody,
+    limiter: AsyncRateLimiter,
+    post: Callable[[httpx.AsyncClient, RequestBody], Awaitable[httpx.Response]],
+    max_retries: int,
+) -> httpx.Response:
+    estimated_tokens = body.estimate_tokens()
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(estimated_tokens)
+        try:
+            response = await post(http_client, body)
+        except httpx.HTTPStatusError as e:
+            limiter.update(e.response.headers)
+            status = e.response.status_code
+            if attempt == max_retries or not (status == 429 or status >= 500):
+                raise
+            delay = retry_delay(e.response, attempt)
+            if status == 429:
+                limiter.throttle(delay)
+            else:
+                await asyncio.sleep(delay)
+            continue
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(retry_delay(None, attempt))
+            continue
+        limiter.update(response.headers)
+        limiter.report_usage(estimated_tokens, response)
+        return response
+    raise AssertionError("unreachable")
+
+
+async def run_chat_completions(
+    samples: Iterable[dict],
+    make_body: Callable[[dict], RequestBody],
+    make_record: Callable[[dict, str | None], dict],
+    writer: JsonlWriter,
+    api_key: str,
+    base_url: str = "https://api.openai.com/v1",
+    key: str | tuple[str, ...] = "story_id",
+    max_in_flight: int = MAX_IN_FLIGHT,
+    requests_per_minute: float | None = None,
+    tokens_per_minute: float | None = None,
+    max_retries: int = MAX_RETRIES,
+    log_payload: Callable[[Any, int, bool, str | None], None] | None = None,
+    make_cache_key: Callable[[dict], str] | None = None,
+    post: Callable[[httpx.AsyncClient, RequestBody], Awaitable[httpx.Response]]
+    | None = None,
+    get_content: Callable[[dict], Any] = get_message_content,
+    prepare_workers: int = PREPARE_WORKERS,
+) -> RunStats:
+    """
+    Send one chat completion per sample with max_in_flight workers.
+
+    Samples flow through stages connected by bounded queues: read (skip the
+    samples already in the output) -> prepare (prepare_workers threads: cache
+    lookup, make_body) -> send (max_in_flight requests) -> write. A slow stage
+    holds back the ones before it, so only a few encoded bodies wait at any
+    time; the busy time of each stage is printed at the end.
+
+    make_body: sample -> RequestBody (run in a thread; it encodes images)
+    make_record: (sample, generated) -> output record; generated is None for
+         a sample that failed for good
+    key: record fields identifying a sample; samples whose key is already in
+         the writer's file are skipped, so an interrupted run can be resumed
+    log_payload: (story_id, bytes, success, error), called once per sample
+    make_cache_key: sample -> request_cache_key; samples found in the response
+         cache are answered from it without a request
+    post: (http_client, body) -> response, raising httpx.HTTPStatusError on
+         4xx/5xx (default: apost_chat_completion with api_key and base_url)
+    get_content: response json -> what make_record receives (default: the
+         generated text)
+
+    Records are written in the order requests complete. Samples that still
+    fail with a retryable error (429, 5xx, transport) after max_retries are
+    not written (they are retried by the next run) and are listed in
+    RunStats.failed_keys. Other errors (e.g. a 400 for the request) would
+    fail again, so those samples are written as make_record(sample, None).
+    """
+    requests_per_minute = requests_per_minute or (
+        float(REQUESTS_PER_MINUTE) if REQUESTS_PER_MINUTE else None
+    )
+    tokens_per_minute = tokens_per_minute or (
+        float(TOKENS_PER_MINUTE) if TOKENS_PER_MINUTE else None
+    )
+    limiter = AsyncRateLimiter(requests_per_minute, tokens_per_minute)
+    if post is None:
+
+        async def post(
+            http_client: httpx.AsyncClient, body: RequestBody
+        ) -> httpx.Response:
+            return await apost_chat_completion(
+                http_client, body, api_key=api_key, base_url=base_url
+            )
+
+    response_cache = get_response_cache()
+    stats = RunStats()
+    done = load_done_keys(writer.jsonl_path, key)
+    start = time.perf_counter()
+
+    pipeline = PipelineStats()
+    read_stage = pipeline.stage("read")
+    prepare_stage = pipeline.stage("prepare", prepare_workers)
+    send_stage = pipeline.stage("send", max_in_flight)
+    write_stage = pipeline.stage("write")
+    prepare_queue: asyncio.Queue = asyncio.Queue(maxsize=2 * prepare_workers)
+    send_queue: asyncio.Queue = asyncio.Queue(maxsize=max_in_flight)
+    write_queue: asyncio.Queue = asyncio.Queue(maxsize=2 * max_in_flight)
+
+    async def get(queue: asyncio.Queue, stage: StageStats) -> Any:
+        queue_depth = queue.qsize()
+        item = await queue.get()
+        if item is not None:
+            stage.observe(queue_depth)
+        return item
+
+    def fail(sample: dict, payload_bytes: int, e: Exception) -> None:
+        sample_key = record_key(sample, key)
+        print(f"[error] {key} {sample_key} failed: {e}")
+        if log_payload is not None:
+            log_payload(sample["story_id"], payload_bytes, False, str(e))
+        if not is_retryable(e):
+            try:
+                writer.write(make_record(sample, None))
+                stats.num_rejected += 1
+                return
+            except Exception as record_error:
+                print(f"[error] {key} {sample_key} not written: {record_error}")
+        stats.num_failed += 1
+        stats.failed_keys.append(sample_key)
+
+    async def prepare_worker() -> None:
+        while (sample := await get(prepare_queue, prepare_stage)) is not None:
+            cached = cache_key = None
+            with prepare_stage.busy():
+                try:
+                    if make_cache_key is not None and response_cache.enabled:
+                        cache_key = await asyncio.to_thread(make_cache_key, sample)
+                        cached = await asyncio.to_thread(response_cache.get, cache_key)
+                    if cached is not None:
+                        generated = get_content(cached)
+                    else:
+                        body = await asyncio.to_thread(make_body, sample)
+                except Exception as e:
+                    fail(sample, -1, e)
+                    continue
+            if cached is not None:
+                # payload_bytes None: answered from the cache
+                await write_queue.put((sample, generated, None, None, None))
+            else:
+                await send_queue.put((sample, cache_key, body))
+
+    async def send_worker(http_client: httpx.AsyncClient) -> None:
+        while (item := await get(send_queue, send_stage)) is not None:
+            sample, cache_key, body = item
+            with send_stage.busy():
+                try:
+                    response = await _send(
+                        http_client, body, limiter, post, max_retries
+                    )
+                    response_json = response.json()
+                    generated = get_content(response_json)
+                except Exception as e:
+                    fail(sample, body.content_length, e)
+                    continue
+            await write_queue.put(
+                (sample, generated, cache_key, response_json, body.content_length)
+            )
+
+    async def write_worker() -> None:
+        finished = False
+        while not finished:
+            items = [await get(write_queue, write_stage)]
+            while len(items) < WRITE_BATCH_SIZE and not write_queue.empty():
+                items.append(write_queue.get_nowait())
+            if items[-1] is None:
+                finished = True
+                items.pop()
+            written = []
+            with write_stage.busy(len(items)):
+                records = []
+                for item in items:
+                    sample, generated, cache_key, response_json, payload_bytes = item
+                    try:
+                        records.append(make_record(sample, generated))
+                    except Exception as e:
+                        # e.g. a response without the expected fields
+                        fail(sample, -1 if payload_bytes is None else payload_bytes, e)
+                        continue
+                    written.append(item)
+                    if cache_key is not None and response_json is not None:
+                        await asyncio.to_thread(
+                            response_cache.put,
+                            cache_key,
+                            response_json.get("model", ""),
+                            response_json,
+                        )
+                if records:
+                    writer.write_many(records)
+            for sample, *_, payload_bytes in written:
+                if payload_bytes is None:
+                    stats.num_cached += 1
+                    continue
+                stats.num_done += 1
+                if payload_bytes > stats.max_success_bytes:
+                    stats.max_success_bytes = payload_bytes
+                    stats.max_success_story_id = sample["story_id"]
+                if log_payload is not None:
+                    log_payload(sample["story_id"], payload_bytes, True, None)
+
+    async with httpx.AsyncClient(
+        timeout=600, limits=httpx.Limits(max_connections=max_in_flight)
+    ) as http_client:
+        try:
+            # a stage that raises cancels the others and the loop below,
+            # instead of leaving them blocked on a queue nobody drains
+            async with asyncio.TaskGroup() as stages:
+                preparers = [
+                    stages.create_task(prepare_worker()) for _ in range(prepare_workers)
+                ]
+                senders = [
+                    stages.create_task(send_worker(http_client))
+                    for _ in range(max_in_flight)
+                ]
+                stages.create_task(write_worker())
+                samples = iter(samples)
+                while True:
+                    read_start = time.perf_counter()
+                    sample = next(samples, None)
+                    if sample is None:
+                        break
+                    read_stage.add(1, time.perf_counter() - read_start)
+                    if record_key(sample, key) in done:
+                        stats.num_skipped += 1
+                        continue
+                    await prepare_queue.put(sample)
+                for queue, workers in (
+                    (prepare_queue, preparers),
+                    (send_queue, senders),
+                ):
+                    for _ in workers:
+                        await queue.put(None)
+                    await asyncio.gather(*workers)
+                await write_queue.put(None)
+        except ExceptionGroup as group:
+            raise group.exceptions[0]
+
+    stats.elapsed = time.perf_counter() - start
+    print(limiter.summary())
+    print(pipeline.summary())
+    print(stats.summary())
+    if make_cache_key is not None:
+        print(response_cache.summary())
+    return stats
+
+
+def run(*args, **kwargs) -> RunStats:
+    """Synchronous entry point of run_chat_completions."""
+    return asyncio.run(run_chat_completions(*args, **kwargs))
@@ -0,0 +1,359 @@
+import json
+import os
+import sys
+from collections.abc import Callable, Iterable
+from pathlib import Path
+from typing import Any
+
+import httpx
+
+from src.utils.concurrency import JsonlWriter, load_done_keys, record_key
+from src.utils.payload import RequestBody, get_message_content
+from src.utils.response_cache import get_response_cache
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# per input file limits of the OpenAI Batch API
+MAX_REQUESTS_PER_FILE = 50_000
+MAX_BYTES_PER_FILE = 200 * 1024 * 1024
+# batch statuses after which nothing changes any more
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def get_custom_id(sample: dict, key: str | tuple[str, ...] = "story_id") -> str:
+    """story_id, or e.g. "story_id#shuffle_idx" for several key fields"""
+    if isinstance(key, str):
+        return str(sample[key])
+    return "#".join(str(sample[f]) for f in key if sample.get(f) is not None)
+
+
+class BatchState:
+    """
+    state.json of a batch directory:
+    {"files": [{"name", "num_requests", "num_bytes",
+                "file_id", "batch_id", "status",
+                "output_file_id", "error_file_id", "collected"}]}
+    Saved after every step, so each step can be re-run after an interruption.
+    """
+
+    def __init__(self, batch_dir: Path):
+        self.batch_dir = batch_dir
+        self.path = batch_dir / "state.json"
+        self.files: list[dict] = []
+        if self.path.exists():
+            self.files = json.loads(self.path.read_text(encoding="utf-8"))["files"]
+
+    def save(self) -> None:
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(
+            json.dumps({"files": self.files}, ensure_ascii=False, indent=2),
+            encoding="utf-8",
+        )
+        os.replace(tmp_path, self.path)
+
+
+def prepare(
+    samples: Iterable[dict],
+    make_body: Callable[[dict], RequestBody],
+    batch_dir: Path,
+    output_path: Path,
+    key: str | tuple[str, ...] = "story_id",
+    max_requests: int = MAX_REQUESTS_PER_FILE,
+    max_bytes: int = MAX_BYTES_PER_FILE,
+    make_record: Callable[[dict, Any], dict] | None = None,
+    make_cache_key: Callable[[dict], str] | None = None,
+    get_content: Callable[[dict], Any] = get_message_content,
+) -> BatchState:
+    """
+    Write batch input files requests_{i:03d}.jsonl, one line
+    {"custom_id", "method", "url", "body"} per sample not yet in output_path,
+    split so that no file exceeds max_requests or max_bytes.
+    With make_record and make_cache_key, samples found in the response cache
+    are written to output_path right away instead (make_record receives
+    get_content of the response).
+    Does nothing if the directory was already prepared.
+    """
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    state = BatchState(batch_dir)
+    if state.files:
+        print(f"{batch_dir} is already prepared ({len(state.files)} files)")
+        return state
+
+    done = load_done_keys(output_path, key)
+    response_cache = get_response_cache()
+    use_cache = (
+        make_record is not None
+        and make_cache_key is not None
+        and response_cache.enabled
+    )
+    writer = JsonlWriter(output_path) if use_cache else None
+    files: list[dict] = []
+    f_out = None
+    num_skipped = 0
+    num_cached = 0
+    for sample in samples:
+        if record_key(sample, key) in done:
+            num_skipped += 1
+            continue
+        if use_cache:
+            cached = response_cache.get(make_cache_key(sample))
+            if cached is not None:
+                writer.write(make_record(sample, get_content(cached)))
+                num_cached += 1
+                continue
+        body = make_body(sample)
+        prefix = (
+            '{"custom_id":%s,"method":"POST","url":%s,"body":'
+            % (json.dumps(get_custom_id(sample, key)), json.dumps(BATCH_ENDPOINT))
+        ).encode("utf-8")
+        line_bytes = len(prefix) + body.content_length + 2
+        if line_bytes > max_bytes:
+            raise ValueError(
+                f"Request for {get_custom_id(sample, key)} ({line_bytes} bytes) "
+                f"exceeds the batch file limit of {max_bytes} bytes"
+            )
+        if (
+            f_out is None
+            or files[-1]["num_requests"] >= max_requests
+            or files[-1]["num_bytes"] + line_bytes > max_bytes
+        ):
+            if f_out is not None:
+                f_out.close()
+            name = f"requests_{len(files):03d}.jsonl"
+            files.append({"name": name, "num_requests": 0, "num_bytes": 0})
+            f_out = open(batch_dir / files[-1]["name"], "wb")
+        f_out.write(prefix)
+        for chunk in body.iter_chunks():
+            f_out.write(chunk)
+        f_out.write(b"}\n")
+        files[-1]["num_requests"] += 1
+        files[-1]["num_bytes"] += line_bytes
+    if f_out is not None:
+        f_out.close()
+    if writer is not None:
+        writer.close()
+
+    state.files = files
+    state.save()
+    print(
+        f"Prepared {sum(f['num_requests'] for f in files)} requests in "
+        f"{len(files)} files under {batch_dir} ({num_skipped} already in the "
+        f"output, {num_cached} from the response cache)"
+    )
+    return state
+
+
+def submit(
+    batch_dir: Path,
+    http_client: httpx.Client,
+    api_key: str,
+    base_url: str = "https://api.openai.com/v1",
+) -> BatchState:
+    """Upload the input files and create one batch per file (skipping done steps)."""
+    state = BatchState(batch_dir)
+    if not state.files:
+        raise RuntimeError(f"{batch_dir} is not prepared")
+    headers = {"Authorization": f"Bearer {api_key}"}
+    base_url = base_url.rstrip("/")
+    for file in state.files:
+        if file.get("file_id") is None:
+            with open(batch_dir / file["name"], "rb") as f:
+                response = http_client.post(
+                    f"{base_url}/files",
+                    headers=headers,
+                    data={"purpose": "batch"},
+                    files={"file": (file["name"], f, "application/jsonl")},
+                )
+            response.raise_for_status()
+            file["file_id"] = response.json()["id"]
+            state.save()
+        if file.get("batch_id") is None:
+            response = http_client.post(
+                f"{base_url}/batches",
+                headers=headers,
+                json={
+                    "input_file_id": file["file_id"],
+                    "endpoint": BATCH_ENDPOINT,
+                    "completion_window": COMPLETION_WINDOW,
+                },
+            )
+            response.raise_for_status()
+            file["batch_id"] = response.json()["id"]
+            file["status"] = response.json().get("status")
+            state.save()
+        print(f"{file['name']}: batch {file['batch_id']} ({file.get('status')})")
+    return state
+
+
+def _download(
+    http_client: httpx.Client, file_id: str, path: Path, headers: dict, base_url: str
+) -> None:
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with http_client.stream(
+        "GET", f"{base_url}/files/{file_id}/content", headers=headers
+    ) as response:
+        response.raise_for_status()
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_bytes():
+                f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+def collect(
+    samples: Iterable[dict],
+    make_record: Callable[[dict, Any], dict],
+    batch_dir: Path,
+    output_path: Path,
+    http_client: httpx.Client | None = None,
+    api_key: str | None = None,
+    base_url: str = "https://api.openai.com/v1",
+    key: str | tuple[str, ...] = "story_id",
+    make_cache_key: Callable[[dict], str] | None = None,
+    get_content: Callable[[dict], Any] = get_message_content,
+) -> BatchState:
+    """
+    Append the results of finished batches to output_path in the schema of
+    make_record, which receives get_content of each response (default: the
+    generated text). A result file already present as {name}.output.jsonl is read
+    as is (no request is made), so collection also works offline. Records
+    whose key is already in output_path are not written again. With
+    make_cache_key, successful responses are stored in the response cache.
+    """
+    state = BatchState(batch_dir)
+    if not state.files:
+        raise RuntimeError(f"{batch_dir} is not prepared")
+    headers = {"Authorization": f"Bearer {api_key}"}
+    base_url = base_url.rstrip("/")
+
+    samples_by_id = {get_custom_id(sample, key): sample for sample in samples}
+    response_cache = get_response_cache()
+    writer = JsonlWriter(output_path)
+    done = load_done_keys(output_path, key)
+    num_written = num_failed = num_pending = 0
+    for file in state.files:
+        if file.get("collected"):
+            continue
+        result_path = batch_dir / f"{Path(file['name']).stem}.output.jsonl"
+        error_path = batch_dir / f"{Path(file['name']).stem}.errors.jsonl"
+        if not result_path.exists():
+            if http_client is None or file.get("batch_id") is None:
+                num_pending += 1
+                continue
+            response = http_client.get(
+                f"{base_url}/batches/{file['batch_id']}", headers=headers
+            )
+            response.raise_for_status()
+            batch = response.json()
+            file["status"] = batch["status"]
+            file["output_file_id"] = batch.get("output_file_id")
+            file["error_file_id"] = batch.get("error_file_id")
+            state.save()
+            if file["status"] not in FINAL_STATUSES:
+                print(f"{file['name']}: {file['status']} {batch.get('request_counts')}")
+                num_pending += 1
+                continue
+            if file["error_file_id"] and not error_path.exists():
+                _download(
+                    http_client, file["error_file_id"], error_path, headers, base_url
+                )
+            if not file["output_file_id"]:
+                print(f"{file['name']}: batch {file['status']} without output")
+                file["collected"] = True
+                state.save()
+                continue
+            _download(
+                http_client, file["output_file_id"], result_path, headers, base_url
+            )
+
+        for result_file in (result_path, error_path):
+            if not result_file.exists():
+                continue
+            with open(result_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    sample = samples_by_id.get(result["custom_id"])
+                    if sample is None:
+                        print(
+                            f"Unknown custom_id {result['custom_id']}", file=sys.stderr
+                        )
+                        continue
+                    response = result.get("response") or {}
+                    if response.get("status_code") != 200:
+                        error = result.get("error") or response.get("body")
+                        print(f"[error] {result['custom_id']} failed: {error}")
+                        num_failed += 1
+                        continue
+                    if make_cache_key is not None:
+                        response_cache.put(
+                            make_cache_key(sample),
+                            response["body"].get("model", ""),
+                            response["body"],
+                        )
+                    if record_key(sample, key) in done:
+                        continue
+                    writer.write(make_record(sample, get_content(response["body"])))
+                    done.add(record_key(sample, key))
+                    num_written += 1
+        file["collected"] = True
+        state.save()
+    writer.close()
+
+    print(
+        f"collected {num_written} records into {output_path}, {num_failed} failed "
+        f"requests, {num_pending} batches pending"
+    )
+    return state
+
+
+def run_step(
+    step: str,
+    samples: Iterable[dict],
+    make_body: Callable[[dict], RequestBody],
+    make_record: Callable[[dict, Any], dict],
+    output_path: Path,
+    api_key: str,
+    base_url: str = "https://api.openai.com/v1",
+    key: str | tuple[str, ...] = "story_id",
+    make_cache_key: Callable[[dict], str] | None = None,
+    get_content: Callable[[dict], Any] = get_message_content,
+) -> None:
+    """
+    step: prepare | submit | collect
+    Batch files and state live in {output_path.stem}_batch next to output_path.
+    Remove that directory to prepare a new batch for the samples still missing
+    from the output (e.g. failed requests).
+    """
+    batch_dir = output_path.with_name(f"{output_path.stem}_batch")
+    if step == "prepare":
+        prepare(
+            samples,
+            make_body,
+            batch_dir,
+            output_path,
+            key=key,
+            make_record=make_record,
+            make_cache_key=make_cache_key,
+            get_content=get_content,
+        )
+        return
+    if step not in ("submit", "collect"):
+        raise ValueError(f"Unknown batch step: {step}")
+    with httpx.Client(timeout=600) as http_client:
+        if step == "submit":
+            submit(batch_dir, http_client, api_key, base_url)
+        else:
+            collect(
+                samples,
+                make_record,
+                batch_dir,
+                output_path,
+                http_client=http_client,
+                api_key=api_key,
+                base_url=base_url,
+                key=key,
+                make_cache_key=make_cache_key,
+                get_content=get_content,
+            )
@@ -0,0 +1,105 @@
+from collections.abc import Iterator, Sequence
+
+import numpy as np
+
+
+class LengthBucketSampler:
+    """
+    Batch sampler (indices) for padded batch inference.
+
+    Items are ordered by image count, then length, largest first, so a batch
+    holds items with the same number of images and similar lengths and the
+    batches most likely to run out of memory come first. A batch is closed
+    when another item would exceed max_batch_size items or max_batch_tokens
+    padded tokens (items * longest item).
+
+    shrink() lowers max_batch_tokens for the batches not handed out yet (after
+    an out of memory error) and grow() raises it again after grow_after
+    batches in a row succeeded, staying below the smallest batch that ran out
+    of memory.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        num_images: Sequence[int],
+        max_batch_size: int,
+        max_batch_tokens: int,
+        grow_after: int = 8,
+    ):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.num_images = np.asarray(num_images, dtype=np.int64)
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.ceiling = max_batch_tokens
+        self.grow_after = grow_after
+        self._num_ok = 0
+        self.num_shrinks = 0
+
+    def __iter__(self) -> Iterator[list[int]]:
+        # np.lexsort sorts by the last key first
+        order = np.lexsort((-self.lengths, -self.num_images))
+        batch: list[int] = []
+        longest = 0
+        for idx in order.tolist():
+            length = int(self.lengths[idx])
+            if batch and (
+                self.num_images[idx] != self.num_images[batch[0]]
+                or len(batch) >= self.max_batch_size
+                or (len(batch) + 1) * max(longest, length) > self.max_batch_tokens
+            ):
+                yield batch
+                batch, longest = [], 0
+            batch.append(idx)
+            longest = max(longest, length)
+        if batch:
+            yield batch
+
+    def __len__(self) -> int:
+        """number of batches under the current budget"""
+        return sum(1 for _ in self)
+
+    def shrink(self, failed_batch_tokens: int) -> None:
+        """failed_batch_tokens: padded tokens of the batch that ran out of memory"""
+        self.ceiling = min(self.ceiling, failed_batch_tokens - 1)
+        # batches handed out before an earlier shrink may fail as well; they
+        # do not lower the budget again
+        self.max_batch_tokens = max(
+            1, min(self.max_batch_tokens, failed_batch_tokens // 2)
+        )
+        self._num_ok = 0
+        self.num_shrinks += 1
+
+    def grow(self) -> None:
+        """Call after each successful batch."""
+        self._num_ok += 1
+        if self._num_ok >= self.grow_after and self.max_batch_tokens < self.ceiling:
+            self.max_batch_tokens = min(
+                self.ceiling, self.max_batch_tokens * 5 // 4 + 1
+            )
+            self._num_ok = 0
+
+
+class BatchTimer:
+    """Per-batch generation latency and throughput."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.batch_sizes: list[int] = []
+
+    def add(self, batch_size: int, seconds: float) -> None:
+        self.batch_sizes.append(batch_size)
+        self.latencies.append(seconds)
+
+    def summary(self) -> str:
+        if not self.latencies:
+            return "batches: none"
+        latencies = np.asarray(self.latencies)
+        num_samples = sum(self.batch_sizes)
+        return (
+            f"batches: {len(latencies)}, mean size {num_samples / len(latencies):.1f}, "
+            f"latency mean {latencies.mean():.2f}s "
+            f"p50 {np.percentile(latencies, 50):.2f}s "
+            f"p95 {np.percentile(latencies, 95):.2f}s max {latencies.max():.2f}s, "
+            f"{num_samples / latencies.sum():.2f} samples/s while generating"
+        )
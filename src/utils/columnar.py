@@ -0,0 +1,201 @@
+import json
+import os
+import sys
+from collections.abc import Iterable
+from pathlib import Path
+
+import numpy as np
+
+# Field kinds:
+#   id:           short repeated string (story_id, image_id), interned into a vocabulary
+#   text:         free text, stored in one UTF-8 buffer with offsets
+#   int:          integer
+#   id_list:      list of ids
+#   text_list:    list of texts
+#   int_list:     list of integers
+#   id_text_dict: {id: text}, e.g. {photo_flickr_id: caption}
+FIELD_KINDS = ("id", "text", "int", "id_list", "text_list", "int_list", "id_text_dict")
+
+
+class _TextBuilder:
+    def __init__(self):
+        self.pieces: list[bytes] = []
+        self.offsets = [0]
+
+    def add(self, text: str) -> None:
+        if not isinstance(text, str):
+            raise TypeError(f"Expected str, got {type(text).__name__}")
+        data = text.encode("utf-8")
+        self.pieces.append(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def arrays(self, prefix: str) -> dict[str, np.ndarray]:
+        return {
+            f"{prefix}.buffer": np.frombuffer(b"".join(self.pieces), dtype=np.uint8),
+            f"{prefix}.offsets": np.asarray(self.offsets, dtype=np.int64),
+        }
+
+
+class _Text:
+    """Read side of _TextBuilder: decodes one string per access."""
+
+    def __init__(self, arrays: dict[str, np.ndarray], prefix: str):
+        self.buffer = memoryview(arrays[f"{prefix}.buffer"])
+        self.offsets = arrays[f"{prefix}.offsets"]
+
+    def __getitem__(self, i) -> str:
+        return str(self.buffer[self.offsets[i] : self.offsets[i + 1]], "utf-8")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+class ColumnStore:
+    """
+    Records with a fixed set of fields, stored column by column in numpy arrays.
+    Missing fields (None) are tracked per row in "<field>.valid".
+    record(i) rebuilds the dict for row i on demand.
+    """
+
+    def __init__(self, fields: dict[str, str], arrays: dict[str, np.ndarray]):
+        for name, kind in fields.items():
+            if kind not in FIELD_KINDS:
+                raise ValueError(f"Unknown kind {kind!r} for field {name!r}")
+        self.fields = fields
+        self.arrays = arrays
+        self.num_rows = int(arrays["num_rows"])
+
+        vocab = _Text(arrays, "vocab")
+        self.vocab = [sys.intern(vocab[i]) for i in range(len(vocab))]
+        self.texts = {
+            name: _Text(arrays, name)
+            for name, kind in fields.items()
+            if kind in ("text", "text_list", "id_text_dict")
+        }
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    @classmethod
+    def from_records(
+        cls, records: Iterable[dict], fields: dict[str, str]
+    ) -> "ColumnStore":
+        vocab_codes: dict[str, int] = {}
+        vocab = _TextBuilder()
+
+        def intern(value: str) -> int:
+            code = vocab_codes.get(value)
+            if code is None:
+                vocab.add(value)
+                code = vocab_codes[value] = len(vocab_codes)
+            return code
+
+        valid = {name: [] for name in fields}
+        values = {name: [] for name in fields}
+        row_offsets = {name: [0] for name in fields}
+        texts = {name: _TextBuilder() for name in fields}
+        num_rows = 0
+
+        for record in records:
+            num_rows += 1
+            for name, kind in fields.items():
+                value = record.get(name)
+                valid[name].append(value is not None)
+                if kind == "id":
+                    values[name].append(intern(value) if value is not None else -1)
+                elif kind == "text":
+                    texts[name].add(value if value is not None else "")
+                elif kind == "int":
+                    values[name].append(value if value is not None else 0)
+                else:
+                    items = value if value is not None else []
+                    if kind == "id_list":
+                        values[name].extend(intern(item) for item in items)
+                    elif kind == "text_list":
+                        for item in items:
+                            texts[name].add(item)
+                    elif kind == "int_list":
+                        values[name].extend(items)
+                    elif kind == "id_text_dict":
+                        for key, text in items.items():
+                            values[name].append(intern(key))
+                            texts[name].add(text)
+                    row_offsets[name].append(row_offsets[name][-1] + len(items))
+
+        arrays = {"num_rows": np.asarray(num_rows, dtype=np.int64)}
+        arrays.update(vocab.arrays("vocab"))
+        for name, kind in fields.items():
+            arrays[f"{name}.valid"] = np.asarray(valid[name], dtype=bool)
+            if kind in ("id", "id_list", "id_text_dict"):
+                arrays[f"{name}.values"] = np.asarray(values[name], dtype=np.int32)
+            elif kind in ("int", "int_list"):
+                arrays[f"{name}.values"] = np.asarray(values[name], dtype=np.int64)
+            if kind in ("text", "text_list", "id_text_dict"):
+                arrays.update(texts[name].arrays(name))
+            if kind not in ("id", "text", "int"):
+                arrays[f"{name}.rows"] = np.asarray(row_offsets[name], dtype=np.int64)
+        return cls(fields, arrays)
+
+    def get(self, i: int, name: str):
+        if not self.arrays[f"{name}.valid"][i]:
+            return None
+        kind = self.fields[name]
+        if kind == "id":
+            return self.vocab[self.arrays[f"{name}.values"][i]]
+        if kind == "text":
+            return self.texts[name][i]
+        if kind == "int":
+            return int(self.arrays[f"{name}.values"][i])
+
+        rows = self.arrays[f"{name}.rows"]
+        start, end = rows[i], rows[i + 1]
+        if kind == "id_list":
+            return [self.vocab[c] for c in self.arrays[f"{name}.values"][start:end]]
+        if kind == "text_list":
+            return [self.texts[name][j] for j in range(start, end)]
+        if kind == "int_list":
+            return self.arrays[f"{name}.values"][start:end].tolist()
+        # id_text_dict
+        codes = self.arrays[f"{name}.values"][start:end]
+        return {
+            self.vocab[c]: self.texts[name][j] for c, j in zip(codes, range(start, end))
+        }
+
+    def record(self, i: int) -> dict:
+        return {name: self.get(i, name) for name in self.fields}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def save(self, path: Path, source_signature: str) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with tmp_path.open("wb") as f:
+            np.savez(
+                f,
+                source_signature=np.asarray(source_signature),
+                fields=np.asarray(json.dumps(self.fields)),
+                **self.arrays,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls, path: Path, fields: dict[str, str], source_signature: str
+    ) -> "ColumnStore | None":
+        """return: None if there is no cache for this source and fields"""
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                if str(npz["source_signature"]) != source_signature:
+                    return None
+                if json.loads(str(npz["fields"])) != fields:
+                    return None
+                arrays = {
+                    key: npz[key]
+                    for key in npz.files
+                    if key not in ("source_signature", "fields")
+                }
+        except (OSError, KeyError, ValueError):
+            return None
+        return cls(fields, arrays)
@@ -0,0 +1,260 @@
+import email.utils
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import httpx
+
+# "1s", "6m0s", "20ms", "1h2m3.5s" (x-ratelimit-reset-* of the OpenAI API)
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_duration(value: str) -> float | None:
+    """return: seconds, or None if value is not a duration"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def get_reset_pause(
+    headers: httpx.Headers, min_remaining_requests: int, min_remaining_tokens: int
+) -> float | None:
+    """
+    return: seconds until the x-ratelimit-reset-* of a limit (requests or
+    tokens) whose x-ratelimit-remaining-* fell below the minimum, else None
+    """
+    pause = None
+    for kind, min_remaining in (
+        ("requests", min_remaining_requests),
+        ("tokens", min_remaining_tokens),
+    ):
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        reset = headers.get(f"x-ratelimit-reset-{kind}")
+        if remaining is None or reset is None or not remaining.isdigit():
+            continue
+        reset_seconds = parse_duration(reset)
+        if int(remaining) < min_remaining and reset_seconds:
+            pause = max(pause or 0.0, reset_seconds)
+    return pause
+
+
+def retry_delay(
+    response: httpx.Response | None, attempt: int, max_backoff: float = 60.0
+) -> float:
+    """retry-after-ms / retry-after of the response, else exponential backoff"""
+    if response is not None:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        if retry_after_ms:
+            try:
+                return float(retry_after_ms) / 1000
+            except ValueError:
+                pass
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            seconds = parse_duration(retry_after)
+            if seconds is None:
+                try:
+                    date = email.utils.parsedate_to_datetime(retry_after)
+                    seconds = date.timestamp() - time.time()
+                except (TypeError, ValueError):
+                    seconds = None
+            if seconds is not None:
+                return max(0.0, seconds)
+    backoff = min(max_backoff, 2.0**attempt)
+    return backoff * (0.5 + random.random() / 2)
+
+
+class AdaptiveRateLimiter:
+    """
+    Shared by all workers of a run.
+
+    acquire() spaces request starts by min_interval and blocks while the run is
+    paused. The pause is set from the provider's x-ratelimit-* headers (no
+    remaining requests/tokens until the reset time) and from 429 responses
+    (retry-after, else exponential backoff). min_interval follows
+    x-ratelimit-limit-requests (per minute) when the provider sends it.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float | None = None,
+        min_remaining_requests: int = 1,
+        min_remaining_tokens: int = 8192,
+        max_backoff: float = 60.0,
+    ):
+        self.base_interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.min_interval = self.base_interval
+        self.min_remaining_requests = min_remaining_requests
+        self.min_remaining_tokens = min_remaining_tokens
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+        self._paused_until = 0.0
+
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.total_wait = 0.0
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start, self._paused_until)
+            self._next_start = start + self.min_interval
+            self.num_requests += 1
+            self.total_wait += start - now
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def throttle(self, seconds: float) -> None:
+        """429: every worker waits, not only the one that got it"""
+        with self._lock:
+            self.num_throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update(self, headers: httpx.Headers) -> None:
+        limit = headers.get("x-ratelimit-limit-requests")
+        if limit and limit.isdigit() and int(limit) > 0:
+            self.min_interval = max(self.base_interval, 60.0 / int(limit))
+        seconds = get_reset_pause(
+            headers, self.min_remaining_requests, self.min_remaining_tokens
+        )
+        if seconds:
+            self.pause(seconds)
+
+    def retry_delay(self, response: httpx.Response | None, attempt: int) -> float:
+        return retry_delay(response, attempt, self.max_backoff)
+
+    def summary(self) -> str:
+        return (
+            f"rate limiter: {self.num_requests} requests, "
+            f"{self.num_throttled} throttled (429), "
+            f"waited {self.total_wait:.1f}s in total"
+        )
+
+
+def send_with_retries(
+    send: Callable[[], httpx.Response],
+    limiter: AdaptiveRateLimiter,
+    max_retries: int = 5,
+) -> httpx.Response:
+    """
+    send: performs one request; raises httpx.HTTPStatusError on 4xx/5xx
+    (see src/utils/payload.post_chat_completion)
+    429, 5xx and transport errors are retried up to max_retries times.
+    """
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            response = send()
+        except httpx.HTTPStatusError as e:
+            limiter.update(e.response.headers)
+            status = e.response.status_code
+            if attempt == max_retries or not (status == 429 or status >= 500):
+                raise
+            delay = limiter.retry_delay(e.response, attempt)
+            if status == 429:
+                limiter.throttle(delay)
+            else:
+                time.sleep(delay)
+            continue
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+            time.sleep(limiter.retry_delay(None, attempt))
+            continue
+        limiter.update(response.headers)
+        return response
+    raise AssertionError("unreachable")
+
+
+def record_key(record: dict, key: str | tuple[str, ...] = "story_id"):
+    """str(record[key]), or a tuple of str for several key fields"""
+    if isinstance(key, str):
+        return str(record[key])
+    return tuple(str(record.get(field)) for field in key)
+
+
+def load_done_keys(jsonl_path: Path, key: str | tuple[str, ...] = "story_id") -> set:
+    """record_key of every complete line of an output file"""
+    done = set()
+    if not jsonl_path.exists():
+        return done
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                done.add(record_key(json.loads(line), key))
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return done
+
+
+class JsonlWriter:
+    """
+    Append records to a JSONL file from several threads.
+
+    Every record is written as one complete line with a single write and
+    flushed, so an interrupted run leaves at most a partial last line, which is
+    cut off when the file is opened again.
+    """
+
+    def __init__(self, jsonl_path: Path, fsync: bool = False):
+        self.jsonl_path = jsonl_path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+        self._repair()
+        self._file = open(jsonl_path, "ab")
+
+    def _repair(self) -> None:
+        if not self.jsonl_path.exists():
+            return
+        with open(self.jsonl_path, "rb+") as f:
+            data = f.read()
+            if not data or data.endswith(b"\n"):
+                return
+            keep = data.rfind(b"\n") + 1
+            print(
+                f"Dropping a partial last line ({len(data) - keep} bytes) "
+                f"of {self.jsonl_path}",
+                file=sys.stderr,
+            )
+            f.truncate(keep)
+
+    def write(self, record: dict) -> None:
+        self.write_many([record])
+
+    def write_many(self, records: list[dict]) -> None:
+        """Several records with one write and flush (each still a whole line)."""
+        data = b"".join(
+            (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            for record in records
+        )
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+
+class ImageCache:
+    """
+    Two-tier cache for base64-encoded images.
+
+    - memory: LRU bounded by the total size of the cached values (bytes)
+    - disk: one file per entry under cache_dir, named by the sha256 of the key
+
+    Values are the ASCII bytes of the base64 string, exactly as produced by the
+    encoder passed to get_or_encode, so cached and fresh results are identical.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path | None,
+        max_memory_bytes: int = 256 * 1024 * 1024,
+        enabled: bool = True,
+    ):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.enabled = enabled
+
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def make_key(image_id: str, variant: str, source_signature: str) -> str:
+        """
+        image_id: str
+        variant: encoder settings (e.g. "raw:q75:max10.0MB:q60")
+        source_signature: identifies the source bytes (e.g. "size:mtime_ns")
+        return: sha256 hex digest
+        """
+        raw = f"{image_id}|{variant}|{source_signature}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.b64"
+
+    def _memory_get(self, key: str) -> bytes | None:
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            return value
+
+    def _memory_put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = value
+            self._memory_bytes += len(value)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _disk_get(self, key: str) -> bytes | None:
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            print(f"Error reading cache entry {path}: {e}", file=sys.stderr)
+            return None
+
+    def _disk_put(self, key: str, value: bytes) -> None:
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = path.with_suffix(f".tmp{os.getpid()}.{threading.get_ident()}")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(value)
+            # rename is atomic, so concurrent readers never see a partial file
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing cache entry {path}: {e}", file=sys.stderr)
+            tmp_path.unlink(missing_ok=True)
+
+    def get_or_encode(
+        self, memory_key: str, disk_key: Callable[[], str], encode: Callable[[], bytes]
+    ) -> bytes:
+        """
+        memory_key: key for the in-process tier (cheap, no I/O)
+        disk_key: returns the persistent key; only called on a memory miss
+        encode: produces the value on a miss; empty results are not cached
+        """
+        if not self.enabled:
+            return encode()
+
+        value = self._memory_get(memory_key)
+        if value is not None:
+            self.memory_hits += 1
+            self.bytes_saved += len(value)
+            return value
+
+        key = disk_key()
+        value = self._disk_get(key)
+        if value is not None:
+            self.disk_hits += 1
+            self.bytes_saved += len(value)
+            self._memory_put(memory_key, value)
+            return value
+
+        self.misses += 1
+        value = encode()
+        if value:
+            self._memory_put(memory_key, value)
+            self._disk_put(key, value)
+        return value
+
+    def clear_memory(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def summary(self) -> str:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hit_rate = (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+        return (
+            f"image cache: lookups={lookups} memory_hits={self.memory_hits} "
+            f"disk_hits={self.disk_hits} misses={self.misses} hit_rate={hit_rate:.2%} "
+            f"bytes_saved={self.bytes_saved / (1024 * 1024):.2f}MB "
+            f"memory_usage={self._memory_bytes / (1024 * 1024):.2f}MB"
+        )
@@ -1,17 +1,92 @@
 import base64
+import os
 import sys
 import tarfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from io import BytesIO
 from pathlib import Path
 
 from PIL import Image
 
-from src.utils.paths import VIST_IMAGE_ROOT
+from src.utils.image_cache import ImageCache
+from src.utils.image_shards import ImageShardStore, ShardImage
+from src.utils.paths import CACHE_ROOT, VIST_IMAGE_ROOT
+from src.utils.utils import env
+
+
+def _write_tar_member(data: bytes, out_path: Path, to_jpg: bool) -> str:
+    """
+    Worker for ImageProcessor.extract_tar_gz_to_jpg (runs in a subprocess).
+    Writes to a temporary file and renames it, so an interrupted run never
+    leaves a partial file at out_path.
+    """
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f".{out_path.name}.{os.getpid()}.tmp")
+    try:
+        if to_jpg:
+            with Image.open(BytesIO(data)) as image_file:
+                image = (
+                    image_file.convert("RGB")
+                    if image_file.mode != "RGB"
+                    else image_file
+                )
+                image.save(tmp_path, "JPEG")
+        else:
+            tmp_path.write_bytes(data)
+        os.replace(tmp_path, out_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return str(out_path)
 
 
 class ImageProcessor:
     image_root_path = VIST_IMAGE_ROOT / "test"
 
+    # VISU_IMAGE_BACKEND selects where images are read from:
+    #   files:  one {image_id}.jpg per image under image_root_path
+    #   shards: shards packed by src.pack_image_shards under {image_root_path}_shards
+    image_backend = env(key="VISU_IMAGE_BACKEND", default="files")
+    _shard_store: ImageShardStore | None = None
+
+    # VISU_IMAGE_ENCODE_MODE selects how images are encoded for the API:
+    #   raw:    full resolution, quality lowered only for files over 10MB
+    #   resize: downsized to the detail level, quality searched to fit a byte budget
+    encode_mode = env(key="VISU_IMAGE_ENCODE_MODE", default="raw")
+    image_detail = env(key="VISU_IMAGE_DETAIL", default="low")
+    image_max_bytes = int(env(key="VISU_IMAGE_MAX_BYTES", default="98304"))
+
+    # detail levels of the API; "auto" is resized like "high", the largest
+    # the API may pick
+    IMAGE_DETAILS = ("low", "high", "auto")
+    ENCODE_MODES = ("raw", "resize")
+    # longest side for "low"; (square fit, shortest side) for "high"
+    LOW_DETAIL_SIZE = 512
+    HIGH_DETAIL_SIZE = (2048, 768)
+
+    # VISU_IMAGE_CACHE=0 disables caching of encoded images for a run
+    image_cache = ImageCache(
+        cache_dir=CACHE_ROOT / "encoded_images",
+        max_memory_bytes=int(env(key="VISU_IMAGE_CACHE_MEMORY_MB", default="256"))
+        * 1024
+        * 1024,
+        enabled=env(key="VISU_IMAGE_CACHE", default="1") != "0",
+    )
+
+    @staticmethod
+    def check_settings() -> None:
+        """Fail on VISU_IMAGE_* values that would make every image unusable."""
+        if ImageProcessor.image_detail not in ImageProcessor.IMAGE_DETAILS:
+            raise ValueError(
+                f"VISU_IMAGE_DETAIL={ImageProcessor.image_detail!r} is not one of "
+                f"{', '.join(ImageProcessor.IMAGE_DETAILS)}"
+            )
+        if ImageProcessor.encode_mode not in ImageProcessor.ENCODE_MODES:
+            raise ValueError(
+                f"VISU_IMAGE_ENCODE_MODE={ImageProcessor.encode_mode!r} is not one "
+                f"of {', '.join(ImageProcessor.ENCODE_MODES)}"
+            )
+
     @staticmethod
     def extract_tar_gz(tar_gz_path: Path, extract_path: Path) -> None:
         try:
@@ -30,8 +105,11 @@ class ImageProcessor:
         for png_file in extract_path.rglob("*png"):
             try:
                 with Image.open(png_file) as image_file:
-                    if image_file.mode != "RGB":
-                        image = image_file.convert("RGB")
+                    image = (
+                        image_file.convert("RGB")
+                        if image_file.mode != "RGB"
+                        else image_file
+                    )
                     jpg_file = png_file.with_suffix(".jpg")
 
                     image.save(jpg_file, "JPEG")
@@ -40,6 +118,85 @@ class ImageProcessor:
             except Exception as e:
                 print(f"Error processing {png_file}: {e}", file=sys.stderr)
 
+    @staticmethod
+    def extract_tar_gz_to_jpg(
+        tar_gz_path: Path,
+        extract_path: Path,
+        num_workers: int | None = None,
+        max_pending: int = 256,
+    ) -> None:
+        """
+        Stream the archive member by member and convert PNGs to JPEG in a
+        process pool without writing the PNG to disk. Other files are written
+        as-is. Members whose output already exists are skipped, so the
+        extraction can be resumed after an interruption.
+        """
+        num_workers = num_workers or os.cpu_count() or 1
+        num_written = 0
+        num_skipped = 0
+        num_failed = 0
+        start = time.perf_counter()
+
+        def collect(done) -> None:
+            nonlocal num_written, num_failed
+            for future in done:
+                try:
+                    future.result()
+                    num_written += 1
+                except Exception as e:
+                    num_failed += 1
+                    print(f"Error converting {pending[future]}: {e}", file=sys.stderr)
+                del pending[future]
+
+        pending = {}
+        try:
+            with (
+                tarfile.open(tar_gz_path, "r|gz") as tar,
+                ProcessPoolExecutor(max_workers=num_workers) as executor,
+            ):
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    try:
+                        member = tarfile.data_filter(member, str(extract_path))
+                    except tarfile.FilterError as e:
+                        print(f"Skipping {member.name}: {e}", file=sys.stderr)
+                        continue
+
+                    out_path = extract_path / member.name
+                    to_jpg = out_path.suffix.lower() == ".png"
+                    if to_jpg:
+                        out_path = out_path.with_suffix(".jpg")
+                    if out_path.exists():
+                        num_skipped += 1
+                        continue
+
+                    data = tar.extractfile(member).read()
+                    future = executor.submit(_write_tar_member, data, out_path, to_jpg)
+                    pending[future] = member.name
+
+                    if len(pending) >= max_pending:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                        elapsed = time.perf_counter() - start
+                        print(
+                            f"written {num_written} files, skipped {num_skipped} "
+                            f"({num_written / elapsed:.1f} images/sec)",
+                            end="\r",
+                        )
+
+                done, _ = wait(pending)
+                collect(done)
+        except Exception as e:
+            print(f"Error extracting {tar_gz_path}: {e}", file=sys.stderr)
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Extracted {tar_gz_path} to {extract_path}: written {num_written}, "
+            f"skipped {num_skipped}, failed {num_failed} in {elapsed:.1f}s "
+            f"({num_written / elapsed if elapsed > 0 else 0.0:.1f} images/sec)"
+        )
+
     @staticmethod
     def reduce_jpg_quality_if_large(
         image_path: Path, max_file_size_mb: float = 10.0, quality: int = 40
@@ -65,7 +222,7 @@ class ImageProcessor:
 
     @staticmethod
     def get_reduced_jpg_quality_if_large(
-        image_path: Path, max_file_size_mb: float = 10.0, quality: int = 60
+        image_path: Path | ShardImage, max_file_size_mb: float = 10.0, quality: int = 60
     ) -> bytes:
         if not image_path.exists():
             print(f"Image path {image_path} does not exist.", file=sys.stderr)
@@ -73,7 +230,7 @@ class ImageProcessor:
 
         try:
             file_size_mb = image_path.stat().st_size / (1024 * 1024)
-            with Image.open(image_path) as image_file:
+            with ImageProcessor.open_image(image_path) as image_file:
                 if file_size_mb > max_file_size_mb:
                     buffer = BytesIO()
                     image_file.save(buffer, format="JPEG", quality=quality)
@@ -96,23 +253,175 @@ class ImageProcessor:
             print(f"Error processing {image_path}: {e}", file=sys.stderr)
             return b""
 
+    @staticmethod
+    def get_detail_target_size(width: int, height: int, detail: str) -> tuple[int, int]:
+        """
+        Size the API works on for the given detail level; never upscales.
+        low:  fit into 512x512
+        high, auto: fit into 2048x2048, then scale the shortest side down to 768
+        """
+        if detail == "low":
+            scale = min(1.0, ImageProcessor.LOW_DETAIL_SIZE / max(width, height))
+        elif detail in ("high", "auto"):
+            fit_size, short_side = ImageProcessor.HIGH_DETAIL_SIZE
+            scale = min(1.0, fit_size / max(width, height))
+            scale = min(scale, short_side / (min(width, height) * scale) * scale)
+        else:
+            raise ValueError(f"Unknown detail level: {detail}")
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    @staticmethod
+    def get_resized_jpg_bytes(
+        image_path: Path | ShardImage,
+        detail: str = "low",
+        max_bytes: int = 98304,
+        min_quality: int = 30,
+        max_quality: int = 90,
+    ) -> bytes:
+        """
+        Resize to the target resolution of the detail level, then binary-search
+        the highest JPEG quality whose output fits in max_bytes. Falls back to
+        min_quality if nothing fits.
+        """
+        if detail not in ImageProcessor.IMAGE_DETAILS:
+            # not caught below: every image would be sent empty
+            raise ValueError(f"Unknown detail level: {detail}")
+        if not image_path.exists():
+            print(f"Image path {image_path} does not exist.", file=sys.stderr)
+            return b""
+
+        try:
+            with ImageProcessor.open_image(image_path) as image_file:
+                image = image_file.convert("RGB")
+            size = ImageProcessor.get_detail_target_size(*image.size, detail=detail)
+            if size != image.size:
+                image = image.resize(size, Image.Resampling.LANCZOS)
+
+            def encode(quality: int) -> bytes:
+                buffer = BytesIO()
+                image.save(buffer, format="JPEG", quality=quality)
+                return buffer.getvalue()
+
+            best_quality, best_bytes = min_quality, encode(min_quality)
+            low, high = min_quality + 1, max_quality
+            while low <= high:
+                quality = (low + high) // 2
+                encoded = encode(quality)
+                if len(encoded) <= max_bytes:
+                    best_quality, best_bytes = quality, encoded
+                    low = quality + 1
+                else:
+                    high = quality - 1
+
+            print(
+                f"Resized {image_path} to {size[0]}x{size[1]} ({detail}) at quality "
+                f"{best_quality}: {len(best_bytes) / 1024:.1f}KB"
+            )
+            return best_bytes
+        except Exception as e:
+            print(f"Error processing {image_path}: {e}", file=sys.stderr)
+            return b""
+
     @staticmethod
     def get_image_path(image_id: str) -> Path:
         return ImageProcessor.image_root_path / f"{image_id}.jpg"
 
     @staticmethod
-    def load_image(image_id: str) -> Image.Image:
-        image_path = ImageProcessor.get_image_path(image_id)
+    def get_shard_store() -> ImageShardStore:
+        if ImageProcessor._shard_store is None:
+            root = ImageProcessor.image_root_path
+            shard_dir = root.with_name(f"{root.name}_shards")
+            ImageProcessor._shard_store = ImageShardStore(shard_dir)
+        return ImageProcessor._shard_store
+
+    @staticmethod
+    def get_image_source(image_id: str) -> Path | ShardImage:
+        backend = ImageProcessor.image_backend
+        if backend == "files":
+            return ImageProcessor.get_image_path(image_id)
+        elif backend == "shards":
+            return ShardImage(ImageProcessor.get_shard_store(), image_id)
+        else:
+            raise ValueError(f"Unknown image backend: {backend}")
+
+    @staticmethod
+    def open_image(image_path: Path | ShardImage) -> Image.Image:
+        if isinstance(image_path, ShardImage):
+            return Image.open(image_path.open())
         return Image.open(image_path)
 
+    @staticmethod
+    def load_image(image_id: str) -> Image.Image:
+        image_path = ImageProcessor.get_image_source(image_id)
+        return ImageProcessor.open_image(image_path)
+
+    @staticmethod
+    def get_source_signature(image_path: Path | ShardImage) -> str:
+        try:
+            stat = image_path.stat()
+        except OSError:
+            return "missing"
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    @staticmethod
+    def get_encode_variant() -> str:
+        """Identifies the output of encode_image_to_jpg_bytes under the current settings."""
+        mode = ImageProcessor.encode_mode
+        if mode == "raw":
+            # must match the defaults of get_reduced_jpg_quality_if_large
+            return "raw:max10.0MB:q60:q75"
+        elif mode == "resize":
+            detail = ImageProcessor.image_detail
+            max_bytes = ImageProcessor.image_max_bytes
+            return f"resize:{detail}:{max_bytes}B:q30-90"
+        else:
+            raise ValueError(f"Unknown image encode mode: {mode}")
+
+    @staticmethod
+    def encode_image_to_jpg_bytes(image_id: str) -> bytes:
+        """JPEG bytes sent to the API for image_id (not cached)."""
+        image_path = ImageProcessor.get_image_source(image_id)
+        mode = ImageProcessor.encode_mode
+        if mode == "raw":
+            return ImageProcessor.get_reduced_jpg_quality_if_large(image_path)
+        elif mode == "resize":
+            return ImageProcessor.get_resized_jpg_bytes(
+                image_path,
+                detail=ImageProcessor.image_detail,
+                max_bytes=ImageProcessor.image_max_bytes,
+            )
+        else:
+            raise ValueError(f"Unknown image encode mode: {mode}")
+
+    @staticmethod
+    def encode_image_to_base64_bytes(image_id: str) -> bytes:
+        image_path = ImageProcessor.get_image_source(image_id)
+        variant = ImageProcessor.get_encode_variant()
+
+        def encode() -> bytes:
+            image_bytes = ImageProcessor.encode_image_to_jpg_bytes(image_id)
+            return base64.b64encode(image_bytes)
+
+        return ImageProcessor.image_cache.get_or_encode(
+            memory_key=f"{image_path}|{variant}",
+            disk_key=lambda: ImageCache.make_key(
+                image_id=image_id,
+                variant=variant,
+                source_signature=ImageProcessor.get_source_signature(image_path),
+            ),
+            encode=encode,
+        )
+
     @staticmethod
     def encode_image_to_base64(image_id: str) -> str:
-        image_path = ImageProcessor.get_image_path(image_id)
-        image_bytes = ImageProcessor.get_reduced_jpg_quality_if_large(image_path)
-        base64_string = base64.b64encode(image_bytes).decode("utf-8")
+        base64_bytes = ImageProcessor.encode_image_to_base64_bytes(image_id)
+        base64_string = base64_bytes.decode("utf-8")
         return base64_string
 
     @staticmethod
     def encode_base64_to_url(base64_string: str) -> str:
         url = f"data:image/jpeg;base64,{base64_string}"
         return url
+
+
+ImageProcessor.check_settings()
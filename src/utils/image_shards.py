@@ -0,0 +1,177 @@
+import io
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+INDEX_FILE_NAME = "index.json"
+
+
+class ShardStat(NamedTuple):
+    st_size: int
+    st_mtime_ns: int
+
+
+class MemoryViewFile(io.RawIOBase):
+    """Read-only, seekable file object over a memoryview (no up-front copy)."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), len(self._view) - self._pos)
+        if n <= 0:
+            return 0
+        buffer[:n] = self._view[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+class ShardImage:
+    """
+    An image stored in a shard. Mimics the parts of Path used by
+    ImageProcessor (exists, stat, str) so the encoders accept either.
+    """
+
+    def __init__(self, store: "ImageShardStore", image_id: str):
+        self.store = store
+        self.image_id = image_id
+
+    def exists(self) -> bool:
+        return self.image_id in self.store
+
+    def stat(self) -> ShardStat:
+        view = self.store.get(self.image_id)
+        if view is None:
+            raise FileNotFoundError(str(self))
+        return ShardStat(st_size=len(view), st_mtime_ns=self.store.mtime_ns)
+
+    def open(self) -> MemoryViewFile:
+        view = self.store.get(self.image_id)
+        if view is None:
+            raise FileNotFoundError(str(self))
+        return MemoryViewFile(view)
+
+    def __str__(self) -> str:
+        return f"{self.store.shard_dir}:{self.image_id}"
+
+
+class ImageShardStore:
+    """
+    Reads images packed by pack_image_shards. Shards are mmapped on first use
+    and get() returns a memoryview into the mapping, so no bytes are copied.
+    """
+
+    def __init__(self, shard_dir: Path):
+        self.shard_dir = shard_dir
+        index_path = shard_dir / INDEX_FILE_NAME
+        with index_path.open("r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.mtime_ns = index_path.stat().st_mtime_ns
+        self.shard_names: list[str] = index["shards"]
+        self.entries: dict[str, list[int]] = index["entries"]
+        self._maps: list[mmap.mmap | None] = [None] * len(self.shard_names)
+        self._lock = threading.Lock()
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _get_map(self, shard: int) -> mmap.mmap:
+        mapping = self._maps[shard]
+        if mapping is None:
+            with self._lock:
+                mapping = self._maps[shard]
+                if mapping is None:
+                    with open(self.shard_dir / self.shard_names[shard], "rb") as f:
+                        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[shard] = mapping
+        return mapping
+
+    def get(self, image_id: str) -> memoryview | None:
+        entry = self.entries.get(image_id)
+        if entry is None:
+            return None
+        shard, offset, length = entry
+        return memoryview(self._get_map(shard))[offset : offset + length]
+
+
+def pack_image_shards(
+    image_dir: Path,
+    shard_dir: Path,
+    shard_size_bytes: int = 1024 * 1024 * 1024,
+    suffix: str = ".jpg",
+) -> None:
+    """
+    Concatenate every {image_id}{suffix} in image_dir into shard files of about
+    shard_size_bytes each and write index.json:
+    {"shards": [name, ...], "entries": {image_id: [shard, offset, length]}}
+    Shard names are new for every pack and the index is replaced last, so a
+    repack never touches the shards of the current index; they are removed
+    once the new index is in place.
+    """
+    if not image_dir.exists():
+        print(f"Image dir {image_dir} does not exist.", file=sys.stderr)
+        return
+
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    image_paths = sorted(image_dir.glob(f"*{suffix}"))
+
+    pack_id = f"{time.time_ns():x}"
+    shards: list[str] = []
+    entries: dict[str, list[int]] = {}
+    f_shard = None
+    offset = 0
+    try:
+        for image_path in image_paths:
+            if f_shard is None or offset >= shard_size_bytes:
+                if f_shard is not None:
+                    f_shard.close()
+                shards.append(f"shard_{pack_id}_{len(shards):05d}.bin")
+                f_shard = (shard_dir / shards[-1]).open("wb")
+                offset = 0
+            data = image_path.read_bytes()
+            f_shard.write(data)
+            entries[image_path.stem] = [len(shards) - 1, offset, len(data)]
+            offset += len(data)
+    finally:
+        if f_shard is not None:
+            f_shard.close()
+
+    index_path = shard_dir / INDEX_FILE_NAME
+    tmp_path = index_path.with_suffix(".tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        json.dump({"shards": shards, "entries": entries}, f)
+    os.replace(tmp_path, index_path)
+    # readers that still map an old shard keep it until they close it
+    for old_shard in shard_dir.glob("shard_*.bin"):
+        if old_shard.name not in shards:
+            old_shard.unlink()
+    print(f"Packed {len(entries)} images from {image_dir} into {len(shards)} shards")
@@ -0,0 +1,146 @@
+import json
+import mmap
+import os
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# story_id is the first key of every record we write; fall back to a full
+# parse when it is not found on the line
+STORY_ID_PATTERN = re.compile(rb'"story_id"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+
+class RowView:
+    """
+    Lightweight selection of rows from a source with __getitem__(int) -> record.
+    Slicing a view returns another view; nothing is decoded until accessed.
+    """
+
+    def __init__(self, source, indices: np.ndarray):
+        self.source = source
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return RowView(self.source, self.indices[idx])
+        return self.source[int(self.indices[idx])]
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.source[int(i)]
+
+    def story_ids(self) -> np.ndarray:
+        return self.source.story_ids()[self.indices]
+
+
+class IndexedJsonl:
+    """
+    Random access to the non-empty lines of a JSONL file.
+
+    The byte offset and story_id of every line are stored in a sidecar
+    "<file>.idx.npz" built on first use (and rebuilt when the file changes).
+    The file is mmapped and only the lines that are accessed are decoded.
+    """
+
+    def __init__(self, jsonl_path: Path):
+        self.jsonl_path = Path(jsonl_path)
+        self.index_path = self.jsonl_path.with_name(f"{self.jsonl_path.name}.idx.npz")
+
+        self._file = open(self.jsonl_path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self._map = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if stat.st_size > 0
+            else b""
+        )
+
+        signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+        index = self._load_index(signature)
+        if index is None:
+            index = self._build_index(signature)
+        self.starts, self.ends, self._story_ids = index
+        self._story_rows: dict[str, list[int]] | None = None
+
+    def _load_index(self, signature: str):
+        try:
+            with np.load(self.index_path, allow_pickle=False) as npz:
+                if str(npz["signature"]) != signature:
+                    return None
+                return npz["starts"], npz["ends"], npz["story_ids"]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _build_index(self, signature: str):
+        data = self._map
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+        line_starts = np.concatenate(([0], newlines + 1))
+        line_ends = np.concatenate((newlines, [len(data)]))
+
+        starts, ends, story_ids = [], [], []
+        for start, end in zip(line_starts.tolist(), line_ends.tolist()):
+            line = data[start:end]
+            if not line.strip():
+                continue
+            m = STORY_ID_PATTERN.search(line)
+            story_id = json.loads(m.group(1)) if m else json.loads(line).get("story_id")
+            starts.append(start)
+            ends.append(end)
+            story_ids.append("" if story_id is None else str(story_id))
+
+        index = (
+            np.asarray(starts, dtype=np.int64),
+            np.asarray(ends, dtype=np.int64),
+            np.asarray(story_ids, dtype=str),
+        )
+        tmp_path = self.index_path.with_name(
+            f".{self.index_path.name}.{os.getpid()}.tmp"
+        )
+        try:
+            with tmp_path.open("wb") as f:
+                np.savez(
+                    f,
+                    signature=np.asarray(signature),
+                    starts=index[0],
+                    ends=index[1],
+                    story_ids=index[2],
+                )
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # read-only location: keep the index in memory only
+            print(f"Could not write index {self.index_path}: {e}", file=sys.stderr)
+            tmp_path.unlink(missing_ok=True)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return RowView(self, np.arange(len(self))[idx])
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("JSONL index out of range")
+        return json.loads(self._map[self.starts[idx] : self.ends[idx]])
+
+    def story_ids(self) -> np.ndarray:
+        return self._story_ids
+
+    def find_story(self, story_id) -> RowView:
+        """All rows with the given story_id."""
+        if self._story_rows is None:
+            self._story_rows = {}
+            for i, sid in enumerate(self._story_ids.tolist()):
+                self._story_rows.setdefault(sid, []).append(i)
+        rows = self._story_rows.get(str(story_id), [])
+        return RowView(self, np.asarray(rows, dtype=np.int64))
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
@@ -17,4 +17,6 @@ ORIGINAL_ROOT = DATA_ROOT / "original"
 
 OUTPUT_ROOT = PROJECT_ROOT / "output"
 
+CACHE_ROOT = PROJECT_ROOT / ".cache"
+
 DOTENV_PATH = PROJECT_ROOT / ".env"
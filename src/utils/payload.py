@@ -0,0 +1,226 @@
+import base64
+import hashlib
+import json
+from collections.abc import AsyncIterator, Iterator
+
+import httpx
+
+from src.utils.image_processor import ImageProcessor as ip
+from src.utils.prompt_template import (
+    ImageRef,
+    PromptTemplate,
+    assemble_messages,
+    fill,
+)
+
+# private-use characters; json.dumps(ensure_ascii=False) keeps them as they are
+IMAGE_SENTINEL = "\ue000image\ue000"
+DATA_URL_PREFIX = "data:image/jpeg;base64,"
+
+# multiple of 3, so base64 of consecutive chunks concatenates without padding
+RAW_CHUNK_SIZE = 3 * 16 * 1024
+
+# upper bounds of the image tokens billed per image; "high" is the most tiles
+# ImageProcessor.HIGH_DETAIL_SIZE can produce (85 + 170 * 8)
+IMAGE_TOKENS = {"low": 85, "high": 1445}
+
+
+def base64_length(num_bytes: int) -> int:
+    return 4 * ((num_bytes + 2) // 3)
+
+
+class RequestBody:
+    """
+    Chat completion request body serialized as a sequence of byte chunks.
+
+    The JSON around the images is serialized once (text only) and split at the
+    image positions. Each image is held exactly once: either the base64 bytes
+    shared with ImageProcessor.image_cache, or the raw JPEG bytes when the
+    cache is disabled, in which case base64 is produced chunk by chunk while
+    streaming. content_length is known without serializing the images.
+    """
+
+    def __init__(self, model: str, template: PromptTemplate, sample: dict, **params):
+        self.model = model
+        self.template = template
+        self.params = params
+        self.image_ids: list[str] = []
+        # (data, is_base64)
+        self.images: list[tuple[bytes, bool]] = []
+
+        content = []
+        for part in fill(template, sample):
+            if isinstance(part, ImageRef):
+                self.image_ids.append(part.image_id)
+                if ip.image_cache.enabled:
+                    data = ip.encode_image_to_base64_bytes(image_id=part.image_id)
+                    self.images.append((data, True))
+                else:
+                    data = ip.encode_image_to_jpg_bytes(image_id=part.image_id)
+                    self.images.append((data, False))
+                part = self.image_part()
+            content.append(part)
+
+        body = self.build(template, content)
+        text = json.dumps(body, ensure_ascii=False, separators=(",", ":"))
+        pieces = text.split(IMAGE_SENTINEL)
+        if len(pieces) != len(self.images) + 1:
+            raise ValueError("Image sentinel found in prompt text")
+        self.static_chunks = [piece.encode("utf-8") for piece in pieces]
+
+    def image_part(self) -> dict:
+        """content part of an image; IMAGE_SENTINEL stands for its base64 data"""
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": DATA_URL_PREFIX + IMAGE_SENTINEL,
+                "detail": ip.image_detail,
+            },
+        }
+
+    def build(self, template: PromptTemplate, content: list) -> dict:
+        """content: user content parts (text parts and image_part())"""
+        return {
+            "model": self.model,
+            "messages": assemble_messages(template, content),
+            **self.params,
+        }
+
+    @property
+    def content_length(self) -> int:
+        image_length = sum(
+            len(data) if is_base64 else base64_length(len(data))
+            for data, is_base64 in self.images
+        )
+        return sum(len(chunk) for chunk in self.static_chunks) + image_length
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        for static_chunk, (data, is_base64) in zip(self.static_chunks, self.images):
+            yield static_chunk
+            if is_base64:
+                yield data
+            else:
+                view = memoryview(data)
+                for start in range(0, len(view), RAW_CHUNK_SIZE):
+                    yield base64.b64encode(view[start : start + RAW_CHUNK_SIZE])
+        yield self.static_chunks[-1]
+
+    async def aiter_chunks(self) -> AsyncIterator[bytes]:
+        for chunk in self.iter_chunks():
+            yield chunk
+
+    def to_bytes(self) -> bytes:
+        return b"".join(self.iter_chunks())
+
+    def estimate_tokens(self, completion_tokens: int = 256) -> int:
+        """
+        Rough prompt + completion tokens for rate limiting (about 4 bytes per
+        text token); max_tokens is used for the completion when it is set.
+        """
+        text_bytes = sum(len(chunk) for chunk in self.static_chunks)
+        image_tokens = IMAGE_TOKENS.get(ip.image_detail, IMAGE_TOKENS["high"])
+        completion_tokens = self.params.get("max_tokens", completion_tokens)
+        return text_bytes // 4 + image_tokens * len(self.images) + completion_tokens
+
+
+def post_chat_completion(
+    http_client: httpx.Client,
+    body: RequestBody,
+    api_key: str,
+    base_url: str = "https://api.openai.com/v1",
+) -> httpx.Response:
+    """
+    Send body without materializing it; raises httpx.HTTPStatusError on 4xx/5xx.
+    return: the response (json() is the chat completion)
+    """
+    response = http_client.post(
+        f"{base_url.rstrip('/')}/chat/completions",
+        content=body.iter_chunks(),
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Content-Length": str(body.content_length),
+        },
+    )
+    response.raise_for_status()
+    return response
+
+
+async def apost_chat_completion(
+    http_client: httpx.AsyncClient,
+    body: RequestBody,
+    api_key: str,
+    base_url: str = "https://api.openai.com/v1",
+) -> httpx.Response:
+    """Async version of post_chat_completion."""
+    response = await http_client.post(
+        f"{base_url.rstrip('/')}/chat/completions",
+        content=body.aiter_chunks(),
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Content-Length": str(body.content_length),
+        },
+    )
+    response.raise_for_status()
+    return response
+
+
+def get_message_content(response: httpx.Response | dict) -> str | None:
+    """response: the HTTP response or its json (e.g. from the response cache)"""
+    if isinstance(response, httpx.Response):
+        response = response.json()
+    return response["choices"][0]["message"]["content"]
+
+
+def get_total_tokens(response: dict) -> int | None:
+    """Tokens billed for a chat completion or a Gemini generateContent response."""
+    try:
+        if "usageMetadata" in response:
+            return response["usageMetadata"]["totalTokenCount"]
+        return response["usage"]["total_tokens"]
+    except (KeyError, TypeError):
+        return None
+
+
+def request_cache_key(
+    model: str,
+    template: PromptTemplate,
+    sample: dict,
+    image_variant: str | None = None,
+    **params,
+) -> str:
+    """
+    sha256 of the canonical request (model, messages, params), computed without
+    encoding any image: each image is represented by the ImageCache key of
+    its id, encoder settings (image_variant, default: the current API
+    encoding) and source file signature.
+    """
+    variant = image_variant or ip.get_encode_variant()
+    content = []
+    image_digests = []
+    for part in fill(template, sample):
+        if isinstance(part, ImageRef):
+            source = ip.get_image_source(part.image_id)
+            image_digests.append(
+                ip.image_cache.make_key(
+                    part.image_id, variant, ip.get_source_signature(source)
+                )
+            )
+            part = {
+                "type": "image_url",
+                "image_url": {"url": IMAGE_SENTINEL, "detail": ip.image_detail},
+            }
+        content.append(part)
+    canonical = json.dumps(
+        {
+            "model": model,
+            "messages": assemble_messages(template, content),
+            "params": params,
+            "images": image_digests,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
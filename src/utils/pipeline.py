@@ -0,0 +1,83 @@
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+
+class StageStats:
+    """
+    Busy time of the workers of a pipeline stage and the depth of its input
+    queue. Updated by the stage's own workers only (one thread, or the event
+    loop), so there is no lock.
+    """
+
+    def __init__(self, name: str, num_workers: int = 1):
+        self.name = name
+        self.num_workers = num_workers
+        self.num_items = 0
+        self.busy_seconds = 0.0
+        self._depth_sum = 0
+        self._depth_max = 0
+        self._num_depths = 0
+
+    def observe(self, queue_depth: int) -> None:
+        """Call when a worker takes an item from the input queue."""
+        self._depth_sum += queue_depth
+        self._depth_max = max(self._depth_max, queue_depth)
+        self._num_depths += 1
+
+    @contextmanager
+    def busy(self, num_items: int = 1) -> Iterator[None]:
+        """Time a worker spends on items (not waiting for input or output room)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(num_items, time.perf_counter() - start)
+
+    def add(self, num_items: int, seconds: float) -> None:
+        self.num_items += num_items
+        self.busy_seconds += seconds
+
+    def utilization(self, elapsed: float) -> float:
+        """busy share of the workers' time"""
+        return self.busy_seconds / (elapsed * self.num_workers) if elapsed > 0 else 0.0
+
+    def summary(self, elapsed: float) -> str:
+        line = (
+            f"{self.name}: {self.num_workers} workers, {self.num_items} items, "
+            f"busy {self.busy_seconds:.1f}s ({self.utilization(elapsed):.0%})"
+        )
+        if self._num_depths:
+            line += (
+                f", queue mean {self._depth_sum / self._num_depths:.1f} "
+                f"max {self._depth_max}"
+            )
+        return line
+
+
+class PipelineStats:
+    """
+    Stages of a run connected by bounded queues. The stage with the busiest
+    workers limits the throughput; the queue in front of it stays full and
+    the queues after it stay empty.
+    """
+
+    def __init__(self):
+        self.stages: list[StageStats] = []
+        self.start = time.perf_counter()
+
+    def stage(self, name: str, num_workers: int = 1) -> StageStats:
+        stage = StageStats(name, num_workers)
+        self.stages.append(stage)
+        return stage
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        lines = ["pipeline:"] + [f"  {stage.summary(elapsed)}" for stage in self.stages]
+        if self.stages:
+            busiest = max(self.stages, key=lambda stage: stage.utilization(elapsed))
+            lines.append(
+                f"  bottleneck: {busiest.name} "
+                f"({busiest.utilization(elapsed):.0%} busy)"
+            )
+        return "\n".join(lines)
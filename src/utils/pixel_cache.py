@@ -0,0 +1,155 @@
+import json
+import math
+import os
+import sys
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from src.utils.image_processor import ImageProcessor as ip
+
+INDEX_FILE_NAME = "index.json"
+PIXELS_FILE_NAME = "pixels.bin"
+
+# Qwen2.5-VL: 14px patches merged 2x2, i.e. one vision token per 28x28 pixels
+PATCH_FACTOR = 28
+
+
+def smart_resize(
+    height: int,
+    width: int,
+    factor: int = PATCH_FACTOR,
+    min_pixels: int = 56 * 56,
+    max_pixels: int = 28 * 28 * 1280,
+) -> tuple[int, int]:
+    """
+    Same rule as the Qwen2.5-VL image processor: both sides become multiples
+    of factor, the aspect ratio is kept and the area lies in [min_pixels, max_pixels].
+    """
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+
+def count_vision_tokens(height: int, width: int) -> int:
+    return (height // PATCH_FACTOR) * (width // PATCH_FACTOR)
+
+
+def _decode_and_resize(args) -> tuple[str, bytes | None, int, int]:
+    """Worker for PixelCache.build (runs in a subprocess)."""
+    image_id, min_pixels, max_pixels = args
+    try:
+        with ip.load_image(image_id=image_id) as image_file:
+            image = image_file.convert("RGB")
+        height, width = smart_resize(
+            image.height, image.width, min_pixels=min_pixels, max_pixels=max_pixels
+        )
+        if (width, height) != image.size:
+            image = image.resize((width, height), Image.Resampling.BICUBIC)
+        return image_id, np.asarray(image, dtype=np.uint8).tobytes(), height, width
+    except Exception as e:
+        print(f"Error processing image {image_id}: {e}", file=sys.stderr)
+        return image_id, None, 0, 0
+
+
+class PixelCache:
+    """
+    Decoded, pre-resized RGB images stored back to back in one uint8 file.
+    get() returns an (H, W, 3) view into a read-only memmap (no copy), which
+    the Qwen processor accepts in place of a PIL image.
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        with (cache_dir / INDEX_FILE_NAME).open("r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.min_pixels: int = index["min_pixels"]
+        self.max_pixels: int = index["max_pixels"]
+        self.entries: dict[str, list[int]] = index["entries"]
+        self.pixels = np.memmap(cache_dir / PIXELS_FILE_NAME, dtype=np.uint8, mode="r")
+
+    def __getstate__(self) -> dict:
+        # reopened by path in DataLoader workers instead of copying the pixels
+        return {"cache_dir": self.cache_dir}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["cache_dir"])
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, image_id: str) -> np.ndarray:
+        offset, height, width = self.entries[image_id]
+        return self.pixels[offset : offset + height * width * 3].reshape(
+            height, width, 3
+        )
+
+    def count_vision_tokens(self, image_ids: list[str]) -> int:
+        return sum(
+            count_vision_tokens(self.entries[image_id][1], self.entries[image_id][2])
+            for image_id in image_ids
+        )
+
+    @staticmethod
+    def build(
+        image_ids: list[str],
+        cache_dir: Path,
+        min_pixels: int = 56 * 56,
+        max_pixels: int = 28 * 28 * 1280,
+        num_workers: int | None = None,
+    ) -> None:
+        """
+        image_ids: images to decode (duplicates are decoded once)
+        min_pixels, max_pixels: per-image pixel budget passed to smart_resize
+        """
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        index_path = cache_dir / INDEX_FILE_NAME
+        # an index must never point into a pixels file it was not built with
+        index_path.unlink(missing_ok=True)
+        unique_ids = list(dict.fromkeys(image_ids))
+
+        entries: dict[str, list[int]] = {}
+        offset = 0
+        pixels_path = cache_dir / PIXELS_FILE_NAME
+        tmp_path = pixels_path.with_suffix(".tmp")
+        tasks = [(image_id, min_pixels, max_pixels) for image_id in unique_ids]
+        with (
+            tmp_path.open("wb") as f,
+            Pool(processes=num_workers or os.cpu_count() or 1) as pool,
+        ):
+            for image_id, data, height, width in pool.imap(
+                _decode_and_resize, tasks, chunksize=16
+            ):
+                if data is None:
+                    continue
+                f.write(data)
+                entries[image_id] = [offset, height, width]
+                offset += len(data)
+        os.replace(tmp_path, pixels_path)
+
+        with index_path.open("w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "min_pixels": min_pixels,
+                    "max_pixels": max_pixels,
+                    "entries": entries,
+                },
+                f,
+            )
+        print(
+            f"Cached {len(entries)}/{len(unique_ids)} images "
+            f"({offset / (1024 * 1024):.1f}MB) to {cache_dir}"
+        )
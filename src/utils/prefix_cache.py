@@ -0,0 +1,117 @@
+import copy
+from collections.abc import Iterable, Sequence
+
+import torch
+
+
+def shared_prefix_length(
+    sequences: Sequence[Sequence[int]], stop_token_ids: Iterable[int] = ()
+) -> int:
+    """
+    Length of the longest common prefix of the token sequences, cut before the
+    first of stop_token_ids (e.g. image tokens: equal ids, different pixels).
+    """
+    stop_token_ids = set(stop_token_ids)
+    length = 0
+    for tokens in zip(*sequences):
+        if tokens[0] in stop_token_ids or any(t != tokens[0] for t in tokens):
+            break
+        length += 1
+    return length
+
+
+def find_shared_prefix(
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    stop_token_ids: Iterable[int] = (),
+    min_length: int = 8,
+) -> torch.Tensor | None:
+    """
+    input_ids, attention_mask: (B, L) left-padded prompts of different samples
+    return: (P,) their shared prefix (see shared_prefix_length), or None if it
+    is shorter than min_length tokens
+    """
+    rows = [row[mask.bool()] for row, mask in zip(input_ids, attention_mask)]
+    length = shared_prefix_length([row.tolist() for row in rows], stop_token_ids)
+    # every prompt keeps a suffix to prefill
+    length = min(length, min(len(row) for row in rows) - 1)
+    return rows[0][:length].clone() if length >= min_length else None
+
+
+class SharedPrefix:
+    """
+    Token prefix shared by every prompt of a run (chat template header and the
+    static instruction of the template) and its KV cache, computed once.
+
+    split() turns a left-padded batch whose rows all start with the prefix
+    into the sample-specific suffixes (left-padded again); fork() gives a copy
+    of the prefix cache for the batch, so only the suffixes are prefilled.
+    """
+
+    def __init__(self, ids: torch.Tensor, past_key_values):
+        """ids: (P,) prefix token ids; past_key_values: their cache (batch size 1)"""
+        self.ids = ids
+        self.past_key_values = past_key_values
+
+        self.num_rows = 0
+        self.num_full_batches = 0
+        self.prefill_tokens = len(ids)
+        self.saved_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def split(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor, pad_token_id: int
+    ) -> tuple[torch.Tensor, torch.Tensor] | None:
+        """
+        input_ids, attention_mask: (B, L), left padded
+        return: (suffix_ids, suffix_mask), (B, S) left padded, or None if a
+        row does not start with the prefix
+        """
+        prefix_len = len(self.ids)
+        suffixes = []
+        for row, mask in zip(input_ids, attention_mask):
+            tokens = row[mask.bool()]
+            if len(tokens) <= prefix_len or not torch.equal(
+                tokens[:prefix_len], self.ids.to(tokens.device)
+            ):
+                return None
+            suffixes.append(tokens[prefix_len:])
+        suffix_len = max(len(suffix) for suffix in suffixes)
+        suffix_ids = input_ids.new_full((len(suffixes), suffix_len), pad_token_id)
+        suffix_mask = attention_mask.new_zeros((len(suffixes), suffix_len))
+        for i, suffix in enumerate(suffixes):
+            suffix_ids[i, suffix_len - len(suffix) :] = suffix
+            suffix_mask[i, suffix_len - len(suffix) :] = 1
+        return suffix_ids, suffix_mask
+
+    def fork(self, batch_size: int):
+        """A copy of the prefix cache for a batch (the cache itself is kept)."""
+        past_key_values = copy.deepcopy(self.past_key_values)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+
+    def record(self, suffix_mask: torch.Tensor | None, num_tokens: int = 0) -> None:
+        """
+        suffix_mask: of a batch run on the prefix, or None for a batch
+        prefilled in full with num_tokens tokens
+        """
+        if suffix_mask is None:
+            self.num_full_batches += 1
+            self.prefill_tokens += num_tokens
+            return
+        self.num_rows += len(suffix_mask)
+        self.prefill_tokens += int(suffix_mask.sum())
+        self.saved_tokens += len(self.ids) * len(suffix_mask)
+
+    def summary(self) -> str:
+        total = self.prefill_tokens + self.saved_tokens
+        saved = self.saved_tokens / total if total else 0.0
+        return (
+            f"shared prefix: {len(self.ids)} tokens reused by {self.num_rows} "
+            f"samples ({self.num_full_batches} batches prefilled in full), "
+            f"prefill tokens {self.prefill_tokens} computed, "
+            f"{self.saved_tokens} saved ({saved:.1%})"
+        )
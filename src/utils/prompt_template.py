@@ -0,0 +1,273 @@
+import base64
+import io
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, NamedTuple
+
+from PIL import Image
+
+from src.utils.image_processor import ImageProcessor as ip
+
+
+class ImageRef(NamedTuple):
+    """An image in a filled prompt; renderers decide how to materialize it."""
+
+    image_id: str
+
+
+class Slot(NamedTuple):
+    """Placeholder in a compiled skeleton, resolved per sample by its section."""
+
+    section: int
+    key: Any
+
+
+def _text_part(text: str) -> dict:
+    return {"type": "text", "text": text}
+
+
+@dataclass(frozen=True)
+class Text:
+    """Static text. With params=True it is formatted with the bound params."""
+
+    text: str
+    params: bool = False
+
+    def shape(self, value) -> None:
+        return None
+
+    def compile(self, section: int, shape, params: dict) -> list:
+        text = self.text.format(**params) if self.params else self.text
+        return [_text_part(text)]
+
+
+@dataclass(frozen=True)
+class Texts:
+    """
+    value: list of texts
+    Each text becomes one part, prefixed with item.format(i=index).
+    """
+
+    item: str = ""
+
+    def shape(self, value) -> int:
+        return len(value)
+
+    def compile(self, section: int, shape, params: dict) -> list:
+        return [Slot(section, (self.item.format(i=i), i)) for i in range(shape)]
+
+    def resolve(self, key, value) -> dict:
+        prefix, i = key
+        return _text_part(prefix + value[i])
+
+
+@dataclass(frozen=True)
+class Images:
+    """
+    value: (image_ids, missing_pos)
+    One image part per image id. If missing_pos is not None, missing_marker is
+    inserted at that position and the following images shift by one. With a
+    label, a text part label.format(i=index) precedes each image.
+    """
+
+    missing_marker: str | None = None
+    label: str | None = None
+
+    def shape(self, value) -> tuple[int, int | None]:
+        image_ids, missing_pos = value
+        return len(image_ids), missing_pos
+
+    def compile(self, section: int, shape, params: dict) -> list:
+        num_images, missing_pos = shape
+        parts = []
+        is_missing_inserted = False
+        num_slots = num_images + (1 if missing_pos is not None else 0)
+        for i in range(num_slots):
+            if i == missing_pos and not is_missing_inserted:
+                parts.append(_text_part(self.missing_marker))
+                is_missing_inserted = True
+            else:
+                idx = i - 1 if is_missing_inserted else i
+                if self.label is not None:
+                    parts.append(_text_part(self.label.format(i=idx)))
+                parts.append(Slot(section, idx))
+        return parts
+
+    def resolve(self, key, value) -> ImageRef:
+        image_ids, _ = value
+        return ImageRef(image_ids[key])
+
+
+@dataclass(frozen=True)
+class CaptionedImages:
+    """
+    value: (image_ids, texts, hidden_pos)
+    For each index: a "(index)" label, the image (or hidden_text at
+    hidden_pos, whose label gets hidden_label appended) and then the caption.
+    hidden_pos may also be a sequence of positions.
+    """
+
+    hidden_text: str
+    hidden_label: str
+
+    def shape(self, value) -> tuple[int, tuple[int, ...]]:
+        image_ids, texts, hidden_pos = value
+        hidden = (hidden_pos,) if isinstance(hidden_pos, int) else tuple(hidden_pos)
+        assert len(image_ids) == len(texts), "image_ids and texts length mismatch"
+        assert all(0 <= pos < len(image_ids) for pos in hidden), (
+            "target_pos out of range"
+        )
+        return len(image_ids), hidden
+
+    def compile(self, section: int, shape, params: dict) -> list:
+        num_images, hidden = shape
+        parts = []
+        for idx in range(num_images):
+            marker = self.hidden_label if idx in hidden else ""
+            parts.append(_text_part(f"({idx}){marker}"))
+            if idx in hidden:
+                parts.append(_text_part(self.hidden_text))
+            else:
+                parts.append(Slot(section, ("image", idx)))
+            parts.append(Slot(section, ("text", idx)))
+        return parts
+
+    def resolve(self, key, value):
+        image_ids, texts, _ = value
+        kind, idx = key
+        if kind == "image":
+            return ImageRef(image_ids[idx])
+        return _text_part(texts[idx])
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    system: system prompt (omitted by render_qwen)
+    sections: user content, in order
+    bind: sample -> (values aligned with sections, params for Text(params=True))
+    """
+
+    name: str
+    system: str | None
+    sections: tuple
+    bind: Callable[[dict], tuple[tuple, dict]]
+
+
+@lru_cache(maxsize=1024)
+def _compile(template: PromptTemplate, shapes: tuple, params: tuple) -> tuple:
+    params_dict = dict(params)
+    skeleton = []
+    for section_idx, (section, shape) in enumerate(zip(template.sections, shapes)):
+        skeleton.extend(section.compile(section_idx, shape, params_dict))
+    return tuple(skeleton)
+
+
+def fill(template: PromptTemplate, sample: dict) -> list:
+    """
+    return: user content parts; static parts are shared dicts from the compiled
+    skeleton, images are ImageRef
+    """
+    values, params = template.bind(sample)
+    shapes = tuple(
+        section.shape(value) for section, value in zip(template.sections, values)
+    )
+    skeleton = _compile(template, shapes, tuple(sorted(params.items())))
+    return [
+        template.sections[part.section].resolve(part.key, values[part.section])
+        if isinstance(part, Slot)
+        else part
+        for part in skeleton
+    ]
+
+
+def assemble_messages(template: PromptTemplate, content: list) -> list[dict]:
+    messages = []
+    if template.system is not None:
+        messages.append({"role": "system", "content": template.system})
+    messages.append({"role": "user", "content": content})
+    return messages
+
+
+def render_openai(template: PromptTemplate, sample: dict) -> list[dict]:
+    content = []
+    for part in fill(template, sample):
+        if isinstance(part, ImageRef):
+            base64_string = ip.encode_image_to_base64(image_id=part.image_id)
+            url = ip.encode_base64_to_url(base64_string=base64_string)
+            part = {
+                "type": "image_url",
+                "image_url": {"url": url, "detail": ip.image_detail},
+            }
+        content.append(part)
+
+    return assemble_messages(template, content)
+
+
+def render_qwen(template: PromptTemplate, sample: dict, pixel_cache=None):
+    """
+    pixel_cache: optional PixelCache; cached images are returned as
+    pre-resized (H, W, 3) arrays instead of full-resolution PIL images
+    return: messages, images
+    """
+    content = []
+    images = []
+    for part in fill(template, sample):
+        if isinstance(part, ImageRef):
+            if pixel_cache is not None and part.image_id in pixel_cache:
+                image = pixel_cache.get(part.image_id)
+            else:
+                image = ip.load_image(image_id=part.image_id)
+            images.append(image)
+            part = {"type": "image"}
+        content.append(part)
+
+    messages = [
+        {"role": "user", "content": content},
+    ]
+    return messages, images
+
+
+def openai_to_qwen(messages: list[dict]):
+    """
+    OpenAI chat messages with data URL images (e.g. sent to
+    src.inference.server) -> messages, images as returned by render_qwen
+    """
+    converted = []
+    images = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            converted.append({"role": message["role"], "content": content})
+            continue
+        parts = []
+        for part in content:
+            if part["type"] == "image_url":
+                url = part["image_url"]["url"]
+                if not url.startswith("data:"):
+                    raise ValueError(f"Only data URL images are supported: {url[:64]}")
+                data = base64.b64decode(url.partition(",")[2])
+                images.append(Image.open(io.BytesIO(data)).convert("RGB"))
+                part = {"type": "image"}
+            parts.append(part)
+        converted.append({"role": message["role"], "content": parts})
+    return converted, images
+
+
+def count_tokens(
+    template: PromptTemplate,
+    sample: dict,
+    count_text_tokens: Callable[[str], int] = lambda text: len(text) // 4 + 1,
+    image_tokens: int = 85,
+) -> int:
+    """
+    Prompt token estimate without loading any image.
+    image_tokens: 85 is the fixed cost of a detail="low" image for OpenAI models
+    """
+    total = count_text_tokens(template.system) if template.system is not None else 0
+    for part in fill(template, sample):
+        if isinstance(part, ImageRef):
+            total += image_tokens
+        else:
+            total += count_text_tokens(part["text"])
+    return total
@@ -0,0 +1,162 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from src.utils.paths import CACHE_ROOT
+from src.utils.utils import env
+
+
+class ResponseCache:
+    """
+    Chat completion responses stored in SQLite, keyed by a canonical request
+    hash (see src/utils/payload.request_cache_key).
+
+    Entries older than ttl_seconds are not returned and are removed by evict(),
+    which also drops the least recently used entries while the total size of
+    the stored responses exceeds max_bytes. Several processes (shards) can
+    share one database.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        ttl_seconds: float | None = None,
+        max_bytes: int | None = None,
+        enabled: bool = True,
+    ):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(
+                self.db_path, timeout=60, check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, created REAL, last_used REAL, "
+                "size INTEGER, response TEXT)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> dict | None:
+        """return: the cached response json, or None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT created, response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (
+                self.ttl_seconds is not None and now - row[0] > self.ttl_seconds
+            ):
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[1])
+
+    def put(self, key: str, model: str, response: dict) -> None:
+        if not self.enabled:
+            return
+        text = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, now, now, len(text.encode("utf-8")), text),
+            )
+            self.writes += 1
+
+    def evict(self) -> int:
+        """return: number of removed entries"""
+        if not self.enabled:
+            return 0
+        with self._lock:
+            conn = self._connect()
+            removed = 0
+            if self.ttl_seconds is not None:
+                removed += conn.execute(
+                    "DELETE FROM responses WHERE created < ?",
+                    (time.time() - self.ttl_seconds,),
+                ).rowcount
+            if self.max_bytes is not None:
+                total = conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()[0]
+                if total > self.max_bytes:
+                    # oldest first until the total fits
+                    rows = conn.execute(
+                        "SELECT key, size FROM responses ORDER BY last_used"
+                    ).fetchall()
+                    keys = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        keys.append((key,))
+                        total -= size
+                    conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+                    removed += len(keys)
+        return removed
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (
+            f"response cache: lookups={lookups} hits={self.hits} "
+            f"hit_rate={hit_rate:.2%} writes={self.writes}"
+        )
+
+
+_response_cache: ResponseCache | None = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    Shared cache configured from the environment:
+      VISU_RESPONSE_CACHE=0 disables it
+      VISU_RESPONSE_CACHE_TTL_DAYS (default 30; 0 keeps entries forever)
+      VISU_RESPONSE_CACHE_MAX_MB (default 1024)
+    Evicted once when it is first used.
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            ttl_days = float(env(key="VISU_RESPONSE_CACHE_TTL_DAYS", default="30"))
+            max_mb = int(env(key="VISU_RESPONSE_CACHE_MAX_MB", default="1024"))
+            cache = ResponseCache(
+                CACHE_ROOT / "responses.sqlite",
+                ttl_seconds=ttl_days * 86400 if ttl_days > 0 else None,
+                max_bytes=max_mb * 1024 * 1024,
+                enabled=env(key="VISU_RESPONSE_CACHE", default="1") != "0",
+            )
+            removed = cache.evict()
+            if removed:
+                print(f"Evicted {removed} cached responses")
+            _response_cache = cache
+    return _response_cache
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from src.utils.concurrency import record_key
+from src.utils.indexed_jsonl import RowView
+from src.utils.utils import env
+
+
+def story_shard(story_id, num_shards: int) -> int:
+    """Stable across processes and machines (unlike hash())."""
+    digest = hashlib.sha1(str(story_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def get_shard_spec() -> tuple[int, int]:
+    """
+    (shard_index, num_shards) from NUM_SHARDS and SHARD_INDEX, falling back to
+    PBS_ARRAY_INDEX inside a qsub array job (see shell_scripts/submit_shards.sh).
+    """
+    num_shards = int(env(key="NUM_SHARDS", default="1"))
+    shard_index = int(
+        env(key="SHARD_INDEX", default=env(key="PBS_ARRAY_INDEX", default="0"))
+    )
+    if not 0 <= shard_index < num_shards:
+        raise RuntimeError(f"Shard index {shard_index} out of range for {num_shards}")
+    return shard_index, num_shards
+
+
+def select_shard(rows, shard_index: int, num_shards: int):
+    """
+    rows: a dataset or RowView (anything with story_ids() and __getitem__)
+    return: RowView of the rows whose story_id hashes to shard_index
+    """
+    if num_shards == 1:
+        return rows
+    shards = np.asarray(
+        [story_shard(story_id, num_shards) for story_id in rows.story_ids().tolist()],
+        dtype=np.int64,
+    )
+    return RowView(rows, np.flatnonzero(shards == shard_index))
+
+
+def shard_output_path(path: Path, shard_index: int, num_shards: int) -> Path:
+    if num_shards == 1:
+        return path
+    return path.with_name(
+        f"{path.stem}.shard{shard_index:03d}-of-{num_shards:03d}{path.suffix}"
+    )
+
+
+def merge_marker_path(output_path: Path) -> Path:
+    """written next to the output of merge_shards (tells a merge from other results)"""
+    return output_path.with_name(f"{output_path.name}.merged")
+
+
+def merge_shards(
+    output_path: Path,
+    num_shards: int,
+    expected_keys: list[tuple[str, ...]],
+    key_fields: tuple[str, ...] = ("story_id",),
+    overwrite: bool = False,
+) -> list[tuple[str, ...]]:
+    """
+    Merge the shard outputs of output_path into output_path.
+
+    Duplicate records (same key_fields, e.g. from a re-run shard) are collapsed,
+    preferring a record with a non-null "generated".
+    expected_keys: record_key(row, key_fields) of every dataset row that was
+    run; records are written in their order, to a temporary file that replaces
+    output_path. An existing output_path that is not an earlier merge (e.g.
+    the results of an unsharded run) is only replaced with overwrite.
+    return: expected keys that no shard produced
+    """
+    marker_path = merge_marker_path(output_path)
+    if output_path.exists() and not marker_path.exists() and not overwrite:
+        raise FileExistsError(
+            f"{output_path} exists and is not a merge of shard outputs; "
+            "move it away or merge with overwrite"
+        )
+    records: dict[tuple, dict] = {}
+    num_read = 0
+    for shard_index in range(num_shards):
+        shard_path = shard_output_path(output_path, shard_index, num_shards)
+        if not shard_path.exists():
+            print(f"Shard output {shard_path} does not exist.", file=sys.stderr)
+            continue
+        with open(shard_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a job killed mid-write leaves a partial last line
+                    print(f"Skipping broken line in {shard_path}", file=sys.stderr)
+                    continue
+                num_read += 1
+                key = record_key(record, key_fields)
+                kept = records.get(key)
+                if kept is None or (
+                    kept.get("generated") is None
+                    and record.get("generated") is not None
+                ):
+                    records[key] = record
+
+    order = {key: i for i, key in enumerate(dict.fromkeys(expected_keys))}
+    merged_keys = sorted(records, key=lambda key: (order.get(key, len(order)), key))
+    merged = [records[key] for key in merged_keys]
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f_out:
+            for record in merged:
+                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    marker_path.write_text(f"{num_shards}\n", encoding="utf-8")
+
+    missing = [key for key in order if key not in records]
+    unexpected = sum(1 for key in records if key not in order)
+    print(
+        f"Merged {num_read} records from {num_shards} shards into {len(merged)} "
+        f"({num_read - len(merged)} duplicates) -> {output_path}"
+    )
+    print(
+        f"coverage: {len(order) - len(missing)}/{len(order)} samples, "
+        f"missing {len(missing)}, unexpected {unexpected}"
+    )
+    return missing
@@ -1,14 +1,241 @@
 import re
+from functools import lru_cache
 
+import pandas as pd
 from num2words import num2words
 
-from src.utils.image_processor import ImageProcessor as ip
+from src.utils.prompt_template import (
+    CaptionedImages,
+    Images,
+    PromptTemplate,
+    Text,
+    Texts,
+    render_openai,
+    render_qwen,
+)
+
+NUMBER_PATTERN = re.compile(r"\d+")
+
+MISSING_IMAGE_INSTRUCTION = "You are given a sequence of images that tell a story, but one image is missing. Choose only the number of the most appropriate option that describes what should happen in the missing image location. Respond with just the index (e.g., 0, 1, 2, ...)."
+ANSWER_SYSTEM_PROMPT = "You are a helpful assistant. Answer the following question."
+
+INCORRECT_OPTION_RULES = (
+    "- Important:\n"
+    "  - Options must be discriminative: avoid generic or 'safe' sentences that could fit regardless of what the hidden image shows.\n"
+    "- Constraints:\n"
+    "  - It must be wrong when the entire context (all images and captions) is considered.\n"
+    "  - Maintain narrative coherence with the surrounding captions (smooth connection, consistent viewpoint/tense, causal flow, recurring entities/terminology).\n"
+    "  - Options must be mutually distinct and not trivially easy.\n"
+    "  - Avoid blatantly wrong errors (physical impossibilities, major plot leaps, obvious anachronisms).\n"
+    "  - Limit differences to subtle yet falsifiable mismatches anchored in the visible context (role/agent swap, off-by-one quantity, order swap, location/time confusion, object state/attribute mismatch, cause–effect inversion, identity confusion, etc.).\n"
+    "- Style:\n"
+    "  - Match the length, tone, perspective, and tense of neighboring captions. Use only previously introduced proper nouns. Do not copy captions verbatim, but keep similar wording.\n"
+    "  - Do not use negations or meta commentary (e.g., 'not', 'incorrect'); write natural narration only.\n"
+    "- Prohibited:\n"
+    "  - Introducing major new elements not present in the images, impossible events, breaking world consistency, explanations or reasoning steps.\n"
+    "  - Generic, content-free sentences that would fit almost any scene.\n"
+)
+
+BUILD_INCORRECT_OPTION_TEMPLATE = PromptTemplate(
+    name="build_incorrect_option",
+    system="You are a helpful assistant.",
+    sections=(
+        Text(
+            "You are given a coherent story represented by a sequence of images and their captions. "
+            "Generate {num_incorrect_options} short alternative story snippets to place at position pos={target_pos}. "
+            "Each snippet should be plausible at first glance but ultimately incorrect when considering the full context.\n"
+            + INCORRECT_OPTION_RULES
+            + "- Output format:\n"
+            '  - Return only a JSON array of strings (no keys). Example: ["Option A", "Option B", "Option C"]\n'
+            "- Language: English.",
+            params=True,
+        ),
+        Text("\n\nStory sequence (index, image, caption):\n"),
+        # Do not show the target image, but still provide the original caption
+        # text to preserve style/context
+        CaptionedImages(
+            hidden_text="[Image at this position is hidden]",
+            hidden_label=" <== TARGET POSITION (IMAGE HIDDEN)",
+        ),
+    ),
+    bind=lambda sample: (
+        (
+            None,
+            None,
+            (sample["image_ids"], sample["texts"], sample["target_pos"]),
+        ),
+        {
+            "num_incorrect_options": sample["num_incorrect_options"],
+            "target_pos": sample["target_pos"],
+        },
+    ),
+)
+
+# One request for several target positions of a story. Every target image is
+# hidden, so the positions of a request should not be adjacent: each one keeps
+# its neighboring images (see build_incorrect_options.group_positions).
+BUILD_MULTI_POS_INCORRECT_OPTION_TEMPLATE = PromptTemplate(
+    name="build_multi_pos_incorrect_option",
+    system="You are a helpful assistant.",
+    sections=(
+        Text(
+            "You are given a coherent story represented by a sequence of images and their captions. "
+            "For each target position pos in [{target_positions}], generate {num_incorrect_options} short alternative story snippets to place at that position. "
+            "Each snippet should be plausible at first glance but ultimately incorrect when considering the full context.\n"
+            "- Hidden images:\n"
+            "  - The images at the target positions are hidden. Write the snippets for a position from the visible images and all captions.\n"
+            + INCORRECT_OPTION_RULES
+            + "- Output format:\n"
+            '  - Return only a JSON object that maps each target position (as a string) to a JSON array of strings. Example: {{"0": ["Option A", "Option B"], "3": ["Option C", "Option D"]}}\n'
+            "- Language: English.",
+            params=True,
+        ),
+        Text("\n\nStory sequence (index, image, caption):\n"),
+        CaptionedImages(
+            hidden_text="[Image at this position is hidden]",
+            hidden_label=" <== TARGET POSITION (IMAGE HIDDEN)",
+        ),
+    ),
+    bind=lambda sample: (
+        (
+            None,
+            None,
+            (sample["image_ids"], sample["texts"], tuple(sample["target_positions"])),
+        ),
+        {
+            "num_incorrect_options": sample["num_incorrect_options"],
+            "target_positions": ", ".join(map(str, sample["target_positions"])),
+        },
+    ),
+)
+
+# NOTE: all image_ids are shown and the missing marker is inserted before the
+# image at target_pos; kept as is so that results stay comparable
+INCORRECT_TEMPLATE = PromptTemplate(
+    name="incorrect",
+    system=ANSWER_SYSTEM_PROMPT,
+    sections=(
+        Text(MISSING_IMAGE_INSTRUCTION),
+        Text("\n\nSequence of images:\n"),
+        Images(missing_marker="[Missing Image Position]"),
+        Text("\n\nOptions:"),
+        Texts(item="\n{i}. "),
+    ),
+    bind=lambda sample: (
+        (
+            None,
+            None,
+            (list(sample["image_ids"]), sample["target_pos"]),
+            None,
+            list(sample["incorrect_options"]) + [sample["texts"][sample["target_pos"]]],
+        ),
+        {},
+    ),
+)
+
+SEQ2OPT_TEMPLATE = PromptTemplate(
+    name="seq2opt",
+    system=ANSWER_SYSTEM_PROMPT,
+    sections=(
+        Text(MISSING_IMAGE_INSTRUCTION),
+        Text("\n\nSequence of images:\n"),
+        Images(missing_marker="[Missing Image Position]"),
+        Text("\n\nOptions:"),
+        Texts(item="\n{i}. "),
+    ),
+    bind=lambda sample: (
+        (
+            None,
+            None,
+            (list(sample["question"].keys()), sample["drop_pos"]),
+            None,
+            list(sample["option"].values()),
+        ),
+        {},
+    ),
+)
+
+SHUFFLED_TEXT_TEMPLATE = PromptTemplate(
+    name="shuffled_text",
+    system=ANSWER_SYSTEM_PROMPT,
+    sections=(
+        Text(
+            "You are given five images representing a sequence of events. You are also given five sentences that describe the same sequence of events, but their order has been shuffled. Rearrange them into the correct sequence. Your answer must be provided in array format only. Example: [1, 3, 4, 0, 2]"
+        ),
+        Text("\n\nSequence of images:\n"),
+        Images(),
+        Text("\n\nSentences:"),
+        Texts(item="\n{i}. "),
+    ),
+    bind=lambda sample: (
+        (
+            None,
+            None,
+            (list(sample["image_ids"]), None),
+            None,
+            list(sample["shuffled_texts"]),
+        ),
+        {},
+    ),
+)
+
+SHUFFLED_IMAGE_TEMPLATE = PromptTemplate(
+    name="shuffled_image",
+    system=ANSWER_SYSTEM_PROMPT,
+    sections=(
+        Text(
+            "You are given five sentences representing a sequence of events. You are also given five images that describe the same sequence of events, but their order has been shuffled. Rearrange them into the correct sequence. Your answer must be provided in array format only. Example: [1, 3, 4, 0, 2]"
+        ),
+        Text("\n\nSequence of sentences:\n"),
+        Texts(item="\n"),
+        Text("\n\nImages:"),
+        Images(label="\n{i}\n"),
+    ),
+    bind=lambda sample: (
+        (
+            None,
+            None,
+            list(sample["texts"]),
+            None,
+            (list(sample["shuffled_image_ids"]), None),
+        ),
+        {},
+    ),
+)
 
 
 class TextProcessor:
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def number_to_words(number: str) -> str:
+        return num2words(int(number), lang="en")
+
     @staticmethod
     def convert_numbers_to_words(text: str) -> str:
-        return re.sub(r"\d+", lambda m: num2words(int(m.group()), lang="en"), text)
+        return NUMBER_PATTERN.sub(
+            lambda m: TextProcessor.number_to_words(m.group()), text
+        )
+
+    @staticmethod
+    def convert_numbers_to_words_batch(texts: pd.Series) -> pd.Series:
+        """
+        Same result as texts.apply(convert_numbers_to_words), but every distinct
+        numeric token is converted once and texts without digits are left untouched.
+        """
+        texts = pd.Series(texts, dtype=object)
+        has_number = texts.str.contains(NUMBER_PATTERN, regex=True, na=False)
+        if not has_number.any():
+            return texts.copy()
+
+        with_number = texts[has_number]
+        tokens = set(NUMBER_PATTERN.findall("\n".join(with_number)))
+        words = {token: TextProcessor.number_to_words(token) for token in tokens}
+
+        converted = texts.copy()
+        converted[has_number] = [
+            NUMBER_PATTERN.sub(lambda m: words[m.group()], text) for text in with_number
+        ]
+        return converted
 
     @staticmethod
     def convert_to_build_incorrect_option_template(
@@ -25,240 +252,54 @@ class TextProcessor:
         num_incorrect_options: int
         return: messages
         """
-        image_ids = sample["image_ids"]
-        texts = sample["texts"]
-        assert len(image_ids) == len(texts), "image_ids and texts length mismatch"
-        assert 0 <= target_pos < len(image_ids), "target_pos out of range"
-
-        instruction = (
-            f"You are given a coherent story represented by a sequence of images and their captions. "
-            f"Generate {num_incorrect_options} short alternative story snippets to place at position pos={target_pos}. "
-            "Each snippet should be plausible at first glance but ultimately incorrect when considering the full context.\n"
-            "- Important:\n"
-            "  - Options must be discriminative: avoid generic or 'safe' sentences that could fit regardless of what the hidden image shows.\n"
-            "- Constraints:\n"
-            "  - It must be wrong when the entire context (all images and captions) is considered.\n"
-            "  - Maintain narrative coherence with the surrounding captions (smooth connection, consistent viewpoint/tense, causal flow, recurring entities/terminology).\n"
-            "  - Options must be mutually distinct and not trivially easy.\n"
-            "  - Avoid blatantly wrong errors (physical impossibilities, major plot leaps, obvious anachronisms).\n"
-            "  - Limit differences to subtle yet falsifiable mismatches anchored in the visible context (role/agent swap, off-by-one quantity, order swap, location/time confusion, object state/attribute mismatch, cause–effect inversion, identity confusion, etc.).\n"
-            "- Style:\n"
-            "  - Match the length, tone, perspective, and tense of neighboring captions. Use only previously introduced proper nouns. Do not copy captions verbatim, but keep similar wording.\n"
-            "  - Do not use negations or meta commentary (e.g., 'not', 'incorrect'); write natural narration only.\n"
-            "- Prohibited:\n"
-            "  - Introducing major new elements not present in the images, impossible events, breaking world consistency, explanations or reasoning steps.\n"
-            "  - Generic, content-free sentences that would fit almost any scene.\n"
-            "- Output format:\n"
-            '  - Return only a JSON array of strings (no keys). Example: ["Option A", "Option B", "Option C"]\n'
-            "- Language: English."
+        return render_openai(
+            BUILD_INCORRECT_OPTION_TEMPLATE,
+            {
+                **sample,
+                "target_pos": target_pos,
+                "num_incorrect_options": num_incorrect_options,
+            },
         )
 
-        content = [
-            {"type": "text", "text": instruction},
-            {"type": "text", "text": "\n\nStory sequence (index, image, caption):\n"},
-        ]
-
-        for idx, (image_id, text) in enumerate(zip(image_ids, texts)):
-            marker = " <== TARGET POSITION (IMAGE HIDDEN)" if idx == target_pos else ""
-            content.append({"type": "text", "text": f"({idx}){marker}"})
-            if idx == target_pos:
-                # Do not show the target image
-                content.append(
-                    {"type": "text", "text": "[Image at this position is hidden]"}
-                )
-            else:
-                base64_string = ip.encode_image_to_base64(image_id=image_id)
-                url = ip.encode_base64_to_url(base64_string=base64_string)
-                content.append(
-                    {"type": "image_url", "image_url": {"url": url, "detail": "low"}}
-                )
-            # Still provide the original caption text to preserve style/context
-            content.append({"type": "text", "text": text})
-
-        messages = [
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": content},
-        ]
-
-        return messages
-
     @staticmethod
-    def convert_to_incorrect_template(sample):
-        instruction = "You are given a sequence of images that tell a story, but one image is missing. Choose only the number of the most appropriate option that describes what should happen in the missing image location. Respond with just the index (e.g., 0, 1, 2, ...)."
-        content = [
-            {"type": "text", "text": instruction},
-            {"type": "text", "text": "\n\nSequence of images:\n"},
-        ]
-
-        image_ids = list(sample["image_ids"])
-        original_length = len(image_ids)
-
-        is_missing_inserted = False
-        for i in range(original_length + 1):
-            if i == sample["target_pos"] and not is_missing_inserted:
-                content.append({"type": "text", "text": "[Missing Image Position]"})
-                is_missing_inserted = True
-            else:
-                idx = i - 1 if is_missing_inserted else i
-                base64_string = ip.encode_image_to_base64(image_id=image_ids[idx])
-                url = ip.encode_base64_to_url(base64_string=base64_string)
-                content.append(
-                    {"type": "image_url", "image_url": {"url": url, "detail": "low"}}
-                )
-
-        options = list(sample["incorrect_options"])
-        options.append(sample["texts"][sample["target_pos"]])
-        content.append({"type": "text", "text": "\n\nOptions:"})
-        for i, option in enumerate(options):
-            content.append({"type": "text", "text": f"\n{i}. {option}"})
-
-        messages = [
+    def convert_to_build_multi_pos_incorrect_option_template(
+        sample, target_positions, num_incorrect_options
+    ):
+        """
+        Same sample as convert_to_build_incorrect_option_template.
+        target_positions: List[int]
+        num_incorrect_options: int (per position)
+        return: messages; the reply is a JSON object {"pos": [options]}
+        """
+        return render_openai(
+            BUILD_MULTI_POS_INCORRECT_OPTION_TEMPLATE,
             {
-                "role": "system",
-                "content": "You are a helpful assistant. Answer the following question.",
+                **sample,
+                "target_positions": target_positions,
+                "num_incorrect_options": num_incorrect_options,
             },
-            {"role": "user", "content": content},
-        ]
+        )
 
-        return messages
+    @staticmethod
+    def convert_to_incorrect_template(sample):
+        return render_openai(INCORRECT_TEMPLATE, sample)
 
     @staticmethod
     def convert_to_openai_template(sample):
-        instruction = "You are given a sequence of images that tell a story, but one image is missing. Choose only the number of the most appropriate option that describes what should happen in the missing image location. Respond with just the index (e.g., 0, 1, 2, ...)."
-
-        content = [
-            {"type": "text", "text": instruction},
-            {"type": "text", "text": "\n\nSequence of images:\n"},
-        ]
-
-        image_ids = list(sample["question"].keys())
-        original_length = len(image_ids)
-
-        is_missing_inserted = False
-        for i in range(original_length + 1):
-            if i == sample["drop_pos"] and not is_missing_inserted:
-                content.append({"type": "text", "text": "[Missing Image Position]"})
-                is_missing_inserted = True
-            else:
-                idx = i - 1 if is_missing_inserted else i
-                base64_string = ip.encode_image_to_base64(image_id=image_ids[idx])
-                url = ip.encode_base64_to_url(base64_string=base64_string)
-                content.append(
-                    {"type": "image_url", "image_url": {"url": url, "detail": "low"}}
-                )
-
-        options = list(sample["option"].values())
-        content.append({"type": "text", "text": "\n\nOptions:"})
-        for i, option in enumerate(options):
-            content.append({"type": "text", "text": f"\n{i}. {option}"})
-
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a helpful assistant. Answer the following question.",
-            },
-            {"role": "user", "content": content},
-        ]
-
-        return messages
+        return render_openai(SEQ2OPT_TEMPLATE, sample)
 
     @staticmethod
-    def convert_to_qwen_template(sample):
-        instruction = "You are given a sequence of images that tell a story, but one image is missing. Choose only the number of the most appropriate option that describes what should happen in the missing image location. Respond with just the index (e.g., 0, 1, 2, ...)."
-
-        content = [
-            {"type": "text", "text": instruction},
-            {"type": "text", "text": "\n\nSequence of images:\n"},
-        ]
-
-        image_ids = list(sample["question"].keys())
-        original_length = len(image_ids)
-
-        is_missing_inserted = False
-        images = []
-        for i in range(original_length + 1):
-            if i == sample["drop_pos"] and not is_missing_inserted:
-                content.append({"type": "text", "text": "[Missing Image Position]"})
-                is_missing_inserted = True
-            else:
-                idx = i - 1 if is_missing_inserted else i
-                image = ip.load_image(image_id=image_ids[idx])
-                images.append(image)
-                content.append({"type": "image"})
-
-        options = list(sample["option"].values())
-        content.append({"type": "text", "text": "\n\nOptions:"})
-        for i, option in enumerate(options):
-            content.append({"type": "text", "text": f"\n{i}. {option}"})
-
-        messages = [
-            {"role": "user", "content": content},
-        ]
-
-        return messages, images
+    def convert_to_qwen_template(sample, pixel_cache=None):
+        """
+        pixel_cache: optional PixelCache; cached images are returned as
+        pre-resized (H, W, 3) arrays instead of full-resolution PIL images
+        """
+        return render_qwen(SEQ2OPT_TEMPLATE, sample, pixel_cache=pixel_cache)
 
     @staticmethod
     def convert_to_shuffled_text_template(sample):
-        instruction = "You are given five images representing a sequence of events. You are also given five sentences that describe the same sequence of events, but their order has been shuffled. Rearrange them into the correct sequence. Your answer must be provided in array format only. Example: [1, 3, 4, 0, 2]"
-
-        content = [
-            {"type": "text", "text": instruction},
-            {"type": "text", "text": "\n\nSequence of images:\n"},
-        ]
-
-        image_ids = list(sample["image_ids"])
-
-        for image_id in image_ids:
-            base64_string = ip.encode_image_to_base64(image_id=image_id)
-            url = ip.encode_base64_to_url(base64_string=base64_string)
-            content.append(
-                {"type": "image_url", "image_url": {"url": url, "detail": "low"}}
-            )
-
-        content.append({"type": "text", "text": "\n\nSentences:"})
-        shuffled_texts = list(sample["shuffled_texts"])
-        for i, text in enumerate(shuffled_texts):
-            content.append({"type": "text", "text": f"\n{i}. {text}"})
-
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a helpful assistant. Answer the following question.",
-            },
-            {"role": "user", "content": content},
-        ]
-
-        return messages
+        return render_openai(SHUFFLED_TEXT_TEMPLATE, sample)
 
     @staticmethod
     def convert_to_shuffled_image_template(sample):
-        instruction = "You are given five sentences representing a sequence of events. You are also given five images that describe the same sequence of events, but their order has been shuffled. Rearrange them into the correct sequence. Your answer must be provided in array format only. Example: [1, 3, 4, 0, 2]"
-
-        content = [
-            {"type": "text", "text": instruction},
-            {"type": "text", "text": "\n\nSequence of sentences:\n"},
-        ]
-
-        texts = list(sample["texts"])
-        for text in texts:
-            content.append({"type": "text", "text": f"\n{text}"})
-
-        shuffled_image_ids = list(sample["shuffled_image_ids"])
-        content.append({"type": "text", "text": "\n\nImages:"})
-        for i, image_id in enumerate(shuffled_image_ids):
-            base64_string = ip.encode_image_to_base64(image_id=image_id)
-            url = ip.encode_base64_to_url(base64_string=base64_string)
-            content.append({"type": "text", "text": f"\n{i}\n"})
-            content.append(
-                {"type": "image_url", "image_url": {"url": url, "detail": "low"}}
-            )
-
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a helpful assistant. Answer the following question.",
-            },
-            {"role": "user", "content": content},
-        ]
-
-        return messages
+        return render_openai(SHUFFLED_IMAGE_TEMPLATE, sample)
@@ -1,6 +1,9 @@
 import json
 import os
+import re
+from collections.abc import Iterator
 from pathlib import Path
+from typing import Any
 
 from dotenv import load_dotenv
 
@@ -17,6 +20,67 @@ def env(key: str, default: str | None = None, required: bool = False) -> str | N
     return value
 
 
+def parse_range(arg: str) -> tuple[int, int | None]:
+    """arg: "100" -> (0, 100), "16:" -> (16, None), "16:116" -> (16, 116)"""
+    if ":" not in arg:
+        return 0, int(arg)
+    start, stop = arg.split(":")
+    return int(start or 0), int(stop) if stop else None
+
+
 def load_json(json_path: Path) -> dict:
     with json_path.open("r", encoding="utf-8") as json_file:
         return json.load(json_file)
+
+
+def iter_json_array(
+    json_path: Path, key: str, chunk_size: int = 1024 * 1024
+) -> Iterator[Any]:
+    """
+    Yield the items of the array stored under a top-level key one at a time,
+    without loading the whole document (e.g. "annotations" of the VIST SIS json).
+    Only the current item and one chunk are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    key_pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    keep = len(key) + 64
+
+    with json_path.open("r", encoding="utf-8") as f:
+        buffer = ""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(f"Key '{key}' not found in {json_path}")
+            buffer = buffer[-keep:] + chunk
+            m = key_pattern.search(buffer)
+            if m:
+                buffer = buffer[m.end() :]
+                break
+
+        pos = 0
+        eof = False
+        while True:
+            # skip separators between items
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"Unterminated array '{key}' in {json_path}")
+                buffer, pos = f.read(chunk_size), 0
+                eof = not buffer
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # item spans the chunk boundary: read more and retry
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.utils import async_runner
+from src.utils.async_runner import run_chat_completions
+from src.utils.concurrency import JsonlWriter
+from src.utils.payload import RequestBody
+from src.utils.prompt_template import PromptTemplate, Text, Texts
+from src.utils.response_cache import ResponseCache
+
+TEMPLATE = PromptTemplate(
+    name="test",
+    system=None,
+    sections=(Text("Answer for story"), Texts()),
+    bind=lambda sample: ((None, [sample["story_id"]]), {}),
+)
+
+
+class MockChatCompletions(ThreadingHTTPServer):
+    """
+    POST /v1/chat/completions answering "answer {story_id}" after
+    delays[story_id] seconds. The first throttled[story_id] requests of a
+    story get a 429 with retry-after, stories in rejected get a 400.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.delays: dict[str, float] = {}
+        self.throttled: dict[str, int] = {}
+        self.rejected: set[str] = set()
+        self.lock = threading.Lock()
+        self.attempts: dict[str, int] = {}
+        self.completed: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: MockChatCompletions
+
+    def _send_json(self, status: int, body: dict, headers: dict | None = None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        story_id = body["messages"][-1]["content"][-1]["text"]
+        with server.lock:
+            server.attempts[story_id] = server.attempts.get(story_id, 0) + 1
+            attempt = server.attempts[story_id]
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if attempt <= server.throttled.get(story_id, 0):
+                self._send_json(
+                    429,
+                    {"error": {"message": "rate limited"}},
+                    {"retry-after": "0.05"},
+                )
+                return
+            if story_id in server.rejected:
+                self._send_json(400, {"error": {"message": "bad request"}})
+                return
+            time.sleep(server.delays.get(story_id, 0.01))
+            with server.lock:
+                server.completed.append(story_id)
+            self._send_json(
+                200,
+                {
+                    "model": "mock",
+                    "choices": [{"message": {"content": f"answer {story_id}"}}],
+                },
+            )
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api():
+    server = MockChatCompletions()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_response_cache(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "responses.sqlite", enabled=False)
+    monkeypatch.setattr(async_runner, "get_response_cache", lambda: cache)
+
+
+def make_record(sample: dict, generated: str | None) -> dict:
+    return {"story_id": sample["story_id"], "output": generated}
+
+
+def run(api, writer, story_ids, **kwargs):
+    return asyncio.run(
+        run_chat_completions(
+            [{"story_id": story_id} for story_id in story_ids],
+            lambda sample: RequestBody("mock", TEMPLATE, sample),
+            make_record,
+            writer,
+            api_key="test",
+            base_url=api.base_url,
+            **kwargs,
+        )
+    )
+
+
+def read_records(writer: JsonlWriter) -> list[dict]:
+    with open(writer.jsonl_path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_in_flight_bound_and_completion_order(api, tmp_path):
+    story_ids = [f"s{i}" for i in range(6)]
+    # s2 frees its slot first, s3..s5 then run one after another in it (in
+    # the order they were prepared)
+    api.delays = {"s0": 0.45, "s1": 0.3, "s2": 0.15}
+    writer = JsonlWriter(tmp_path / "out.jsonl")
+
+    stats = run(api, writer, story_ids, max_in_flight=3)
+
+    assert stats.num_done == 6
+    assert api.max_in_flight == 3
+    records = read_records(writer)
+    assert api.completed[0] == "s2"
+    assert api.completed[-2:] == ["s1", "s0"]
+    assert [record["story_id"] for record in records] == api.completed
+    assert all(record["output"] == f"answer {record['story_id']}" for record in records)
+
+
+def test_429_is_retried_after_retry_after(api, tmp_path):
+    api.throttled = {"s1": 2}
+    writer = JsonlWriter(tmp_path / "out.jsonl")
+
+    stats = run(api, writer, ["s0", "s1", "s2"], max_in_flight=2)
+
+    assert stats.num_done == 3
+    assert stats.num_failed == 0
+    assert api.attempts["s1"] == 3
+    assert {record["story_id"]: record["output"] for record in read_records(writer)}[
+        "s1"
+    ] == "answer s1"
+
+
+def test_exhausted_retries_are_resumed_by_the_next_run(api, tmp_path):
+    api.throttled = {"s1": 100}
+    writer = JsonlWriter(tmp_path / "out.jsonl")
+
+    stats = run(api, writer, ["s0", "s1", "s2"], max_retries=2)
+
+    assert stats.num_failed == 1
+    assert stats.failed_keys == ["s1"]
+    assert api.attempts["s1"] == 3
+    assert sorted(record["story_id"] for record in read_records(writer)) == [
+        "s0",
+        "s2",
+    ]
+
+    api.throttled = {}
+    api.attempts.clear()
+    writer.close()
+    writer = JsonlWriter(tmp_path / "out.jsonl")
+    stats = run(api, writer, ["s0", "s1", "s2"], max_retries=2)
+
+    assert stats.num_skipped == 2
+    assert stats.num_done == 1
+    assert api.attempts == {"s1": 1}
+    assert sorted(record["story_id"] for record in read_records(writer)) == [
+        "s0",
+        "s1",
+        "s2",
+    ]
+
+
+def test_rejected_request_is_written_without_output(api, tmp_path):
+    api.rejected = {"s1"}
+    writer = JsonlWriter(tmp_path / "out.jsonl")
+
+    stats = run(api, writer, ["s0", "s1", "s2"])
+
+    assert stats.num_rejected == 1
+    assert stats.failed_keys == []
+    assert api.attempts["s1"] == 1
+    outputs = {record["story_id"]: record["output"] for record in read_records(writer)}
+    assert outputs == {"s0": "answer s0", "s1": None, "s2": "answer s2"}
+
+
+def test_record_error_fails_only_its_sample(api, tmp_path):
+    writer = JsonlWriter(tmp_path / "out.jsonl")
+
+    def make_checked_record(sample: dict, generated: dict | None) -> dict:
+        if generated is not None and sample["story_id"] == "s1":
+            # e.g. a response without choices
+            generated = generated["choices"][1]
+        return make_record(sample, None if generated is None else "ok")
+
+    stats = asyncio.run(
+        asyncio.wait_for(
+            run_chat_completions(
+                [{"story_id": story_id} for story_id in ("s0", "s1", "s2")],
+                lambda sample: RequestBody("mock", TEMPLATE, sample),
+                make_checked_record,
+                writer,
+                api_key="test",
+                base_url=api.base_url,
+                get_content=lambda response: response,
+            ),
+            timeout=30,
+        )
+    )
+
+    assert stats.num_done == 2
+    assert stats.num_rejected == 1
+    outputs = {record["story_id"]: record["output"] for record in read_records(writer)}
+    assert outputs == {"s0": "ok", "s1": None, "s2": "ok"}
+
+
+def test_writer_error_stops_the_run(api, tmp_path):
+    writer = JsonlWriter(tmp_path / "out.jsonl")
+
+    def write_many(records: list[dict]) -> None:
+        raise OSError("disk full")
+
+    writer.write_many = write_many
+    with pytest.raises(OSError, match="disk full"):
+        asyncio.run(
+            asyncio.wait_for(
+                run_chat_completions(
+                    [{"story_id": f"s{i}"} for i in range(50)],
+                    lambda sample: RequestBody("mock", TEMPLATE, sample),
+                    lambda sample, generated: make_record(sample, "ok"),
+                    writer,
+                    api_key="test",
+                    base_url=api.base_url,
+                    max_in_flight=2,
+                ),
+                timeout=30,
+            )
+        )
@@ -0,0 +1,249 @@
+import asyncio
+import base64
+import json
+import runpy
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from PIL import Image
+
+from src.inference import run as run_module
+from src.inference.backends import (
+    GeminiBackend,
+    OpenAIBackend,
+    ServerBackend,
+    get_backend,
+)
+from src.utils.image_cache import ImageCache
+from src.utils.image_processor import ImageProcessor as ip
+from src.utils.payload import get_message_content
+from src.utils.prompt_template import Images, PromptTemplate, Text
+
+INFERENCE_ROOT = Path(run_module.__file__).parent
+
+TASK = SimpleNamespace(
+    template=PromptTemplate(
+        name="test",
+        system="You are a helpful assistant.",
+        sections=(Text("Describe the images."), Images()),
+        bind=lambda sample: ((None, (sample["image_ids"], None)), {}),
+    )
+)
+SAMPLE = {"story_id": "s0", "image_ids": ["img0", "img1"]}
+
+
+@pytest.fixture(autouse=True)
+def images(tmp_path, monkeypatch):
+    for i, color in enumerate(("red", "blue")):
+        Image.new("RGB", (8, 8), color).save(tmp_path / f"img{i}.jpg")
+    monkeypatch.setattr(ip, "image_root_path", tmp_path)
+    monkeypatch.setattr(ip, "image_cache", ImageCache(None, enabled=False))
+    monkeypatch.setenv("OPENAI_API_KEY", "openai-key")
+    monkeypatch.setenv("GEMINI_API_KEY", "gemini-key")
+
+
+def openai_response(content: str, top_logprobs: dict | None = None) -> dict:
+    choice = {"index": 0, "message": {"role": "assistant", "content": content}}
+    if top_logprobs is not None:
+        choice["logprobs"] = {
+            "content": [
+                {
+                    "token": content,
+                    "logprob": top_logprobs[content],
+                    "top_logprobs": [
+                        {"token": token, "logprob": logprob}
+                        for token, logprob in top_logprobs.items()
+                    ],
+                }
+            ]
+        }
+    return {"model": "gpt-4o", "choices": [choice]}
+
+
+def test_get_message_content():
+    response = openai_response("2")
+
+    assert get_message_content(response) == "2"
+    assert get_message_content(httpx.Response(200, json=response)) == "2"
+
+
+def test_openai_body():
+    body = OpenAIBackend().make_body(TASK, SAMPLE, score=True)
+
+    data = body.to_bytes()
+    assert len(data) == body.content_length
+    request = json.loads(data)
+    assert request["model"] == "gpt-4o"
+    assert request["logprobs"] is True
+    assert request["max_tokens"] == 1
+    system, user = request["messages"]
+    assert system == {"role": "system", "content": "You are a helpful assistant."}
+    assert [part["type"] for part in user["content"]] == [
+        "text",
+        "image_url",
+        "image_url",
+    ]
+    url = user["content"][1]["image_url"]["url"]
+    assert url.startswith("data:image/jpeg;base64,")
+    assert base64.b64decode(url.partition(",")[2])[:2] == b"\xff\xd8"
+
+
+def test_openai_option_probs():
+    backend = OpenAIBackend()
+    response = openai_response("1", {"1": -0.1, "0": -2.5, " 3": -3.0, "A": -4.0})
+
+    probs, mass = backend.get_option_probs(response, 3)
+
+    assert probs[1] > probs[0] > 0
+    assert probs[2] == 0
+    assert sum(probs) == pytest.approx(1)
+    assert mass < 1
+    assert backend.get_option_probs(openai_response("A", {"A": 0.0}), 3) is None
+
+
+def test_gemini_body():
+    body = GeminiBackend().make_body(TASK, SAMPLE, score=True)
+
+    data = body.to_bytes()
+    assert len(data) == body.content_length
+    request = json.loads(data)
+    assert request["systemInstruction"] == {
+        "parts": [{"text": "You are a helpful assistant."}]
+    }
+    assert request["generationConfig"] == GeminiBackend.score_params
+    (content,) = request["contents"]
+    assert content["role"] == "user"
+    text, *image_parts = content["parts"]
+    assert text == {"text": "Describe the images."}
+    assert len(image_parts) == 2
+    for part in image_parts:
+        assert part["inlineData"]["mimeType"] == "image/jpeg"
+        assert base64.b64decode(part["inlineData"]["data"])[:2] == b"\xff\xd8"
+    assert "generationConfig" not in json.loads(
+        GeminiBackend().make_body(TASK, SAMPLE).to_bytes()
+    )
+
+
+def test_gemini_post():
+    backend = GeminiBackend("gemini-test")
+    body = backend.make_body(TASK, SAMPLE)
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.headers["x-goog-api-key"] != "gemini-key":
+            return httpx.Response(403)
+        return httpx.Response(200, json={"candidates": []})
+
+    async def post() -> httpx.Response:
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await backend.post(client, body)
+
+    response = asyncio.run(post())
+
+    assert response.json() == {"candidates": []}
+    (request,) = requests
+    assert str(request.url) == (
+        "https://generativelanguage.googleapis.com/v1beta/models/"
+        "gemini-test:generateContent"
+    )
+    assert request.content == body.to_bytes()
+    assert int(request.headers["content-length"]) == body.content_length
+
+
+def test_gemini_response_parsing():
+    backend = GeminiBackend()
+    response = {
+        "candidates": [
+            {
+                "content": {
+                    "parts": [
+                        {"text": "Option 2 fits best.", "thought": True},
+                        {"text": "2"},
+                    ]
+                },
+                "logprobsResult": {
+                    "topCandidates": [
+                        {
+                            "candidates": [
+                                {"token": "2", "logProbability": -0.2},
+                                {"token": "0", "logProbability": -1.8},
+                            ]
+                        }
+                    ]
+                },
+            }
+        ]
+    }
+
+    assert backend.get_content(response) == "2"
+    assert backend.get_top_logprobs(response) == [{"2": -0.2, "0": -1.8}]
+    probs, _ = backend.get_option_probs(response, 4)
+    assert probs[2] > probs[0] > 0
+    # a blocked prompt has no candidates
+    assert backend.get_content({"promptFeedback": {"blockReason": "SAFETY"}}) is None
+    assert backend.get_option_probs({}, 4) is None
+
+
+def test_server_backend_defaults(monkeypatch):
+    monkeypatch.delenv("VISU_SERVER_API_KEY", raising=False)
+    monkeypatch.delenv("VISU_SERVER_URL", raising=False)
+
+    backend = get_backend("server")
+
+    assert isinstance(backend, ServerBackend)
+    assert backend.api_key == "local"
+    assert backend.base_url == "http://127.0.0.1:8765/v1"
+    assert backend.output_name == "qwen2-5-VL-72B-server"
+    assert get_backend("openai:gpt-4o-mini").model == "gpt-4o-mini"
+    with pytest.raises(ValueError, match="Unknown backend"):
+        get_backend("nope")
+
+
+@pytest.mark.parametrize(
+    ("argv", "expected"),
+    [
+        (["seq2opt", "openai"], ("seq2opt", "openai", 0, None, None, False)),
+        (
+            ["seq2opt", "gemini", "16:", "score"],
+            ("seq2opt", "gemini", 16, None, None, True),
+        ),
+        (
+            ["shuffled_text", "openai:gpt-4o-mini", "10:20", "batch", "submit"],
+            ("shuffled_text", "openai:gpt-4o-mini", 10, 20, "submit", False),
+        ),
+    ],
+)
+def test_run_main(monkeypatch, argv, expected):
+    calls = []
+
+    def run_task(task_name, backend_spec, start, stop, batch_step, score):
+        calls.append((task_name, backend_spec, start, stop, batch_step, score))
+
+    monkeypatch.setattr(run_module, "run_task", run_task)
+
+    run_module.main(argv)
+
+    assert calls == [expected]
+
+
+@pytest.mark.parametrize(
+    ("script", "argv", "expected"),
+    [
+        ("seq2opt/gpt4o.py", ["batch", "prepare"], ["incorrect_options", "openai"]),
+        ("seq2opt/gemini2-5pro.py", [], ["seq2opt", "gemini"]),
+        ("seq2opt/qwen2-5-VL.py", ["score"], ["seq2opt", "qwen", "16:"]),
+        ("shuffled_text/gpt4o.py", [], ["shuffled_text", "openai", "100"]),
+        ("shuffled_image/gpt4o.py", [], ["shuffled_image", "openai", "100"]),
+    ],
+)
+def test_wrapper_scripts_call_run_main(monkeypatch, script, argv, expected):
+    calls = []
+    monkeypatch.setattr(run_module, "main", calls.append)
+    monkeypatch.setattr("sys.argv", [script, *argv])
+
+    runpy.run_path(str(INFERENCE_ROOT / script), run_name="__main__")
+
+    assert calls == [expected + argv]
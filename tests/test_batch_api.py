@@ -0,0 +1,175 @@
+import json
+
+import pytest
+
+from src.utils import batch_api
+from src.utils.batch_api import BatchState, collect, prepare
+from src.utils.payload import RequestBody
+from src.utils.prompt_template import PromptTemplate, Text, Texts
+from src.utils.response_cache import ResponseCache
+
+TEMPLATE = PromptTemplate(
+    name="test",
+    system=None,
+    sections=(Text("Answer for story"), Texts()),
+    bind=lambda sample: ((None, [sample["story_id"]]), {}),
+)
+
+
+@pytest.fixture(autouse=True)
+def no_response_cache(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "responses.sqlite", enabled=False)
+    monkeypatch.setattr(batch_api, "get_response_cache", lambda: cache)
+
+
+@pytest.fixture
+def batch_dir(tmp_path):
+    return tmp_path / "out_batch"
+
+
+@pytest.fixture
+def output_path(tmp_path):
+    return tmp_path / "out.jsonl"
+
+
+def samples(num_samples: int) -> list[dict]:
+    return [{"story_id": f"s{i}"} for i in range(num_samples)]
+
+
+def make_body(sample: dict) -> RequestBody:
+    return RequestBody("mock", TEMPLATE, sample, max_tokens=16)
+
+
+def make_record(sample: dict, generated: str | None) -> dict:
+    return {"story_id": sample["story_id"], "output": generated}
+
+
+def write_jsonl(path, rows: list[dict]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(row) + "\n" for row in rows)
+
+
+def read_jsonl(path) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def result(custom_id: str, content: str) -> dict:
+    return {
+        "custom_id": custom_id,
+        "response": {
+            "status_code": 200,
+            "body": {"model": "mock", "choices": [{"message": {"content": content}}]},
+        },
+    }
+
+
+def error_result(custom_id: str) -> dict:
+    return {
+        "custom_id": custom_id,
+        "response": {"status_code": 400, "body": {"error": {"message": "bad"}}},
+    }
+
+
+def test_prepare_splits_by_request_count(batch_dir, output_path):
+    state = prepare(samples(5), make_body, batch_dir, output_path, max_requests=2)
+
+    assert [file["num_requests"] for file in state.files] == [2, 2, 1]
+    lines = [
+        line for file in state.files for line in read_jsonl(batch_dir / file["name"])
+    ]
+    assert [line["custom_id"] for line in lines] == [f"s{i}" for i in range(5)]
+    assert lines[0]["url"] == batch_api.BATCH_ENDPOINT
+    assert lines[0]["body"]["model"] == "mock"
+    assert lines[0]["body"]["max_tokens"] == 16
+
+
+def test_prepare_splits_by_bytes(batch_dir, output_path):
+    single = prepare(samples(1), make_body, batch_dir / "single", output_path)
+    line_bytes = single.files[0]["num_bytes"]
+
+    state = prepare(
+        samples(5), make_body, batch_dir, output_path, max_bytes=2 * line_bytes + 1
+    )
+
+    assert [file["num_requests"] for file in state.files] == [2, 2, 1]
+    for file in state.files:
+        assert file["num_bytes"] == (batch_dir / file["name"]).stat().st_size
+        assert file["num_bytes"] <= 2 * line_bytes + 1
+
+
+def test_prepare_rejects_a_request_over_the_byte_limit(batch_dir, output_path):
+    with pytest.raises(ValueError, match="exceeds the batch file limit"):
+        prepare(samples(1), make_body, batch_dir, output_path, max_bytes=10)
+
+
+def test_prepare_skips_samples_in_the_output(batch_dir, output_path):
+    write_jsonl(output_path, [{"story_id": "s1", "output": "done"}])
+
+    state = prepare(samples(3), make_body, batch_dir, output_path)
+
+    lines = read_jsonl(batch_dir / state.files[0]["name"])
+    assert [line["custom_id"] for line in lines] == ["s0", "s2"]
+
+
+def test_prepare_resumes_from_the_state(batch_dir, output_path):
+    prepare(samples(3), make_body, batch_dir, output_path, max_requests=2)
+
+    state = prepare(samples(10), make_body, batch_dir, output_path, max_requests=2)
+
+    assert [file["num_requests"] for file in state.files] == [2, 1]
+    assert sorted(path.name for path in batch_dir.glob("requests_*.jsonl")) == [
+        "requests_000.jsonl",
+        "requests_001.jsonl",
+    ]
+
+
+def test_collect_reads_local_results(batch_dir, output_path):
+    prepare(samples(4), make_body, batch_dir, output_path)
+    write_jsonl(output_path, [{"story_id": "s3", "output": "earlier"}])
+    write_jsonl(
+        batch_dir / "requests_000.output.jsonl",
+        [
+            result("s0", "answer s0"),
+            error_result("s1"),
+            result("s2", "answer s2"),
+            result("s3", "answer s3"),
+        ],
+    )
+
+    state = collect(samples(4), make_record, batch_dir, output_path)
+
+    assert read_jsonl(output_path) == [
+        {"story_id": "s3", "output": "earlier"},
+        {"story_id": "s0", "output": "answer s0"},
+        {"story_id": "s2", "output": "answer s2"},
+    ]
+    assert state.files[0]["collected"]
+    assert BatchState(batch_dir).files[0]["collected"]
+
+
+def test_collect_resumes_from_the_state(batch_dir, output_path):
+    prepare(samples(4), make_body, batch_dir, output_path, max_requests=2)
+    write_jsonl(
+        batch_dir / "requests_000.output.jsonl",
+        [result("s0", "answer s0"), result("s1", "answer s1")],
+    )
+
+    # the second batch has no result yet and there is no client to ask
+    state = collect(samples(4), make_record, batch_dir, output_path)
+
+    assert [file.get("collected") for file in state.files] == [True, None]
+    assert [record["story_id"] for record in read_jsonl(output_path)] == ["s0", "s1"]
+
+    # collected files are not read again
+    (batch_dir / "requests_000.output.jsonl").write_text("not json\n")
+    write_jsonl(
+        batch_dir / "requests_001.output.jsonl",
+        [result("s2", "answer s2"), result("s3", "answer s3")],
+    )
+    state = collect(samples(4), make_record, batch_dir, output_path)
+
+    assert [file.get("collected") for file in state.files] == [True, True]
+    assert read_jsonl(output_path) == [
+        {"story_id": f"s{i}", "output": f"answer s{i}"} for i in range(4)
+    ]
@@ -0,0 +1,138 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from src.inference import backends
+from src.inference.backends import StubBackend, estimate_prompt_tokens
+from src.inference.tasks import Task
+from src.utils.batching import LengthBucketSampler
+from src.utils.concurrency import JsonlWriter
+from src.utils.prompt_template import PromptTemplate, Text, Texts
+from src.utils.response_cache import ResponseCache
+
+TEMPLATE = PromptTemplate(
+    name="test",
+    system=None,
+    sections=(Text("Answer for story"), Texts()),
+    bind=lambda sample: ((None, [sample["story_id"]]), {}),
+)
+TASK = Task(
+    name="test",
+    template=TEMPLATE,
+    dataset_path=Path("unused"),
+    load_dataset=lambda path: [],
+    make_record=lambda sample, generated: {
+        "story_id": sample["story_id"],
+        "generated": generated,
+    },
+)
+
+
+def batches(sampler: LengthBucketSampler) -> list[list[int]]:
+    return [list(batch) for batch in sampler]
+
+
+def test_batches_hold_one_image_count_longest_first():
+    sampler = LengthBucketSampler(
+        lengths=[10, 50, 30, 20, 40, 60],
+        num_images=[1, 2, 1, 2, 1, 2],
+        max_batch_size=2,
+        max_batch_tokens=1000,
+    )
+
+    # images 2: 60, 50, 20; images 1: 40, 30, 10
+    assert batches(sampler) == [[5, 1], [3], [4, 2], [0]]
+    assert len(sampler) == 4
+
+
+def test_batches_stay_under_the_token_budget():
+    lengths = [100, 90, 80, 70, 60, 50, 40, 30]
+    sampler = LengthBucketSampler(
+        lengths=lengths,
+        num_images=[0] * len(lengths),
+        max_batch_size=8,
+        max_batch_tokens=250,
+    )
+
+    # padded tokens: items * longest item
+    assert batches(sampler) == [[0, 1], [2, 3, 4], [5, 6, 7]]
+    for batch in sampler:
+        assert len(batch) * max(lengths[i] for i in batch) <= 250
+    # an item over the budget still gets a batch of its own
+    sampler.max_batch_tokens = 50
+    assert batches(sampler)[0] == [0]
+
+
+def test_shrink_and_grow_stay_under_the_ceiling():
+    sampler = LengthBucketSampler(
+        lengths=[10] * 100,
+        num_images=[0] * 100,
+        max_batch_size=100,
+        max_batch_tokens=400,
+        grow_after=2,
+    )
+
+    sampler.shrink(300)
+    assert (sampler.max_batch_tokens, sampler.ceiling) == (150, 299)
+    # a batch handed out before the shrink does not lower the budget again
+    sampler.shrink(400)
+    assert (sampler.max_batch_tokens, sampler.ceiling) == (150, 299)
+    assert sampler.num_shrinks == 2
+
+    sampler.grow()
+    assert sampler.max_batch_tokens == 150
+    budgets = []
+    for _ in range(20):
+        sampler.grow()
+        budgets.append(sampler.max_batch_tokens)
+    assert budgets == sorted(budgets)
+    assert budgets[-1] == 299
+    assert all(len(batch) * 10 <= 299 for batch in sampler)
+
+
+@pytest.fixture
+def stub_run(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "responses.sqlite", enabled=False)
+    monkeypatch.setattr(backends, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(backends, "LOCAL_NUM_WORKERS", 0)
+    monkeypatch.setattr(backends, "LOCAL_BATCH_SIZE", 8)
+    monkeypatch.setattr(backends, "LOCAL_BATCH_TOKENS", "100000")
+
+    def run(backend: StubBackend, samples: list[dict]) -> list[dict]:
+        writer = JsonlWriter(tmp_path / "out.jsonl")
+        try:
+            backend.run(TASK, samples, writer)
+        finally:
+            writer.close()
+        with open(writer.jsonl_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    return run
+
+
+def test_out_of_memory_batches_are_split(stub_run, monkeypatch, capsys):
+    samples = [{"story_id": f"s{i:02d}"} for i in range(12)]
+    _, length = estimate_prompt_tokens(TEMPLATE, samples[0])
+    # room for 3 prompts: the batches of 8 and 4 run out of memory
+    monkeypatch.setenv("VISU_STUB_MEMORY_TOKENS", str(3 * length))
+    backend = StubBackend()
+    batch_sizes = []
+    generate = backend.generate
+
+    def record_generate(task, inputs, max_new_tokens=None):
+        outputs = generate(task, inputs, max_new_tokens)
+        batch_sizes.append(len(outputs))
+        return outputs
+
+    monkeypatch.setattr(backend, "generate", record_generate)
+
+    records = stub_run(backend, samples)
+
+    assert sorted(record["story_id"] for record in records) == [
+        sample["story_id"] for sample in samples
+    ]
+    assert all(record["generated"] == "0" for record in records)
+    assert sum(batch_sizes) == 12
+    assert max(batch_sizes) <= 3
+    assert "ran out of memory" in capsys.readouterr().out
@@ -0,0 +1,196 @@
+import json
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+from PIL import Image
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from src.build_dataset import build_incorrect_options
+from src.utils.image_cache import ImageCache
+from src.utils.image_processor import ImageProcessor as ip
+from src.utils.response_cache import ResponseCache
+
+CAPTION_PATTERN = re.compile(r"caption (\w+) \d")
+# "pos in [0, 2]" of a multi-position request, "pos=1" of a single one
+POSITIONS_PATTERN = re.compile(r"pos in \[([\d, ]+)\]|pos=(\d+)")
+
+
+class MockChatCompletions(ThreadingHTTPServer):
+    """
+    POST /v1/chat/completions answering the requests of a story (found by
+    its captions) with replies[story_id] in turn; the last reply repeats.
+    Requests of stories without replies get valid options; their
+    (story_id, positions, number of images) are kept in requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.replies: dict[str, list[str]] = {}
+        self.lock = threading.Lock()
+        self.attempts: dict[str, int] = {}
+        self.requests: list[tuple[str, list[int], int]] = []
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: MockChatCompletions
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        story_id = CAPTION_PATTERN.search(body).group(1)
+        with server.lock:
+            attempt = server.attempts.get(story_id, 0)
+            server.attempts[story_id] = attempt + 1
+        if story_id in server.replies:
+            replies = server.replies[story_id]
+            reply = replies[min(attempt, len(replies) - 1)]
+        else:
+            match = POSITIONS_PATTERN.search(body)
+            positions = [int(pos) for pos in (match[1] or match[2]).split(",")]
+            with server.lock:
+                server.requests.append(
+                    (story_id, positions, body.count('"type":"image_url"'))
+                )
+            options = {str(pos): [f"{story_id} wrong {pos}"] for pos in positions}
+            reply = json.dumps(options if match[1] else options[match[2]])
+        data = json.dumps(
+            {"model": "mock", "choices": [{"message": {"content": reply}}]}
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api():
+    server = MockChatCompletions()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch, api):
+    """ORIGINAL_ROOT with a sis_base.jsonl of stories s0 and s1"""
+    image_root = tmp_path / "images"
+    image_root.mkdir()
+    stories = []
+    for story_id in ("s0", "s1"):
+        image_ids = [f"{story_id}_{pos}" for pos in range(3)]
+        for image_id in image_ids:
+            Image.new("RGB", (8, 8)).save(image_root / f"{image_id}.jpg")
+        stories.append(
+            {
+                "story_id": story_id,
+                "image_ids": image_ids,
+                "texts": [f"caption {story_id} {pos}" for pos in range(3)],
+            }
+        )
+    (tmp_path / "sis_base.jsonl").write_text(
+        "".join(json.dumps(story) + "\n" for story in stories)
+    )
+
+    monkeypatch.setattr(build_incorrect_options, "ORIGINAL_ROOT", tmp_path)
+    monkeypatch.setattr(build_incorrect_options, "OPENAI_BASE_URL", api.base_url)
+    monkeypatch.setattr(build_incorrect_options, "client", httpx.Client(timeout=30))
+    # a real cache: a malformed reply must not come back from it
+    cache = ResponseCache(tmp_path / "responses.sqlite")
+    monkeypatch.setattr(build_incorrect_options, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(ip, "image_root_path", image_root)
+    monkeypatch.setattr(ip, "image_cache", ImageCache(None, enabled=False))
+    return tmp_path
+
+
+def run(monkeypatch, *args: str) -> None:
+    monkeypatch.setattr(sys, "argv", ["build_incorrect_options", *args])
+    build_incorrect_options.main()
+
+
+def read_jsonl(path) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_unparsed_reply_is_retried(root, api, monkeypatch):
+    api.replies = {
+        "s0": ["Sorry, I cannot help with that.", '["wrong 1", "wrong 2"]'],
+        "s1": ['```json\n["other 1", "other 2"]\n```'],
+    }
+
+    run(monkeypatch, "2", "1")
+
+    records = read_jsonl(build_incorrect_options.get_output_path(1, 2))
+    options = {record["story_id"]: record["incorrect_options"] for record in records}
+    assert options == {"s0": ["wrong 1", "wrong 2"], "s1": ["other 1", "other 2"]}
+    assert api.attempts == {"s0": 2, "s1": 1}
+    assert not (
+        root / "text_option" / "pos1" / "incorrect_options_2.unparsed.jsonl"
+    ).exists()
+
+
+def test_unparsed_story_is_kept_aside_and_retried_by_the_next_run(
+    root, api, monkeypatch
+):
+    monkeypatch.setattr(build_incorrect_options, "PARSE_RETRIES", 1)
+    api.replies = {"s0": ["not json"], "s1": ['["other 1", "other 2"]']}
+
+    run(monkeypatch, "2", "1")
+
+    output_path = build_incorrect_options.get_output_path(1, 2)
+    assert [record["story_id"] for record in read_jsonl(output_path)] == ["s1"]
+    assert api.attempts["s0"] == 2
+    unparsed = read_jsonl(output_path.with_name("incorrect_options_2.unparsed.jsonl"))
+    assert unparsed == [
+        {"story_id": "s0", "target_positions": [1], "generated": "not json"}
+    ]
+
+    api.replies["s0"] = ['["wrong 1", "wrong 2"]']
+    api.attempts.clear()
+    monkeypatch.setattr(build_incorrect_options, "client", httpx.Client(timeout=30))
+    run(monkeypatch, "2", "1")
+
+    assert api.attempts == {"s0": 1}
+    assert [record["story_id"] for record in read_jsonl(output_path)] == ["s1", "s0"]
+
+
+def test_group_positions():
+    group_positions = build_incorrect_options.group_positions
+    assert group_positions([0, 1, 2, 3, 4]) == [[0, 2, 4], [1, 3]]
+    assert group_positions([1, 3]) == [[1, 3]]
+    assert group_positions([2]) == [[2]]
+
+
+def test_all_positions_hide_the_target_images(root, api, monkeypatch):
+    run(monkeypatch, "1", "all")
+
+    # 3 positions: one request for 0 and 2, one for 1; the others' images shown
+    assert sorted(api.requests) == [
+        ("s0", [0, 2], 1),
+        ("s0", [1], 2),
+        ("s1", [0, 2], 1),
+        ("s1", [1], 2),
+    ]
+    for pos in range(3):
+        records = read_jsonl(build_incorrect_options.get_output_path(pos, 1))
+        assert sorted(
+            (record["story_id"], record["incorrect_options"]) for record in records
+        ) == [("s0", [f"s0 wrong {pos}"]), ("s1", [f"s1 wrong {pos}"])]
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from src.build_dataset import build_seq2opt_data as seq2opt
+from src.build_dataset.build_seq2opt_data import (
+    build_seq2opt_data,
+    get_seq2opt_output_path,
+)
+
+
+@pytest.fixture
+def base_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(seq2opt, "ORIGINAL_ROOT", tmp_path)
+    path = tmp_path / "sis_base.jsonl"
+    stories = [
+        {
+            "story_id": str(story),
+            "image_ids": [f"p{story}_{pos}" for pos in range(5)],
+            "texts": [f"text {story} {pos}" for pos in range(5)],
+        }
+        for story in range(30)
+    ]
+    path.write_text("".join(json.dumps(story) + "\n" for story in stories))
+    return path
+
+
+def read(drop_pos: int) -> list[dict]:
+    with open(get_seq2opt_output_path(drop_pos), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_options(base_path):
+    build_seq2opt_data(base_path, [2])
+
+    records = read(2)
+    assert len(records) == 30
+    for record in records:
+        options = list(record["option"].items())
+        assert len(options) == 4
+        assert options[record["answer_idx"]] == next(iter(record["answer"].items()))
+        assert len(record["question"]) == 4
+
+
+def test_each_position_is_reproducible_on_its_own(base_path):
+    build_seq2opt_data(base_path, [2])
+    alone = read(2)
+
+    build_seq2opt_data(base_path, [0, 4, 2])
+
+    assert read(2) == alone
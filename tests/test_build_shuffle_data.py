@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from src.build_dataset.build_shuffle_data import build_shuffle_data
+
+
+@pytest.fixture
+def base_path(tmp_path):
+    path = tmp_path / "sis_base.jsonl"
+    stories = [
+        {
+            "story_id": str(story),
+            # stories of 4 and 5 positions
+            "image_ids": [f"p{story}_{pos}" for pos in range(4 + story % 2)],
+            "texts": [f"text {story} {pos}" for pos in range(4 + story % 2)],
+        }
+        for story in range(25)
+    ]
+    path.write_text("".join(json.dumps(story) + "\n" for story in stories))
+    return path
+
+
+def build(tmp_path, base_path, **kwargs) -> tuple[list[dict], list[dict]]:
+    text_path = tmp_path / "text.jsonl"
+    image_path = tmp_path / "image.jsonl"
+    build_shuffle_data(base_path, text_path, image_path, **kwargs)
+    return (
+        [json.loads(line) for line in text_path.read_text().splitlines()],
+        [json.loads(line) for line in image_path.read_text().splitlines()],
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 100])
+def test_answers_restore_the_story(tmp_path, base_path, chunk_size):
+    text_records, image_records = build(
+        tmp_path,
+        base_path,
+        num_shuffles=3,
+        exclude_identity=True,
+        unique=True,
+        chunk_size=chunk_size,
+    )
+
+    assert len(text_records) == len(image_records) == 25 * 3
+    assert [record["story_id"] for record in text_records[:6]] == ["0"] * 3 + ["1"] * 3
+    for record in text_records:
+        restored = [record["shuffled_texts"][i] for i in record["answer"]]
+        assert restored == record["texts"]
+        assert record["shuffled_texts"] != record["texts"]
+    for record in image_records:
+        restored = [record["shuffled_image_ids"][i] for i in record["answer"]]
+        assert restored == record["image_ids"]
+    for story in range(25):
+        shuffles = [
+            r["shuffled_texts"] for r in text_records[3 * story : 3 * story + 3]
+        ]
+        assert len({tuple(shuffle) for shuffle in shuffles}) == 3
+
+
+def test_reproducible_for_a_seed(tmp_path, base_path):
+    first = build(tmp_path, base_path, num_shuffles=2, chunk_size=4)
+    second = build(tmp_path, base_path, num_shuffles=2, chunk_size=4)
+    other_seed = build(tmp_path, base_path, num_shuffles=2, chunk_size=4, seed=7)
+
+    assert first == second
+    assert first != other_seed
@@ -0,0 +1,164 @@
+import base64
+import io
+
+import pytest
+import torch
+from PIL import Image
+
+from src.inference.backends import (
+    STUB_IMAGE_TOKEN_ID,
+    STUB_PAD_TOKEN_ID,
+    StubCache,
+    StubMessageCollator,
+)
+from src.utils.prefix_cache import SharedPrefix, find_shared_prefix
+
+SYSTEM = "You are shown a story. Answer with the index of the option."
+
+
+def image_part() -> dict:
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(buffer, format="JPEG")
+    url = "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def prompt(*parts) -> list[dict]:
+    content = [
+        {"type": "text", "text": part} if isinstance(part, str) else part
+        for part in parts
+    ]
+    return [
+        {"role": "system", "content": SYSTEM},
+        {"role": "user", "content": content},
+    ]
+
+
+@pytest.fixture
+def collate():
+    return StubMessageCollator()
+
+
+def tokens(text: str) -> list[int]:
+    return list(text.encode())
+
+
+def unpadded(input_ids: torch.Tensor, attention_mask: torch.Tensor) -> list[list]:
+    return [row[mask.bool()].tolist() for row, mask in zip(input_ids, attention_mask)]
+
+
+def test_find_shared_prefix_ignores_left_padding(collate):
+    inputs = collate([prompt("Story: a cat."), prompt("Story: a much longer dog.")])
+
+    prefix = find_shared_prefix(inputs["input_ids"], inputs["attention_mask"])
+
+    assert prefix.tolist() == tokens(SYSTEM + "Story: a ")
+
+
+def test_find_shared_prefix_stops_at_stop_tokens(collate):
+    inputs = collate(
+        [
+            prompt("Story:", image_part(), "a cat"),
+            prompt("Story:", image_part(), "a cat"),
+        ]
+    )
+
+    prefix = find_shared_prefix(
+        inputs["input_ids"], inputs["attention_mask"], [STUB_IMAGE_TOKEN_ID]
+    )
+
+    # equal image tokens stand for different pixels
+    assert prefix.tolist() == tokens(SYSTEM + "Story:")
+
+
+def test_find_shared_prefix_keeps_a_suffix_token(collate):
+    inputs = collate([prompt("Story: a cat."), prompt("Story: a cat.", " And more.")])
+
+    prefix = find_shared_prefix(inputs["input_ids"], inputs["attention_mask"])
+
+    assert prefix.tolist() == tokens(SYSTEM + "Story: a cat")
+
+
+def test_find_shared_prefix_min_length(collate):
+    inputs = collate([prompt("Story: a cat."), prompt("Story: a dog.")])
+    shared = len(SYSTEM + "Story: a ")
+
+    assert (
+        find_shared_prefix(
+            inputs["input_ids"], inputs["attention_mask"], min_length=shared
+        )
+        is not None
+    )
+    assert (
+        find_shared_prefix(
+            inputs["input_ids"], inputs["attention_mask"], min_length=shared + 1
+        )
+        is None
+    )
+
+
+def test_split_left_pads_the_suffixes(collate):
+    shared_prefix = SharedPrefix(torch.tensor(tokens(SYSTEM + "Story: ")), StubCache())
+    inputs = collate([prompt("Story: a cat."), prompt("Story: a much longer dog.")])
+
+    suffix_ids, suffix_mask = shared_prefix.split(
+        inputs["input_ids"], inputs["attention_mask"], STUB_PAD_TOKEN_ID
+    )
+
+    assert unpadded(suffix_ids, suffix_mask) == [
+        tokens("a cat."),
+        tokens("a much longer dog."),
+    ]
+    assert suffix_ids.shape == (2, len("a much longer dog."))
+    assert suffix_mask[0].tolist() == [0] * 12 + [1] * 6
+    assert suffix_ids[0, :12].tolist() == [STUB_PAD_TOKEN_ID] * 12
+
+
+def test_split_returns_none_on_a_mismatch(collate):
+    shared_prefix = SharedPrefix(torch.tensor(tokens(SYSTEM + "Story: ")), StubCache())
+    inputs = collate([prompt("Story: a cat."), prompt("Tale: a dog.")])
+
+    assert (
+        shared_prefix.split(
+            inputs["input_ids"], inputs["attention_mask"], STUB_PAD_TOKEN_ID
+        )
+        is None
+    )
+
+
+def test_split_returns_none_without_a_suffix(collate):
+    shared_prefix = SharedPrefix(torch.tensor(tokens(SYSTEM + "Story:")), StubCache())
+    inputs = collate([prompt("Story:")])
+
+    assert (
+        shared_prefix.split(
+            inputs["input_ids"], inputs["attention_mask"], STUB_PAD_TOKEN_ID
+        )
+        is None
+    )
+
+
+def test_fork_copies_the_cache_for_the_batch():
+    shared_prefix = SharedPrefix(torch.tensor(tokens(SYSTEM)), StubCache())
+
+    single = shared_prefix.fork(1)
+    batch = shared_prefix.fork(4)
+
+    assert single is not shared_prefix.past_key_values
+    assert single.batch_size == 1
+    assert batch.batch_size == 4
+    assert shared_prefix.past_key_values.batch_size == 1
+
+
+def test_record_counts_prefill_and_saved_tokens():
+    shared_prefix = SharedPrefix(torch.tensor(tokens("0123456789")), StubCache())
+
+    shared_prefix.record(torch.tensor([[0, 1, 1], [1, 1, 1]]))
+    shared_prefix.record(None, num_tokens=40)
+
+    assert shared_prefix.num_rows == 2
+    assert shared_prefix.num_full_batches == 1
+    # the prefix itself, the suffixes and the batch prefilled in full
+    assert shared_prefix.prefill_tokens == 10 + 5 + 40
+    assert shared_prefix.saved_tokens == 2 * 10
+    assert "20 saved" in shared_prefix.summary()
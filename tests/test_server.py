@@ -0,0 +1,174 @@
+import asyncio
+import json
+import threading
+
+import httpx
+import pytest
+
+from src.inference.backends import ServerBackend, get_backend
+from src.inference.server import ModelServer, ModelWorker
+from src.utils.payload import RequestBody, get_message_content
+from src.utils.prompt_template import PromptTemplate, Text, Texts
+
+TEMPLATE = PromptTemplate(
+    name="test",
+    system=None,
+    sections=(Text("Answer for story"), Texts()),
+    bind=lambda sample: ((None, [sample["story_id"]]), {}),
+)
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """backend -> ServerBackend client of a ModelServer on a free port"""
+    servers = []
+
+    def serve(backend) -> ServerBackend:
+        worker = ModelWorker(backend, max_batch_size=4, batch_wait=0.5)
+        threading.Thread(target=worker.run, daemon=True).start()
+        server = ModelServer(("127.0.0.1", 0), worker)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setenv(
+            "VISU_SERVER_URL", f"http://127.0.0.1:{server.server_address[1]}/v1"
+        )
+        return get_backend(f"server:{backend.model}")
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_body(client: ServerBackend, story_id: str, score: bool = False) -> RequestBody:
+    return RequestBody(
+        model=client.model,
+        template=TEMPLATE,
+        sample={"story_id": story_id},
+        **client.request_params(score),
+    )
+
+
+def record_batch_sizes(backend, monkeypatch) -> list[int]:
+    """sizes of the batches generated (the worker's timer lags the replies)"""
+    batch_sizes = []
+    generate = backend.generate
+
+    def record_generate(task, inputs, max_new_tokens=None):
+        outputs = generate(task, inputs, max_new_tokens)
+        batch_sizes.append(len(outputs))
+        return outputs
+
+    monkeypatch.setattr(backend, "generate", record_generate)
+    return batch_sizes
+
+
+def post_all(client: ServerBackend, bodies: list[RequestBody]) -> list:
+    """responses (or the exceptions raised) of requests sent at once"""
+
+    async def post_all():
+        async with httpx.AsyncClient(timeout=30) as http_client:
+            return await asyncio.gather(
+                *(client.post(http_client, body) for body in bodies),
+                return_exceptions=True,
+            )
+
+    return asyncio.run(post_all())
+
+
+def test_generate_and_score(serve, monkeypatch):
+    monkeypatch.setenv("VISU_STUB_REPLY", "2")
+    client = serve(get_backend("stub"))
+
+    generated, scored = post_all(
+        client, [make_body(client, "s0"), make_body(client, "s1", score=True)]
+    )
+
+    assert get_message_content(generated) == "2"
+    assert client.get_top_logprobs(scored.json()) == [{"2": 0.0}]
+    assert client.get_option_probs(scored.json(), 4) == ([0.0, 0.0, 1.0, 0.0], 1.0)
+
+
+def test_invalid_requests(serve):
+    client = serve(get_backend("stub"))
+    url = f"{client.base_url}/chat/completions"
+
+    assert httpx.post(url, json={"messages": []}).status_code == 400
+    assert httpx.post(url, content=b"not json").status_code == 400
+    response = httpx.post(url, json={"model": "other", "messages": [{}]})
+    assert response.status_code == 404
+    assert httpx.get(f"{client.base_url}/models").json()["data"][0]["id"] == "stub"
+
+
+def test_requests_are_batched(serve, monkeypatch):
+    backend = get_backend("stub")
+    batch_sizes = record_batch_sizes(backend, monkeypatch)
+    client = serve(backend)
+
+    responses = post_all(client, [make_body(client, f"s{i}") for i in range(8)])
+
+    assert [get_message_content(response) for response in responses] == ["0"] * 8
+    assert sum(batch_sizes) == 8
+    assert max(batch_sizes) > 1
+
+
+def test_out_of_memory_batches_are_split(serve, monkeypatch, capsys):
+    stub = get_backend("stub")
+    message_collator = stub.make_message_collator()
+    bodies = [make_body(stub, f"s{i}") for i in range(4)]
+    length = max(
+        message_collator.render(json.loads(body.to_bytes())["messages"])[1]
+        for body in bodies
+    )
+    # room for 2 requests
+    monkeypatch.setenv("VISU_STUB_MEMORY_TOKENS", str(2 * length))
+    backend = get_backend("stub")
+    batch_sizes = record_batch_sizes(backend, monkeypatch)
+    client = serve(backend)
+
+    responses = post_all(client, bodies)
+
+    assert [get_message_content(response) for response in responses] == ["0"] * 4
+    assert "Out of memory with 4 requests" in capsys.readouterr().out
+    assert batch_sizes == [2, 2]
+
+
+def test_missing_outputs_fail_their_requests(serve, monkeypatch):
+    backend = get_backend("stub")
+    batch_sizes = []
+
+    def generate(task, inputs, max_new_tokens=None):
+        batch_sizes.append(len(inputs["lengths"]))
+        return ["0"]
+
+    monkeypatch.setattr(backend, "generate", generate)
+    client = serve(backend)
+
+    responses = post_all(client, [make_body(client, f"s{i}") for i in range(3)])
+
+    assert batch_sizes == [3]
+    assert get_message_content(responses[0]) == "0"
+    for error in responses[1:]:
+        assert isinstance(error, httpx.HTTPStatusError)
+        assert error.response.status_code == 500
+        assert "1 outputs for a batch of 3" in error.response.json()["error"]["message"]
+
+
+def test_worker_survives_a_failing_batch(serve, monkeypatch):
+    monkeypatch.setenv("VISU_STUB_MEMORY_TOKENS", "1")
+    backend = get_backend("stub")
+
+    def handle_out_of_memory(e):
+        raise RuntimeError("cannot release the memory")
+
+    monkeypatch.setattr(backend, "handle_out_of_memory", handle_out_of_memory)
+    client = serve(backend)
+
+    responses = post_all(client, [make_body(client, f"s{i}") for i in range(2)])
+
+    for error in responses:
+        assert error.response.status_code == 500
+        assert "cannot release the memory" in error.response.text
+    backend.memory_tokens = None
+    (response,) = post_all(client, [make_body(client, "s2")])
+    assert get_message_content(response) == "0"